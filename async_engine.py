@@ -0,0 +1,315 @@
+import asyncio
+import logging
+import threading
+from collections import deque
+
+import paho.mqtt.client as mqtt
+
+from codec import JSON
+from transport import MqttTransport, MQTT_BROKER, MQTT_PORT
+
+# How the server runs its sessions, chosen when it starts.
+#
+# threads: commands are handled on a pool of worker threads and the machines on
+# a pool of stmpy drivers, each with a thread of its own (see dispatch.py and
+# driver_pool.py).
+# asyncio: network I/O, commands, machines and their timers all run on a single
+# asyncio event loop. A session costs a machine and its pending timer handles,
+# no thread, and a transition never runs at the same time as another.
+THREADS = 'threads'
+ASYNCIO = 'asyncio'
+ENGINES = (THREADS, ASYNCIO)
+# seconds between two calls to paho's housekeeping (keepalive, retries, reconnects)
+MQTT_MISC_INTERVAL = 1.0
+
+
+class EventLoopThread:
+    """An asyncio event loop running on a thread of its own, for code that is not async itself."""
+
+    def __init__(self, name='event-loop'):
+        self._logger = logging.getLogger(__name__)
+        self.loop = asyncio.new_event_loop()
+        self._started = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+        self._started.wait()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self._started.set)
+        self.loop.run_forever()
+
+    def in_loop(self):
+        return threading.get_ident() == self.thread.ident
+
+    def call(self, func, *args):
+        # call_soon is only safe on the loop's own thread, everybody else has to wake it up
+        if self.in_loop():
+            self.loop.call_soon(func, *args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class LoopWorkerPool:
+    """
+    The WorkerPool interface of dispatch.py, running every job on the event loop.
+
+    Jobs run one at a time in the order they were submitted, which keeps the
+    order of each session's commands just like a keyed worker does.
+    """
+
+    def __init__(self, event_loop):
+        self._logger = logging.getLogger(__name__)
+        self.event_loop = event_loop
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    def __len__(self):
+        return 1
+
+    def submit(self, key, func, *args):
+        with self._lock:
+            self._pending += 1
+        self.event_loop.call(self._run, func, args)
+        return True
+
+    def _run(self, func, args):
+        try:
+            func(*args)
+        except Exception as err:
+            self._logger.error('Invalid arguments to command. {}'.format(err))
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def queue_depths(self):
+        return [self._pending]
+
+    def stop(self):
+        pass
+
+
+class _EventQueue:
+    # what stmpy machines touch of a driver's queue.Queue: deferred events are
+    # put back at the front of `queue`
+    def __init__(self):
+        self.queue = deque()
+
+    def qsize(self):
+        return len(self.queue)
+
+
+class LoopDriver:
+    """
+    Runs stmpy machines on the event loop instead of a thread of its own.
+
+    It offers what stmpy machines and the server use of a stmpy Driver: adding
+    machines, sending them events by name and their timers. Events are handled
+    run to completion, one at a time, in batches between which the loop gets
+    back to its I/O. Timers are loop timer handles, so starting or stopping one
+    does not sort a list of all timers, and a machine's timers are cancelled
+    when it terminates.
+    """
+
+    def __init__(self, event_loop):
+        self._logger = logging.getLogger(__name__)
+        self.event_loop = event_loop
+        # our own table of machines by name, stmpy keeps one for the whole process
+        self._stms_by_id = {}
+        self._event_queue = _EventQueue()
+        self._scheduled = False
+        # machine id -> timer name -> loop timer handle
+        self._timers = {}
+
+    def add_machine(self, machine):
+        machine._driver = self
+        machine._reset()
+        if machine.id is not None:
+            self._stms_by_id[machine.id] = machine
+            self._add_event(None, [], {}, machine)
+
+    def start(self, max_transitions=None, keep_active=True):
+        # runs as long as the event loop does
+        pass
+
+    def stop(self):
+        self.event_loop.call(self._cancel_timers)
+
+    def send(self, message_id, stm_id, args=[], kwargs={}):
+        stm = self._stms_by_id.get(stm_id)
+        if stm is None:
+            self._logger.warning('Machine with name {} cannot be found. Ignoring message {}.'.format(
+                stm_id, message_id))
+            return
+        self._add_event(message_id, args, kwargs, stm)
+
+    def _add_event(self, event_id, args, kwargs, stm, front=False):
+        event = {'id': event_id, 'args': args, 'kwargs': kwargs, 'stm': stm}
+        if front:
+            self._event_queue.queue.appendleft(event)
+        else:
+            self._event_queue.queue.append(event)
+        if not self._scheduled:
+            self._scheduled = True
+            self.event_loop.call(self._run_events)
+
+    def _run_events(self):
+        # events added from here on need another round
+        self._scheduled = False
+        events = self._event_queue.queue
+        for _ in range(len(events)):
+            if not events:
+                break
+            event = events.popleft()
+            stm = event['stm']
+            try:
+                if stm._defers_event(event['id']):
+                    stm._add_to_defer_queue(event)
+                else:
+                    stm._execute_transition(event['id'], event['args'], event['kwargs'])
+            except Exception as err:
+                self._logger.error('Machine {} failed on event {}. {}'.format(stm.id, event['id'], err))
+        if events and not self._scheduled:
+            self._scheduled = True
+            self.event_loop.call(self._run_events)
+
+    def _start_timer(self, name, timeout, stm):
+        if not self.event_loop.in_loop():
+            self.event_loop.call(self._start_timer, name, timeout, stm)
+            return
+        timers = self._timers.setdefault(stm.id, {})
+        handle = timers.pop(name, None)
+        if handle is not None:
+            handle.cancel()
+        timers[name] = self.event_loop.loop.call_later(int(timeout) / 1000, self._timer_expired, name, stm)
+
+    def _timer_expired(self, name, stm):
+        timers = self._timers.get(stm.id)
+        if timers is not None:
+            timers.pop(name, None)
+            if not timers:
+                del self._timers[stm.id]
+        self._add_event(name, [], {}, stm, front=True)
+
+    def _stop_timer(self, name, stm, log=True):
+        if not self.event_loop.in_loop():
+            self.event_loop.call(self._stop_timer, name, stm)
+            return
+        timers = self._timers.get(stm.id)
+        handle = timers.pop(name, None) if timers is not None else None
+        if handle is not None:
+            handle.cancel()
+
+    def _get_timer(self, name, stm):
+        handle = self._timers.get(stm.id, {}).get(name)
+        if handle is None:
+            return None
+        return (handle.when() - self.event_loop.loop.time()) * 1000
+
+    def _terminate_stm(self, stm_id):
+        self._stms_by_id.pop(stm_id, None)
+        for handle in self._timers.pop(stm_id, {}).values():
+            handle.cancel()
+
+    def _cancel_timers(self):
+        for timers in self._timers.values():
+            for handle in timers.values():
+                handle.cancel()
+        self._timers.clear()
+
+
+class LoopDriverPool:
+    """The DriverPool interface of driver_pool.py, with one LoopDriver for every session."""
+
+    def __init__(self, event_loop):
+        self.driver = LoopDriver(event_loop)
+        self.drivers = [self.driver]
+
+    def __len__(self):
+        return 1
+
+    def driver_for(self, key):
+        return self.driver
+
+    def add_machine(self, key, machine):
+        self.driver.add_machine(machine)
+        return self.driver
+
+    def queue_depths(self):
+        return [self.driver._event_queue.qsize()]
+
+    def stop(self):
+        self.driver.stop()
+
+
+class AsyncioMqttTransport(MqttTransport):
+    """
+    The paho MQTT client with its network I/O on the event loop, no thread of its own.
+
+    paho tells us when its socket opens, closes and has something to write; the
+    loop then calls paho back when the socket can be read or written. Everything
+    that touches the client is done on the loop.
+    """
+
+    def __init__(self, event_loop, broker=MQTT_BROKER, port=MQTT_PORT, codec=JSON):
+        super().__init__(broker, port, codec)
+        self.event_loop = event_loop
+        self._misc = None
+        self.mqtt_client.on_socket_open = self._on_socket_open
+        self.mqtt_client.on_socket_close = self._on_socket_close
+        self.mqtt_client.on_socket_register_write = self._on_socket_register_write
+        self.mqtt_client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def subscribe(self, topic):
+        self.event_loop.call(super().subscribe, topic)
+
+    def start(self):
+        self.event_loop.call(self._connect)
+
+    def _connect(self):
+        self._logger.debug('Connecting to MQTT broker {} at port {}'.format(self.broker, self.port))
+        try:
+            self.mqtt_client.connect(self.broker, self.port)
+        except OSError as err:
+            self._logger.error('Could not connect to MQTT broker {}, retrying. {}'.format(self.broker, err))
+        self._misc = self.event_loop.loop.call_later(MQTT_MISC_INTERVAL, self._loop_misc)
+
+    def _loop_misc(self):
+        if self.mqtt_client.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+            try:
+                self.mqtt_client.reconnect()
+            except OSError as err:
+                self._logger.error('Could not reconnect to MQTT broker {}. {}'.format(self.broker, err))
+        self._misc = self.event_loop.loop.call_later(MQTT_MISC_INTERVAL, self._loop_misc)
+
+    def stop(self):
+        self.event_loop.call(self._disconnect)
+
+    def _disconnect(self):
+        if self._misc is not None:
+            self._misc.cancel()
+            self._misc = None
+        self.mqtt_client.disconnect()
+
+    def publish(self, topic, msg, qos=2, codec=None):
+        if self.event_loop.in_loop():
+            super().publish(topic, msg, qos, codec)
+        else:
+            self.event_loop.call(super().publish, topic, msg, qos, codec)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self.event_loop.loop.add_reader(sock, client.loop_read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self.event_loop.loop.remove_reader(sock)
+        self.event_loop.loop.remove_writer(sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self.event_loop.loop.add_writer(sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self.event_loop.loop.remove_writer(sock)
@@ -0,0 +1,266 @@
+"""
+Load test for the server.
+
+Drives simulated phones through the whole protocol against a simulated fleet:
+
+    phone_location -> selected_escooter -> exchange_destination -> route_confirmed
+    -> ask_price / ask_distance -> destination_reached
+
+and reports latency percentiles per step, throughput, thread count and RSS.
+By default everything runs in this process over the loopback transport; pass
+--broker to go through a real (local) MQTT broker instead, and --nodes to run
+several servers as a cluster (the broker must support shared subscriptions).
+
+    python benchmark.py --phones 500 --concurrency 50 --fleet 10000 --output bench.json
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import server
+from cluster import HEARTBEAT_INTERVAL
+from codec import BINARY
+from fleet_sim import CITY_SIZE, FleetSimulator
+from topics import escooter_input_topic, escooter_bucket_topic, phone_input_topic, phone_topic
+from transport import LoopbackBus, LoopbackTransport, MqttTransport
+
+STEPS = ["phone_location", "selected_escooter", "exchange_destination", "route_confirmed",
+         "ask_price", "ask_distance", "destination_reached"]
+# seconds a simulated phone waits for the answer to one step
+STEP_TIMEOUT = 10
+
+
+def make_transport(bus, host, port):
+    if bus is not None:
+        return LoopbackTransport(bus)
+    return MqttTransport(host, port, BINARY)
+
+
+class SimulatedFleet:
+    """Answers the server on behalf of every escooter and tells phones when their escooter got a command."""
+
+    def __init__(self, transport, size, seed=None):
+        self.transport = transport
+        self.sim = FleetSimulator(size, seed=seed)
+        self.names = [self.sim.name_of(i) for i in range(size)]
+        # server_name / escooter_name -> callback of the phone waiting for it
+        self.waiters = {}
+        transport.on_message = self.on_message
+        transport.subscribe(escooter_bucket_topic('+'))
+        transport.start()
+
+    def publish(self, msg, topic):
+        self.transport.publish(topic, msg, qos=1)
+
+    def report_all(self):
+        positions, busy = self.sim.snapshot()
+        for name, location, is_busy in zip(self.names, positions, busy):
+            self.publish({"command": "escooter_report", "escooter_id": name, "location": location,
+                          "busy": is_busy}, escooter_input_topic(name))
+
+    def on_message(self, topic, payload, codec):
+        command = payload.get("command")
+        name = payload.get("escooter_name")
+        if command == "get_location":
+            self.publish({"command": "receive_escooter_location", "location": self.sim.location(name),
+                          "escooter_id": name, "busy": self.sim.is_busy(name), "server_name": payload.get("server_name"),
+                          "phone_location": payload.get("phone_location")}, escooter_input_topic(name))
+        elif command in ("receive_route_details", "destination_reached"):
+            waiter = self.waiters.get(name)
+            if waiter is not None:
+                waiter(command)
+
+
+class SimulatedPhone:
+    def __init__(self, name, transport, fleet):
+        self.name = name
+        self.transport = transport
+        self.fleet = fleet
+        self.inbox = queue.Queue()
+        self.location = (random.randint(0, CITY_SIZE), random.randint(0, CITY_SIZE))
+        transport.on_message = lambda topic, msg, codec: self.inbox.put(msg.get("command"))
+        transport.subscribe(phone_topic(name))
+        transport.start()
+
+    def send(self, msg):
+        msg["phone_name"] = self.name
+        self.transport.publish(phone_input_topic(self.name), msg, qos=1)
+
+    def expect(self, *commands):
+        deadline = time.monotonic() + STEP_TIMEOUT
+        while True:
+            command = self.inbox.get(timeout=max(deadline - time.monotonic(), 0))
+            if command in commands:
+                return command
+
+    def step(self, latencies, step, msg, *answers):
+        start = time.perf_counter()
+        self.send(msg)
+        answer = self.expect(*answers)
+        latencies[step].append(time.perf_counter() - start)
+        return answer
+
+    def run(self, latencies):
+        self.step(latencies, "phone_location", {"command": "phone_location", "location": self.location},
+                  "escooters_list")
+        escooter = None
+        for name in random.sample(self.fleet.names, min(5, len(self.fleet.names))):
+            answer = self.step(latencies, "selected_escooter", {"command": "selected_escooter", "escooter": name},
+                               "reservation_confirmed", "reservation_failed")
+            if answer == "reservation_confirmed":
+                escooter = name
+                break
+            # the server follows up a failed reservation with a fresh list
+            self.expect("escooters_list")
+        if escooter is None:
+            raise RuntimeError("{} could not reserve an escooter".format(self.name))
+        # the escooter's commands reach the fleet, which hands them to us
+        self.fleet.waiters[escooter] = self.inbox.put
+
+        destination = (random.randint(0, CITY_SIZE), random.randint(0, CITY_SIZE))
+        self.step(latencies, "exchange_destination", {"command": "exchange_destination", "location": self.location,
+                                                      "destination": destination}, "suggest_route")
+        self.step(latencies, "route_confirmed", {"command": "route_confirmed", "confirm": True, "price": 1},
+                  "receive_route_details")
+        self.step(latencies, "ask_price", {"command": "ask_price", "location": self.location}, "price_remaining")
+        self.step(latencies, "ask_distance", {"command": "ask_distance", "location": self.location},
+                  "distance_remaining")
+        self.step(latencies, "destination_reached", {"command": "destination_reached", "escooter": escooter},
+                  "destination_reached")
+        self.fleet.waiters.pop(escooter, None)
+        self.transport.stop()
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def rss_bytes():
+    try:
+        import psutil
+        return psutil.Process(os.getpid()).memory_info().rss
+    except ImportError:
+        import resource
+        # peak rather than current, but better than nothing; KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_benchmark(phones=100, concurrency=20, fleet_size=1000, cold=False, host=None, port=server.MQTT_PORT,
+                  driver_pool_size=server.DRIVER_POOL_SIZE, worker_pool_size=server.WORKER_POOL_SIZE, seed=None,
+                  nodes=1, record=None, engine=server.THREADS):
+    random.seed(seed)
+    bus = LoopbackBus() if host is None else None
+    rss_before = rss_bytes()
+    # more than one node makes a cluster, see cluster.py; all drivers must exist before the first machine
+    components = [server.ServerManagerComponent(driver_pool_size=driver_pool_size, worker_pool_size=worker_pool_size,
+                                                transport=make_transport(bus, host, port),
+                                                node=None if nodes == 1 else f"bench_node_{i}",
+                                                record=None if record is None else
+                                                record if nodes == 1 else f"{record}.{i}", engine=engine)
+                  for i in range(nodes)]
+    fleet = SimulatedFleet(make_transport(bus, host, port), fleet_size, seed)
+    for component in components:
+        component.escooters = fleet.names
+    if not cold:
+        fleet.report_all()
+        while any(len(component.fleet) < fleet_size for component in components):
+            time.sleep(0.01)
+    if nodes > 1:
+        # until every node knows the others and takes its share of the phones
+        while any(len(component.cluster.members) < nodes for component in components):
+            time.sleep(0.01)
+        time.sleep(2 * HEARTBEAT_INTERVAL)
+
+    latencies = {step: [] for step in STEPS}
+    failures = []
+    peak_threads = threading.active_count()
+
+    def one_phone(i):
+        nonlocal peak_threads
+        phone = SimulatedPhone(f"bench_phone_{i}", make_transport(bus, host, port), fleet)
+        try:
+            phone.run(latencies)
+        except Exception as err:
+            failures.append(repr(err))
+        peak_threads = max(peak_threads, threading.active_count())
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one_phone, range(phones)))
+    elapsed = time.perf_counter() - start
+
+    results = {
+        "phones": phones,
+        "concurrency": concurrency,
+        "fleet_size": fleet_size,
+        "cold": cold,
+        "seed": seed,
+        "transport": "loopback" if host is None else "mqtt://{}:{}".format(host, port),
+        "elapsed_s": elapsed,
+        "sessions_per_s": (phones - len(failures)) / elapsed,
+        "failures": len(failures),
+        "steps": {step: {"count": len(values),
+                         "p50_ms": _ms(percentile(values, 50)),
+                         "p95_ms": _ms(percentile(values, 95)),
+                         "p99_ms": _ms(percentile(values, 99))}
+                  for step, values in latencies.items()},
+        "peak_threads": peak_threads,
+        "rss_bytes": rss_bytes(),
+        "rss_growth_bytes": rss_bytes() - rss_before,
+        "nodes": nodes,
+        "engine": engine,
+        "sessions": components[0].session_stats() if nodes == 1 else
+        {component.node: component.session_stats() for component in components},
+        "server_metrics": components[0].metrics.snapshot() if nodes == 1 else
+        {component.node: component.metrics.snapshot() for component in components},
+    }
+    for component in components:
+        component.stop()
+    fleet.transport.stop()
+    if failures:
+        logging.getLogger(__name__).warning('First failures: {}'.format(failures[:5]))
+    return results
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--phones', type=int, default=100, help='number of simulated phone sessions')
+    parser.add_argument('--concurrency', type=int, default=20, help='sessions running at the same time')
+    parser.add_argument('--fleet', type=int, default=1000, help='number of simulated escooters')
+    parser.add_argument('--cold', action='store_true', help='no escooter reports, discovery fans out get_location')
+    parser.add_argument('--broker', default=None, help='MQTT broker host, default is the in-process loopback')
+    parser.add_argument('--port', type=int, default=server.MQTT_PORT)
+    parser.add_argument('--drivers', type=int, default=server.DRIVER_POOL_SIZE, help='stmpy driver pool size')
+    parser.add_argument('--workers', type=int, default=server.WORKER_POOL_SIZE, help='command worker pool size')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the fleet and phone simulation')
+    parser.add_argument('--nodes', type=int, default=1, help='server nodes sharing the load as a cluster')
+    parser.add_argument('--engine', choices=server.ENGINES, default=server.THREADS,
+                        help='how the servers run their sessions, see async_engine.py')
+    parser.add_argument('--record', default=None, help='record the server traffic to this file, see replay.py')
+    parser.add_argument('--output', default=None, help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = run_benchmark(phones=args.phones, concurrency=args.concurrency, fleet_size=args.fleet, cold=args.cold,
+                            host=args.broker, port=args.port, driver_pool_size=args.drivers,
+                            worker_pool_size=args.workers, seed=args.seed, nodes=args.nodes,
+                            record=args.record, engine=args.engine)
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
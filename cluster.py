@@ -0,0 +1,124 @@
+import logging
+import threading
+import time
+
+from hash_ring import HashRing
+from qos import qos_for
+from topics import member_topic
+
+# seconds between two heartbeats of a server node
+HEARTBEAT_INTERVAL = 1.0
+# a node not heard from for this long has left the cluster
+NODE_TIMEOUT = 5.0
+# name of the MQTT shared subscription the servers split the phones' messages over
+SHARED_GROUP = 'team02Servers'
+# what the servers of a cluster send each other
+CLUSTER_COMMANDS = ("node_heartbeat", "node_leave", "session_handoff", "reservation_request", "reservation_result",
+                    "reservation_extend", "reservation_release", "reservation_handoff")
+
+
+class ClusterMembership:
+    """
+    Which server nodes are up, and which of them owns a session.
+
+    Every node publishes a heartbeat on its member topic and listens to the
+    heartbeats of the others. The nodes heard from within NODE_TIMEOUT, this
+    one included, make up a consistent hash ring; a session belongs to the node
+    the ring maps its phone name to. As all nodes see the same heartbeats they
+    agree on the owners, apart from the moment a node joins or leaves.
+
+    `on_change(members)` is called, on the heartbeat thread or the thread that
+    handed in a heartbeat, whenever the ring changed.
+    """
+
+    def __init__(self, node, transport, on_change=None, heartbeat_interval=HEARTBEAT_INTERVAL,
+                 timeout=NODE_TIMEOUT):
+        self._logger = logging.getLogger(__name__)
+        self.node = node
+        self.transport = transport
+        self.on_change = on_change
+        self.heartbeat_interval = heartbeat_interval
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        # node -> when we last heard from it
+        self._last_seen = {}
+        self.ring = HashRing([node])
+        # when the ring last changed, owners may disagree for a moment after that
+        self.changed_at = time.monotonic()
+        self._stop = threading.Event()
+        self._heartbeats = None
+
+    @property
+    def members(self):
+        return list(self.ring.members)
+
+    def owner(self, key):
+        with self._lock:
+            return self.ring.get(key)
+
+    def is_local(self, key):
+        return self.owner(key) == self.node
+
+    def start(self):
+        self._stop.clear()
+        self._heartbeats = threading.Thread(target=self._beat, daemon=True)
+        self._heartbeats.start()
+
+    def leave(self):
+        """Tell the others we are going, from now on we own nothing."""
+        self._stop.set()
+        with self._lock:
+            self.ring.remove(self.node)
+            self.changed_at = time.monotonic()
+        self.transport.publish(member_topic(self.node), {"command": "node_leave", "node": self.node},
+                               qos=qos_for("node_leave"))
+
+    def stop(self):
+        # leave right away instead of letting the others time us out
+        if not self._stop.is_set():
+            self.leave()
+
+    def _beat(self):
+        while True:
+            self.transport.publish(member_topic(self.node), {"command": "node_heartbeat", "node": self.node},
+                                   qos=qos_for("node_heartbeat"))
+            self.expire()
+            if self._stop.wait(self.heartbeat_interval):
+                return
+
+    def on_heartbeat(self, node, now=None):
+        if node == self.node:
+            return
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            joined = node not in self._last_seen
+            self._last_seen[node] = now
+            if joined:
+                self.ring.add(node)
+                self.changed_at = now
+        if joined:
+            self._logger.info('Node {} joined, members {}'.format(node, self.members))
+            self._changed()
+
+    def on_leave(self, node, now=None):
+        with self._lock:
+            left = self._last_seen.pop(node, None) is not None
+            if left:
+                self.ring.remove(node)
+                self.changed_at = time.monotonic() if now is None else now
+        if left:
+            self._logger.info('Node {} left, members {}'.format(node, self.members))
+            self._changed()
+
+    def expire(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            gone = [node for node, seen in self._last_seen.items() if seen <= now - self.timeout]
+        for node in gone:
+            self._logger.warning('Node {} timed out'.format(node))
+            self.on_leave(node, now)
+        return gone
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change(self.members)
@@ -0,0 +1,300 @@
+import json
+import struct
+
+# Wire formats shared by the phone, the server and the escooters.
+#
+# JSON is what every client has always spoken and stays the fallback. The binary
+# format is a compact tagged encoding of the same dicts: the command and the
+# well-known keys are sent as one-byte codes and coordinate pairs are packed as
+# long as that does not change them.
+# A receiver tells the two apart by the first byte, so it never needs to know in
+# advance what a client speaks; the server answers each client in the format
+# that client last used, down to the version of the binary format it spoke.
+
+JSON = 'json'
+BINARY = 'binary'
+
+BINARY_MAGIC = 0xB7
+# every entry added to COMMANDS or KEYS needs a new version in TABLE_SIZES
+BINARY_VERSION = 3
+
+# append only, the position in the list is the code on the wire
+COMMANDS = [
+    "phone_location", "escooters_list", "selected_escooter", "exchange_destination", "suggest_route",
+    "route_confirmed", "ask_price", "price_remaining", "ask_distance", "distance_remaining",
+    "destination_reached", "get_location", "receive_escooter_location", "escooter_report",
+    "receive_route_details", "reservation_confirmed", "reservation_failed", "trip_update",
+    "out_of_route", "back_on_route", "escooter_report_batch", "node_heartbeat", "node_leave", "session_handoff",
+    "reservation_request", "reservation_result", "reservation_extend", "reservation_release", "reservation_handoff",
+    "gateway_reset",
+]
+KEYS = [
+    "command", "location", "phone_name", "phone_location", "escooter", "escooter_id", "escooter_name",
+    "server_name", "busy", "destination", "distance", "price", "Price", "confirm", "escooters", "id",
+    "gateway", "reports", "msg_id", "node", "state", "granted", "ttl",
+]
+# version -> how many COMMANDS and KEYS it knows. A message to a client of an
+# older version gives commands and keys it does not know as strings.
+TABLE_SIZES = {
+    1: (15, 16),
+    2: (29, 23),
+    3: (len(COMMANDS), len(KEYS)),
+}
+COMMAND_CODES = {command: code for code, command in enumerate(COMMANDS, start=1)}
+KEY_CODES = {key: code for code, key in enumerate(KEYS, start=1)}
+# key given as a string instead of a code
+KEY_INLINE = 0xFF
+
+# keys whose value is a coordinate pair
+COORDINATE_KEYS = {"location", "destination", "phone_location"}
+# keys whose value is a list of rows, with a coordinate pair at these positions of every row
+COORDINATE_COLUMNS = {"reports": (1,)}
+
+_NONE, _TRUE, _FALSE, _INT, _FLOAT, _STR, _LIST, _DICT, _INT_PAIR, _FLOAT_PAIR = range(10)
+# decimals kept for coordinates sent as float32, about a metre in degrees
+PAIR_DECIMALS = 5
+
+_int_pair = struct.Struct('<hh')
+_float_pair = struct.Struct('<ff')
+_float = struct.Struct('<d')
+
+
+class CodecError(ValueError):
+    pass
+
+
+class JsonCodec:
+    name = JSON
+
+    def encode(self, msg):
+        return json.dumps(msg).encode("utf-8")
+
+    def decode(self, data):
+        return json.loads(data.decode("utf-8"))
+
+
+class BinaryCodec:
+    """The binary format, encoding in `version` and decoding every version up to ours."""
+
+    name = BINARY
+
+    def __init__(self, version=BINARY_VERSION):
+        if version not in TABLE_SIZES:
+            raise CodecError("Unsupported binary version {}".format(version))
+        self.version = version
+        commands, keys = TABLE_SIZES[version]
+        self._command_codes = {command: code for command, code in COMMAND_CODES.items() if code <= commands}
+        self._key_codes = {key: code for key, code in KEY_CODES.items() if code <= keys}
+
+    def encode(self, msg):
+        out = bytearray((BINARY_MAGIC, self.version))
+        command = msg.get("command")
+        code = self._command_codes.get(command, 0)
+        out.append(code)
+        fields = {key: value for key, value in msg.items() if not (key == "command" and code)}
+        _write_dict(out, fields, self._key_codes)
+        return bytes(out)
+
+    def decode(self, data):
+        if len(data) < 3 or data[0] != BINARY_MAGIC:
+            raise CodecError("Not a binary message")
+        if data[1] not in TABLE_SIZES:
+            raise CodecError("Unsupported binary version {}".format(data[1]))
+        msg = {}
+        if data[2]:
+            try:
+                msg["command"] = COMMANDS[data[2] - 1]
+            except IndexError:
+                raise CodecError("Unknown command code {}".format(data[2]))
+        fields, _ = _read_dict(data, 3)
+        msg.update(fields)
+        return msg
+
+
+CODECS = {JSON: JsonCodec(), BINARY: BinaryCodec()}
+# the binary format as every version knows it, to answer a client in its own
+BINARY_CODECS = {version: BinaryCodec(version) for version in TABLE_SIZES}
+BINARY_CODECS[BINARY_VERSION] = CODECS[BINARY]
+
+
+def get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise CodecError("Unknown codec {}".format(name))
+
+
+def decode(data):
+    """Decode a message in whatever format and version it was sent, returns (codec, msg)."""
+    if data[:1] == bytes((BINARY_MAGIC,)):
+        codec = BINARY_CODECS.get(data[1] if len(data) > 1 else None, CODECS[BINARY])
+    else:
+        codec = CODECS[JSON]
+    return codec, codec.decode(data)
+
+
+def _write_varint(out, n):
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+
+def _read_varint(data, i):
+    n = 0
+    shift = 0
+    while True:
+        byte = data[i]
+        i += 1
+        n |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return n, i
+        shift += 7
+
+
+def _write_str(out, s):
+    raw = s.encode("utf-8")
+    _write_varint(out, len(raw))
+    out += raw
+
+
+def _read_str(data, i):
+    n, i = _read_varint(data, i)
+    return bytes(data[i:i + n]).decode("utf-8"), i + n
+
+
+def _write_dict(out, d, key_codes):
+    _write_varint(out, len(d))
+    for key, value in d.items():
+        code = key_codes.get(key)
+        if code is None:
+            out.append(KEY_INLINE)
+            _write_str(out, str(key))
+        else:
+            out.append(code)
+        if key in COORDINATE_KEYS:
+            _write_coordinates(out, value, key_codes)
+        elif key in COORDINATE_COLUMNS and isinstance(value, (list, tuple)):
+            _write_rows(out, value, COORDINATE_COLUMNS[key], key_codes)
+        else:
+            _write_value(out, value, key_codes)
+
+
+def _write_coordinates(out, value, key_codes):
+    # packed into 4 or 8 bytes if it comes back exactly as it was, as it is otherwise
+    if isinstance(value, (list, tuple)) and len(value) == 2:
+        if all(isinstance(v, int) and not isinstance(v, bool) and -2 ** 15 <= v < 2 ** 15 for v in value):
+            out.append(_INT_PAIR)
+            out += _int_pair.pack(*value)
+            return
+        if all(isinstance(v, float) for v in value):
+            try:
+                packed = _float_pair.pack(*value)
+            except OverflowError:
+                packed = None
+            if packed is not None and \
+                    [round(v, PAIR_DECIMALS) for v in _float_pair.unpack(packed)] == list(value):
+                out.append(_FLOAT_PAIR)
+                out += packed
+                return
+    _write_value(out, value, key_codes)
+
+
+def _write_rows(out, rows, columns, key_codes):
+    out.append(_LIST)
+    _write_varint(out, len(rows))
+    for row in rows:
+        if not isinstance(row, (list, tuple)):
+            _write_value(out, row, key_codes)
+            continue
+        out.append(_LIST)
+        _write_varint(out, len(row))
+        for i, item in enumerate(row):
+            if i in columns:
+                _write_coordinates(out, item, key_codes)
+            else:
+                _write_value(out, item, key_codes)
+
+
+def _write_value(out, value, key_codes):
+    if value is None:
+        out.append(_NONE)
+    elif value is True:
+        out.append(_TRUE)
+    elif value is False:
+        out.append(_FALSE)
+    elif isinstance(value, int):
+        if not -2 ** 63 <= value < 2 ** 63:
+            raise CodecError("Integer {} does not fit in 64 bits".format(value))
+        out.append(_INT)
+        # zigzag so small negative numbers stay small
+        _write_varint(out, (value << 1) ^ (value >> 63))
+    elif isinstance(value, float):
+        out.append(_FLOAT)
+        out += _float.pack(value)
+    elif isinstance(value, str):
+        out.append(_STR)
+        _write_str(out, value)
+    elif isinstance(value, (list, tuple)):
+        out.append(_LIST)
+        _write_varint(out, len(value))
+        for item in value:
+            _write_value(out, item, key_codes)
+    elif isinstance(value, dict):
+        out.append(_DICT)
+        _write_dict(out, value, key_codes)
+    else:
+        raise CodecError("Cannot encode value of type {}".format(type(value).__name__))
+
+
+def _read_value(data, i):
+    tag = data[i]
+    i += 1
+    if tag == _NONE:
+        return None, i
+    if tag == _TRUE:
+        return True, i
+    if tag == _FALSE:
+        return False, i
+    if tag == _INT:
+        n, i = _read_varint(data, i)
+        return (n >> 1) ^ -(n & 1), i
+    if tag == _FLOAT:
+        return _float.unpack_from(data, i)[0], i + _float.size
+    if tag == _STR:
+        return _read_str(data, i)
+    if tag == _INT_PAIR:
+        return list(_int_pair.unpack_from(data, i)), i + _int_pair.size
+    if tag == _FLOAT_PAIR:
+        return [round(v, PAIR_DECIMALS) for v in _float_pair.unpack_from(data, i)], i + _float_pair.size
+    if tag == _LIST:
+        n, i = _read_varint(data, i)
+        items = []
+        for _ in range(n):
+            item, i = _read_value(data, i)
+            items.append(item)
+        return items, i
+    if tag == _DICT:
+        return _read_dict(data, i)
+    raise CodecError("Unknown value tag {}".format(tag))
+
+
+def _read_dict(data, i):
+    n, i = _read_varint(data, i)
+    d = {}
+    for _ in range(n):
+        code = data[i]
+        i += 1
+        if code == KEY_INLINE:
+            key, i = _read_str(data, i)
+        else:
+            try:
+                key = KEYS[code - 1]
+            except IndexError:
+                raise CodecError("Unknown key code {}".format(code))
+        d[key], i = _read_value(data, i)
+    return d, i
@@ -0,0 +1,90 @@
+import logging
+import queue
+import threading
+
+from hash_ring import stable_hash
+
+WORKER_POOL_SIZE = 4
+# jobs waiting per worker before new ones are dropped
+WORKER_QUEUE_SIZE = 1000
+
+
+class WorkerPool:
+    """
+    Worker threads, each with its own bounded queue.
+
+    Jobs are assigned to a worker by their key, so jobs with the same key run
+    one after the other in the order they were submitted, while jobs with
+    different keys can run in parallel on other workers. Submitting never
+    blocks: when a worker's queue is full the job is dropped and False returned.
+    """
+
+    def __init__(self, size=WORKER_POOL_SIZE, queue_size=WORKER_QUEUE_SIZE):
+        self._logger = logging.getLogger(__name__)
+        if size < 1:
+            raise ValueError("Worker pool needs at least one worker, got {}".format(size))
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(size)]
+        self._threads = []
+        for i, jobs in enumerate(self._queues):
+            thread = threading.Thread(target=self._work, args=(jobs,), name='worker-{}'.format(i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def __len__(self):
+        return len(self._queues)
+
+    def submit(self, key, func, *args):
+        jobs = self._queues[stable_hash(key) % len(self._queues)]
+        try:
+            jobs.put_nowait((func, args))
+        except queue.Full:
+            self._logger.error('Worker queue full, dropping job for {}'.format(key))
+            return False
+        return True
+
+    def queue_depths(self):
+        return [jobs.qsize() for jobs in self._queues]
+
+    def _work(self, jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            func, args = job
+            try:
+                func(*args)
+            except Exception as err:
+                self._logger.error('Invalid arguments to command. {}'.format(err))
+
+    def stop(self):
+        for jobs in self._queues:
+            jobs.put(None)
+
+
+class CommandDispatcher:
+    """
+    Maps the `command` field of a message to its handler.
+
+    Each handler is registered with the name of the payload field that holds its
+    session key; the handler then runs on the worker that owns that key.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._handlers = {}
+
+    def register(self, command, handler, key_field):
+        self._handlers[command] = (handler, key_field)
+
+    def __contains__(self, command):
+        return command in self._handlers
+
+    def handler(self, command):
+        return self._handlers[command][0]
+
+    def key_field(self, command):
+        return self._handlers[command][1]
+
+    def dispatch(self, command, payload):
+        handler, key_field = self._handlers[command]
+        return self.pool.submit(payload.get(key_field), handler, payload)
@@ -0,0 +1,84 @@
+import logging
+
+from stmpy import Driver
+
+from hash_ring import HashRing
+
+DRIVER_POOL_SIZE = 4
+
+
+class PoolDriver(Driver):
+    """
+    A stmpy Driver with a table of machines of its own.
+
+    stmpy keeps its table of machines by name on the Driver class and clears it
+    whenever a new Driver is created, so a Driver created anywhere else in the
+    process, say by a co-located escooter gateway, would make every machine
+    added before unreachable by name. Like LoopDriver of async_engine.py, this
+    one keeps its own and leaves stmpy's as it was.
+    """
+
+    def __init__(self):
+        stms_by_id = Driver._stms_by_id
+        super().__init__()
+        Driver._stms_by_id = stms_by_id
+        self._stms_by_id = {}
+
+    def add_machine(self, machine):
+        machine._driver = self
+        machine._reset()
+        if machine.id is not None:
+            self._stms_by_id[machine.id] = machine
+            self._add_event(event_id=None, args=[], kwargs={}, stm=machine)
+
+    def send(self, message_id, stm_id, args=[], kwargs={}):
+        stm = self._stms_by_id.get(stm_id)
+        if stm is None:
+            self._logger.warning('Machine with name {} cannot be found. Ignoring message {}.'.format(
+                stm_id, message_id))
+            return
+        self._add_event(message_id, args, kwargs, stm)
+
+    def _terminate_stm(self, stm_id):
+        self._stms_by_id.pop(stm_id, None)
+        if not self._keep_active and not self._stms_by_id:
+            self._active = False
+            self._wake_queue()
+
+
+class DriverPool:
+    """
+    Fixed set of stmpy drivers shared by all sessions.
+
+    A session is pinned to one driver by consistent hash of its name, and a
+    driver runs its machines one transition at a time, so the events of one
+    session are still handled in the order they were sent.
+    """
+
+    def __init__(self, size=DRIVER_POOL_SIZE):
+        self._logger = logging.getLogger(__name__)
+        if size < 1:
+            raise ValueError("Driver pool needs at least one driver, got {}".format(size))
+        self.drivers = [PoolDriver() for _ in range(size)]
+        self._ring = HashRing(range(size))
+        for driver in self.drivers:
+            driver.start(keep_active=True)
+        self._logger.info('Started pool of {} drivers'.format(size))
+
+    def __len__(self):
+        return len(self.drivers)
+
+    def driver_for(self, key):
+        return self.drivers[self._ring.get(key)]
+
+    def add_machine(self, key, machine):
+        driver = self.driver_for(key)
+        driver.add_machine(machine)
+        return driver
+
+    def queue_depths(self):
+        return [driver._event_queue.qsize() for driver in self.drivers]
+
+    def stop(self):
+        for driver in self.drivers:
+            driver.stop()
@@ -0,0 +1,154 @@
+import threading
+import time
+from collections import OrderedDict
+
+from spatial_index import GridIndex
+
+# a scooter that has not reported for this long is not offered to phones; parked
+# scooters report every telemetry.PARKED_REPORT_INTERVAL, so this allows for a lost report
+STALE_AFTER = 150.0
+# and after this long it is dropped from the registry altogether
+EVICT_AFTER = 600.0
+# minimum time between two eviction sweeps
+EVICT_INTERVAL = 5.0
+
+
+class FleetRegistry:
+    """
+    Server-side view of the whole fleet.
+
+    Scooters keep it fresh by reporting their location and busy state, so that
+    the server can answer a phone from memory instead of asking every scooter.
+    Reports are kept in arrival order, which makes both the freshness check and
+    the eviction of silent scooters proportional to the work they actually do.
+    """
+
+    def __init__(self, stale_after=STALE_AFTER, evict_after=EVICT_AFTER, evict_interval=EVICT_INTERVAL):
+        self.stale_after = stale_after
+        self.evict_after = evict_after
+        self.evict_interval = evict_interval
+        self.index = GridIndex()
+        self._lock = threading.Lock()
+        # escooter_id -> time of last report, oldest first
+        self._last_seen = OrderedDict()
+        # escooter_id -> velocity of its last report, only for moving scooters
+        self._velocities = {}
+        self._last_sweep = 0.0
+
+    def __len__(self):
+        return len(self._last_seen)
+
+    def __contains__(self, escooter_id):
+        return escooter_id in self._last_seen
+
+    def report(self, escooter_id, location, busy=False, now=None, velocity=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._last_seen[escooter_id] = now
+            self._last_seen.move_to_end(escooter_id)
+            self.index.update(escooter_id, location, bool(busy))
+            if velocity and any(velocity):
+                self._velocities[escooter_id] = tuple(velocity)
+            else:
+                self._velocities.pop(escooter_id, None)
+        self.maybe_evict(now)
+
+    def set_busy(self, escooter_id, busy):
+        entry = self.index.get(escooter_id)
+        if entry is not None:
+            self.index.update(escooter_id, entry[0], bool(busy))
+
+    def get(self, escooter_id):
+        return self.index.get(escooter_id)
+
+    def position(self, escooter_id, now=None):
+        """Where the escooter should be now, extrapolated from its last report."""
+        now = time.monotonic() if now is None else now
+        entry = self.index.get(escooter_id)
+        if entry is None:
+            return None
+        location = entry[0]
+        velocity = self._velocities.get(escooter_id)
+        last_seen = self._last_seen.get(escooter_id)
+        if velocity is None or last_seen is None:
+            return location
+        # moving scooters only report when they leave the predicted track
+        elapsed = min(now - last_seen, self.stale_after)
+        return (round(location[0] + velocity[0] * elapsed, 2), round(location[1] + velocity[1] * elapsed, 2))
+
+    def last_seen(self, escooter_id):
+        # time of the escooter's latest report, None if it never reported
+        return self._last_seen.get(escooter_id)
+
+    def is_moving(self, escooter_id):
+        # only moving scooters have a velocity, see report
+        return escooter_id in self._velocities
+
+    def is_fresh(self, escooter_id, now=None):
+        now = time.monotonic() if now is None else now
+        last_seen = self._last_seen.get(escooter_id)
+        return last_seen is not None and now - last_seen <= self.stale_after
+
+    def has_fresh(self, now=None):
+        # the most recent report is the last one in the ordered dict
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if not self._last_seen:
+                return False
+            newest = next(reversed(self._last_seen.values()))
+        return now - newest <= self.stale_after
+
+    def nearest(self, location, k=10, radius=None, exclude=None, now=None):
+        now = time.monotonic() if now is None else now
+
+        def skip(escooter_id):
+            if not self.is_fresh(escooter_id, now):
+                return True
+            return exclude is not None and exclude(escooter_id)
+
+        return self.index.nearest(location, k=k, radius=radius, exclude=skip)
+
+    def snapshot(self, now=None):
+        """[escooter_id, location, busy, velocity, age of the report] for every scooter, oldest report first."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            seen = list(self._last_seen.items())
+            velocities = dict(self._velocities)
+        entries = self.index.entries()
+        return [[escooter_id, entries[escooter_id][0], entries[escooter_id][1], velocities.get(escooter_id),
+                 now - last_seen] for escooter_id, last_seen in seen if escooter_id in entries]
+
+    def restore(self, reports, now=None):
+        # reports of `snapshot`, oldest first, their ages already counting the time since it was taken
+        now = time.monotonic() if now is None else now
+        reports = [report for report in reports if report[4] <= self.evict_after]
+        with self._lock:
+            for escooter_id, _, _, velocity, age in reports:
+                self._last_seen[escooter_id] = now - age
+                self._last_seen.move_to_end(escooter_id)
+                if velocity and any(velocity):
+                    self._velocities[escooter_id] = tuple(velocity)
+                else:
+                    self._velocities.pop(escooter_id, None)
+            self.index.update_many((report[0], report[1], bool(report[2])) for report in reports)
+
+    def maybe_evict(self, now=None):
+        now = time.monotonic() if now is None else now
+        if now - self._last_sweep < self.evict_interval:
+            return []
+        return self.evict_stale(now)
+
+    def evict_stale(self, now=None):
+        now = time.monotonic() if now is None else now
+        evicted = []
+        with self._lock:
+            self._last_sweep = now
+            while self._last_seen:
+                escooter_id, last_seen = next(iter(self._last_seen.items()))
+                if now - last_seen <= self.evict_after:
+                    break
+                self._last_seen.popitem(last=False)
+                self._velocities.pop(escooter_id, None)
+                self.index.remove(escooter_id)
+                evicted.append(escooter_id)
+        return evicted
@@ -0,0 +1,157 @@
+import logging
+import threading
+
+import numpy as np
+
+# the city is a square of CITY_SIZE x CITY_SIZE metres, same units as the server's distances
+CITY_SIZE = 100
+# metres per second of an escooter on a trip
+TRIP_SPEED = 5.0
+# seconds between two simulation ticks
+TICK_INTERVAL = 1.0
+# decimals of the locations handed out, keeps messages small and reproducible
+LOCATION_DECIMALS = 2
+
+
+class FleetSimulator:
+    """
+    Positions, velocities and busy flags of a whole fleet, as NumPy arrays.
+
+    Escooter i is called `escooter_{i + 1}`, like everywhere else; a simulator
+    of one shard of a larger fleet is given the `names` of its escooters. Free escooters
+    stand still; an escooter on a trip drives towards its destination at
+    TRIP_SPEED, or wanders around the city when it has none, bouncing off the
+    city limits. Every tick advances all escooters at once, so the cost of a tick
+    hardly depends on the size of the fleet.
+
+    With a seed, the same sequence of ticks and trips gives the same locations.
+    """
+
+    def __init__(self, size, city_size=CITY_SIZE, speed=TRIP_SPEED, seed=None, names=None):
+        self._logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._rng = np.random.default_rng(seed)
+        if names is not None and len(names) != size:
+            raise ValueError("Fleet of {} escooters got {} names".format(size, len(names)))
+        self.size = size
+        self.names = names
+        self._indices = None if names is None else {name: index for index, name in enumerate(names)}
+        self.city_size = city_size
+        self.speed = speed
+        self.positions = self._rng.uniform(0, city_size, (size, 2))
+        self.velocities = np.zeros((size, 2))
+        self.busy = np.zeros(size, dtype=bool)
+        self.destinations = np.full((size, 2), np.nan)
+        self.ticks = 0
+        self._ticker = None
+        self._stop_ticking = threading.Event()
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, name):
+        try:
+            self.index_of(name)
+        except (AttributeError, ValueError, IndexError, KeyError):
+            return False
+        return True
+
+    def name_of(self, index):
+        if self.names is not None:
+            return self.names[index]
+        return f"escooter_{index + 1}"
+
+    def index_of(self, name):
+        if self._indices is not None:
+            return self._indices[name]
+        index = int(name.rsplit('_', 1)[1]) - 1
+        if not 0 <= index < self.size:
+            raise KeyError(name)
+        return index
+
+    def location(self, name):
+        with self._lock:
+            x, y = self.positions[self.index_of(name)]
+        return round(float(x), LOCATION_DECIMALS), round(float(y), LOCATION_DECIMALS)
+
+    def is_busy(self, name):
+        return bool(self.busy[self.index_of(name)])
+
+    def start_trip(self, name, destination=None):
+        i = self.index_of(name)
+        with self._lock:
+            self.busy[i] = True
+            if destination is not None and _in_city(destination, self.city_size):
+                self.destinations[i] = destination
+                self.velocities[i] = 0
+            else:
+                # nowhere we can drive to, wander in a random direction
+                self.destinations[i] = np.nan
+                angle = self._rng.uniform(0, 2 * np.pi)
+                self.velocities[i] = self.speed * np.cos(angle), self.speed * np.sin(angle)
+
+    def end_trip(self, name):
+        i = self.index_of(name)
+        with self._lock:
+            self.busy[i] = False
+            self.velocities[i] = 0
+            self.destinations[i] = np.nan
+
+    def tick(self, dt=TICK_INTERVAL):
+        with self._lock:
+            # escooters with a destination head straight for it and stop there
+            heading = ~np.isnan(self.destinations[:, 0]) & self.busy
+            if heading.any():
+                offset = self.destinations[heading] - self.positions[heading]
+                remaining = np.hypot(offset[:, 0], offset[:, 1])
+                step = np.minimum(remaining, self.speed * dt)
+                scale = np.divide(step, remaining, out=np.zeros_like(step), where=remaining > 0)
+                self.positions[heading] += offset * scale[:, None]
+                # what was actually driven this tick, zero once there
+                self.velocities[heading] = offset * (scale / dt)[:, None]
+            # the others move with their velocity and bounce off the city limits
+            wandering = ~heading & self.busy
+            if wandering.any():
+                positions = self.positions[wandering] + self.velocities[wandering] * dt
+                velocities = self.velocities[wandering]
+                low = positions < 0
+                high = positions > self.city_size
+                positions[low] = -positions[low]
+                positions[high] = 2 * self.city_size - positions[high]
+                velocities[low | high] *= -1
+                self.positions[wandering] = np.clip(positions, 0, self.city_size)
+                self.velocities[wandering] = velocities
+            self.ticks += 1
+
+    def state(self):
+        """Copies of the position, velocity and busy arrays, taken between two ticks."""
+        with self._lock:
+            return self.positions.copy(), self.velocities.copy(), self.busy.copy()
+
+    def snapshot(self):
+        """Locations and busy flags of the whole fleet as plain lists, taken between two ticks."""
+        with self._lock:
+            positions = np.round(self.positions, LOCATION_DECIMALS).tolist()
+            busy = self.busy.tolist()
+        return positions, busy
+
+    def start(self, interval=TICK_INTERVAL):
+        self._stop_ticking.clear()
+        self._ticker = threading.Thread(target=self._tick_periodically, args=(interval,), daemon=True)
+        self._ticker.start()
+        self._logger.info('Simulating {} escooters, one tick every {}s'.format(self.size, interval))
+
+    def stop(self):
+        self._stop_ticking.set()
+
+    def _tick_periodically(self, interval):
+        while not self._stop_ticking.wait(interval):
+            self.tick(interval)
+
+
+def _in_city(location, city_size):
+    try:
+        x, y = location
+    except (TypeError, ValueError):
+        return False
+    return 0 <= x <= city_size and 0 <= y <= city_size
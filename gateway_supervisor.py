@@ -0,0 +1,176 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+from metrics import serve_metrics
+from scooter import ScooterManagerComponent, GATEWAY_NAME, MQTT_BROKER, MQTT_PORT, MQTT_CODEC
+from topics import ESCOOTER_TOPIC_BUCKETS, escooter_bucket
+from transport import MqttTransport
+
+# seconds between two heartbeats of a worker, and between two checks of the supervisor
+WORKER_HEARTBEAT_INTERVAL = 1.0
+# a worker that has not beaten its heart for this long is taken for hung and restarted
+WORKER_TIMEOUT = 10.0
+# seconds a new worker has to start up (spawn, imports, connect) before its first heartbeat
+WORKER_START_GRACE = 30.0
+# a worker that crashes again is restarted after a delay doubling from the first
+# to the second value; one that ran for STABLE_AFTER seconds starts over
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 60.0
+STABLE_AFTER = 60.0
+# seconds stop() gives the workers to shut down before they are killed
+STOP_TIMEOUT = 5.0
+
+
+def shard_buckets(workers, shard):
+    """The escooter topic buckets of `shard`, see topics.py."""
+    return [bucket for bucket in range(ESCOOTER_TOPIC_BUCKETS) if bucket % workers == shard]
+
+
+def shard_names(num_scooters, workers, shard):
+    """Names of the escooters of `shard`, those in its topic buckets."""
+    return [name for name in (f"escooter_{i + 1}" for i in range(num_scooters))
+            if escooter_bucket(name) % workers == shard]
+
+
+def run_worker(shard, workers, num_scooters, seed, broker, port, name, metrics_port, heartbeats, stopping,
+               restarted):
+    # a worker process: one gateway for its shard, with its own broker connection, driver and GIL
+    names = shard_names(num_scooters, workers, shard)
+    component = ScooterManagerComponent(len(names), transport=MqttTransport(broker, port, MQTT_CODEC), seed=seed,
+                                        name='{}_{}'.format(name, shard), names=names,
+                                        buckets=shard_buckets(workers, shard))
+    if restarted:
+        component.announce_reset()
+    if metrics_port is not None:
+        serve_metrics(component.metrics, metrics_port + shard)
+    while not stopping.value:
+        # no heartbeat once the gateway stopped working, the supervisor restarts us
+        if component.healthy():
+            heartbeats[shard] = time.time()
+        time.sleep(WORKER_HEARTBEAT_INTERVAL)
+    component.stop()
+
+
+class GatewaySupervisor:
+    """
+    The escooter gateway spread over several processes, to use every core.
+
+    The fleet is split into shards by the topic buckets the server addresses
+    the escooters in (see topics.py), one shard per worker process. Each
+    worker runs a ScooterManagerComponent for its shard, with its own broker
+    connection, stmpy driver and simulator, subscribes to its own buckets only
+    and reports its telemetry as gateway `<name>_<shard>`.
+
+    Workers beat their heart through shared memory while their gateway is
+    healthy. A worker that exited or stopped beating is killed and started
+    again, after a delay that grows while it keeps crashing. A restarted worker
+    starts its shard afresh and tells the server so, which ends the trips in
+    progress on it and releases their reservations.
+    """
+
+    def __init__(self, num_scooters, workers=None, seed=None, broker=MQTT_BROKER, port=MQTT_PORT, name=GATEWAY_NAME,
+                 metrics_port=None, timeout=WORKER_TIMEOUT):
+        self._logger = logging.getLogger(__name__)
+        workers = workers or min(os.cpu_count() or 1, ESCOOTER_TOPIC_BUCKETS)
+        if not 1 <= workers <= ESCOOTER_TOPIC_BUCKETS:
+            raise ValueError("Gateway needs between 1 and {} workers, got {}".format(ESCOOTER_TOPIC_BUCKETS, workers))
+        # how many escooters each shard has
+        self.shards = [len(shard_names(num_scooters, workers, shard)) for shard in range(workers)]
+        if not all(self.shards):
+            raise ValueError("{} escooters leave some of {} gateway workers without any, use fewer".format(
+                num_scooters, workers))
+        self.num_scooters = num_scooters
+        self.seed = seed
+        self.broker = broker
+        self.port = port
+        self.name = name
+        self.metrics_port = metrics_port
+        self.timeout = timeout
+        # a fresh interpreter per worker, forking a process with threads is asking for trouble
+        self._context = multiprocessing.get_context('spawn')
+        # plain shared memory without locks, a worker killed halfway cannot leave one held
+        self._heartbeats = self._context.Array('d', workers, lock=False)
+        self._stopping = self._context.Value('b', 0, lock=False)
+        self.processes = [None] * workers
+        self.restarts = [0] * workers
+        self._started_at = [0.0] * workers
+        self._delays = [RESTART_DELAY] * workers
+        self._restart_at = [None] * workers
+        self._lock = threading.Lock()
+        for shard in range(workers):
+            self._start(shard)
+        self._logger.info('Started {} gateway workers for {} escooters'.format(workers, num_scooters))
+        self._stop_watching = threading.Event()
+        self._watcher = threading.Thread(target=self._watch, daemon=True)
+        self._watcher.start()
+
+    def _start(self, shard):
+        seed = None if self.seed is None else self.seed + shard
+        self._heartbeats[shard] = time.time() + WORKER_START_GRACE
+        process = self._context.Process(target=run_worker, name='{}_{}'.format(self.name, shard), daemon=True,
+                                        args=(shard, len(self.shards), self.num_scooters, seed, self.broker,
+                                              self.port, self.name, self.metrics_port, self._heartbeats,
+                                              self._stopping, self.restarts[shard] > 0))
+        process.start()
+        self.processes[shard] = process
+        self._started_at[shard] = time.monotonic()
+        self._restart_at[shard] = None
+
+    def _watch(self):
+        while not self._stop_watching.wait(WORKER_HEARTBEAT_INTERVAL):
+            with self._lock:
+                if self._stop_watching.is_set():
+                    return
+                for shard in range(len(self.shards)):
+                    self.check(shard)
+
+    def check(self, shard, now=None):
+        """Restart the worker of `shard` if it died or hangs, once its restart delay is over."""
+        now = time.monotonic() if now is None else now
+        process = self.processes[shard]
+        if process is None:
+            if now >= self._restart_at[shard]:
+                self.restarts[shard] += 1
+                self._logger.warning('Restarting gateway worker {}'.format(shard))
+                self._start(shard)
+            return
+        silent = time.time() - self._heartbeats[shard]
+        if process.exitcode is None and silent <= self.timeout:
+            return
+        if process.exitcode is None:
+            self._logger.error('Gateway worker {} sent no heartbeat for {:.1f}s, killing it'.format(shard, silent))
+            process.kill()
+            process.join(STOP_TIMEOUT)
+        else:
+            self._logger.error('Gateway worker {} exited with code {}'.format(shard, process.exitcode))
+        # back off while it keeps crashing, start over once it ran for a while
+        if now - self._started_at[shard] >= STABLE_AFTER:
+            self._delays[shard] = RESTART_DELAY
+        delay = self._delays[shard]
+        self._delays[shard] = min(delay * 2, MAX_RESTART_DELAY)
+        self.processes[shard] = None
+        self._restart_at[shard] = now + delay
+
+    def stats(self):
+        now = time.time()
+        return [{"shard": shard, "escooters": count,
+                 "pid": None if process is None else process.pid,
+                 "alive": process is not None and process.is_alive(),
+                 "restarts": self.restarts[shard],
+                 "heartbeat_age_s": max(0.0, now - self._heartbeats[shard])}
+                for shard, (count, process) in enumerate(zip(self.shards, self.processes))]
+
+    def stop(self):
+        with self._lock:
+            self._stop_watching.set()
+            self._stopping.value = 1
+            deadline = time.monotonic() + STOP_TIMEOUT
+            for process in self.processes:
+                if process is not None:
+                    process.join(max(0.0, deadline - time.monotonic()))
+                    if process.exitcode is None:
+                        process.kill()
+                        process.join()
@@ -0,0 +1,70 @@
+import math
+
+# how far from its route an escooter may be before it counts as out of route,
+# in the same units as the locations
+CORRIDOR_WIDTH = 10.0
+# side of the raster cells; a cell is inside the corridor when its centre is,
+# so the corridor's edge is only exact to about one cell
+CORRIDOR_CELL_SIZE = 1.0
+# upper bound on the raster, long routes get coarser cells instead of more of them
+MAX_CORRIDOR_CELLS = 250000
+
+
+def segment_distance(point, a, b):
+    # euclidean distance from point to the segment a-b
+    ax, ay = a
+    bx, by = b
+    px, py = point
+    dx, dy = bx - ax, by - ay
+    length2 = dx * dx + dy * dy
+    if length2 == 0:
+        return math.hypot(px - ax, py - ay)
+    t = max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length2))
+    return math.hypot(px - (ax + t * dx), py - (ay + t * dy))
+
+
+class RouteCorridor:
+    """
+    Everything within `width` of a route, rasterized once.
+
+    The route is a list of waypoints. All the geometry is done when the corridor
+    is built; afterwards `contains` is a bounds check and one lookup in a
+    bitmap, cheap enough to run on every position sample.
+    """
+
+    def __init__(self, waypoints, width=CORRIDOR_WIDTH, cell_size=CORRIDOR_CELL_SIZE):
+        points = [(float(x), float(y)) for x, y in waypoints]
+        if not points:
+            raise ValueError("A route needs at least one waypoint")
+        self.width = width
+        self.x0 = min(x for x, _ in points) - width
+        self.y0 = min(y for _, y in points) - width
+        x1 = max(x for x, _ in points) + width
+        y1 = max(y for _, y in points) + width
+        area = (x1 - self.x0) * (y1 - self.y0)
+        self.cell_size = max(cell_size, math.sqrt(area / MAX_CORRIDOR_CELLS))
+        self.nx = int((x1 - self.x0) // self.cell_size) + 1
+        self.ny = int((y1 - self.y0) // self.cell_size) + 1
+        self._cells = bytearray(self.nx * self.ny)
+
+        segments = list(zip(points, points[1:])) or [(points[0], points[0])]
+        for a, b in segments:
+            # only the cells around this segment can be within reach of it
+            cx0, cy0 = self._cell((min(a[0], b[0]) - width, min(a[1], b[1]) - width))
+            cx1, cy1 = self._cell((max(a[0], b[0]) + width, max(a[1], b[1]) + width))
+            for cx in range(max(cx0, 0), min(cx1, self.nx - 1) + 1):
+                x = self.x0 + (cx + 0.5) * self.cell_size
+                row = cx * self.ny
+                for cy in range(max(cy0, 0), min(cy1, self.ny - 1) + 1):
+                    if not self._cells[row + cy] and \
+                            segment_distance((x, self.y0 + (cy + 0.5) * self.cell_size), a, b) <= width:
+                        self._cells[row + cy] = 1
+
+    def _cell(self, location):
+        return (int((location[0] - self.x0) // self.cell_size), int((location[1] - self.y0) // self.cell_size))
+
+    def contains(self, location):
+        cx, cy = self._cell(location)
+        if not (0 <= cx < self.nx and 0 <= cy < self.ny):
+            return False
+        return bool(self._cells[cx * self.ny + cy])
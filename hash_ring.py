@@ -0,0 +1,55 @@
+import bisect
+import hashlib
+
+# virtual points per member, more points give a more even split
+HASH_RING_REPLICAS = 64
+
+
+def stable_hash(key):
+    # python's hash() is salted per process, this one is the same everywhere
+    return int.from_bytes(hashlib.md5(str(key).encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring.
+
+    Keys are mapped to the first member point clockwise from the key's hash, so
+    adding or removing a member only moves the keys next to its points.
+    """
+
+    def __init__(self, members=(), replicas=HASH_RING_REPLICAS):
+        self.replicas = replicas
+        self._points = []
+        self._owners = {}
+        self.members = []
+        for member in members:
+            self.add(member)
+
+    def __len__(self):
+        return len(self.members)
+
+    def add(self, member):
+        if member in self.members:
+            return
+        self.members.append(member)
+        for i in range(self.replicas):
+            point = stable_hash(f"{member}#{i}")
+            self._owners[point] = member
+            bisect.insort(self._points, point)
+
+    def remove(self, member):
+        if member not in self.members:
+            return
+        self.members.remove(member)
+        for i in range(self.replicas):
+            point = stable_hash(f"{member}#{i}")
+            if self._owners.pop(point, None) is not None:
+                index = bisect.bisect_left(self._points, point)
+                del self._points[index]
+
+    def get(self, key):
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, stable_hash(key)) % len(self._points)
+        return self._owners[self._points[index]]
@@ -0,0 +1,103 @@
+"""
+Memory benchmark for the server and the escooter gateway.
+
+Measures, with tracemalloc, what the following cost in this process:
+
+    * one escooter in the escooter gateway (ScooterManagerComponent)
+    * one escooter in the server's fleet registry
+    * one open session on the server, parked in SearchForNearbyEscooters
+
+    python memory_benchmark.py --scooters 20000 --sessions 2000 --output memory.json
+"""
+import argparse
+import gc
+import json
+import logging
+import random
+import time
+import tracemalloc
+
+import server
+import scooter
+from topics import escooter_input_topic, phone_input_topic
+from transport import LoopbackBus, LoopbackTransport
+
+CITY_SIZE = 100
+
+
+def _allocated():
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def _wait_for(condition, timeout=60):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise RuntimeError("Timed out")
+        time.sleep(0.01)
+
+
+def measure_gateway(scooters):
+    before = _allocated()
+    gateway = scooter.ScooterManagerComponent(scooters, transport=LoopbackTransport(LoopbackBus()))
+    used = _allocated() - before
+    gateway.stop()
+    return used / scooters
+
+
+def measure_fleet_registry(scooters):
+    component = server.ServerManagerComponent(transport=LoopbackTransport(LoopbackBus()))
+    before = _allocated()
+    for i in range(scooters):
+        component.fleet.report(f"escooter_{i + 1}", (random.uniform(0, CITY_SIZE), random.uniform(0, CITY_SIZE)))
+    used = _allocated() - before
+    component.stop()
+    return used / scooters
+
+
+def measure_sessions(sessions, scooters=100):
+    bus = LoopbackBus()
+    component = server.ServerManagerComponent(transport=LoopbackTransport(bus))
+    reporter = LoopbackTransport(bus)
+    reporter.start()
+    for i in range(scooters):
+        name = f"escooter_{i + 1}"
+        reporter.publish(escooter_input_topic(name), {"command": "escooter_report", "escooter_id": name,
+                                                      "location": (random.randint(0, CITY_SIZE),
+                                                                   random.randint(0, CITY_SIZE)), "busy": False})
+    _wait_for(lambda: len(component.fleet) == scooters)
+
+    before = _allocated()
+    for i in range(sessions):
+        name = f"memory_phone_{i}"
+        reporter.publish(phone_input_topic(name), {"command": "phone_location", "phone_name": name,
+                                                   "location": (random.randint(0, CITY_SIZE),
+                                                                random.randint(0, CITY_SIZE))})
+    _wait_for(lambda: all(stm.state == "SearchForNearbyEscooters" for stm in list(component.server_stm.values()))
+              and len(component.server_stm) == sessions)
+    used = _allocated() - before
+    component.stop()
+    return used / sessions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scooters', type=int, default=20000, help='escooters in the gateway and the registry')
+    parser.add_argument('--sessions', type=int, default=2000, help='open sessions on the server')
+    parser.add_argument('--output', default=None, help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    random.seed(1)
+    tracemalloc.start()
+    results = {
+        "registry_bytes_per_escooter": round(measure_fleet_registry(args.scooters)),
+        "server_bytes_per_session": round(measure_sessions(args.sessions)),
+        "gateway_bytes_per_escooter": round(measure_gateway(args.scooters)),
+    }
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
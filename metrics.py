@@ -0,0 +1,160 @@
+import bisect
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from shared_machine import SharedTableMachine
+
+# upper bounds of the histogram buckets in seconds, 0.1 ms doubling up to ~14 min
+HISTOGRAM_BUCKETS = [0.0001 * 2 ** i for i in range(24)]
+METRICS_PORT = 9102
+
+
+class Histogram:
+    """Fixed-bucket histogram, cheap enough to update on every event."""
+
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-th value
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def snapshot(self):
+        return {"count": self.count, "sum": self.sum,
+                "p50": self.quantile(0.5), "p95": self.quantile(0.95), "p99": self.quantile(0.99)}
+
+
+class Metrics:
+    """
+    Counters, histograms and gauges of one component.
+
+    Counters and histograms are keyed by a name and a label tuple and created on
+    first use. Gauges are callables evaluated only when a snapshot is taken, so
+    things like queue depths cost nothing between snapshots.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self.started = time.monotonic()
+
+    def inc(self, name, *labels, n=1):
+        key = (name,) + labels
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+
+    def observe(self, name, value, *labels):
+        key = (name,) + labels
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def gauge(self, name, func):
+        self._gauges[name] = func
+
+    def snapshot(self):
+        with self._lock:
+            counters = {'/'.join(map(str, key)): n for key, n in self._counters.items()}
+            histograms = {'/'.join(map(str, key)): h.snapshot() for key, h in self._histograms.items()}
+        gauges = {}
+        for name, func in self._gauges.items():
+            try:
+                gauges[name] = func()
+            except Exception as err:
+                gauges[name] = repr(err)
+        return {"uptime_s": time.monotonic() - self.started, "counters": counters, "histograms": histograms,
+                "gauges": gauges}
+
+
+class InstrumentedMachine(SharedTableMachine):
+    """
+    stmpy Machine that records how long it stays in each state and which
+    transitions it takes, labelled with the kind of machine (server, scooter, phone).
+
+    `on_transition(machine, source, target)`, if given, is called after every
+    transition the machine takes.
+    """
+
+    def __init__(self, name, transitions, obj, states=[], metrics=None, kind='machine', table_key=None,
+                 on_transition=None):
+        super().__init__(name=name, transitions=transitions, obj=obj, states=states, table_key=table_key)
+        self._metrics = metrics
+        self._kind = kind
+        self._on_transition = on_transition
+        self._entered_at = time.monotonic()
+        self._terminated = False
+
+    def _execute_transition(self, event_id, args, kwargs):
+        if self._metrics is None and self._on_transition is None:
+            return super()._execute_transition(event_id, args, kwargs)
+        source = self._state
+        declared = source == 'initial' or '{}_{}'.format(source, event_id) in self._table
+        super()._execute_transition(event_id, args, kwargs)
+        if not declared:
+            if self._metrics is not None:
+                self._metrics.inc('ignored_events', self._kind, source, event_id)
+            return
+        target = 'final' if self._terminated else self._state
+        if self._on_transition is not None:
+            self._on_transition(self, source, target)
+        if self._metrics is None:
+            return
+        self._metrics.inc('transitions', self._kind, source, event_id or '', target)
+        if target != source:
+            now = time.monotonic()
+            if source != 'initial':
+                self._metrics.observe('dwell_s', now - self._entered_at, self._kind, source)
+            self._entered_at = now
+
+    def terminate(self):
+        self._terminated = True
+        # stmpy finds machines by name in one table for the whole process (a
+        # LoopDriver has its own); a machine of the same name may already have
+        # taken our place there, e.g. a session handed over to another server
+        # in this process
+        if self._driver._stms_by_id.get(self.id) is self:
+            super().terminate()
+
+
+def serve_metrics(metrics, port=METRICS_PORT, host=''):
+    """Serve JSON snapshots of `metrics` on http://host:port/ from a background thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(metrics.snapshot()).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    logging.getLogger(__name__).info('Serving metrics on port {}'.format(port))
+    return httpd
@@ -1,15 +1,19 @@
-import paho.mqtt.client as mqtt
 import stmpy
 import logging
-import json
 from appJar import gui
 import time
 
+from codec import BINARY
+from metrics import InstrumentedMachine, Metrics
+from phone_view import PhoneView
+from qos import MessageIds
+from topics import phone_input_topic, phone_topic
+from transport import MqttTransport
+
 MQTT_BROKER = 'mqtt20.iik.ntnu.no'
 MQTT_PORT = 1883
-
-MQTT_TOPIC_INPUT = 'team02Input'
-MQTT_TOPIC_OUTPUT = 'team02Output'
+# wire format used for everything we send, see codec.py
+MQTT_CODEC = BINARY
 
 
 def get_location():
@@ -28,19 +32,11 @@ class PhoneLogic:
         self.start_time = time.time()
         self.price = 0
         self.selected_escooter = ""
-
-    def clear_gui(self):
-        self.app.removeAllWidgets()
-        self.app.startLabelFrame("Escooter APP")
-        self.app.stopLabelFrame()
+        # all screens are built here, once; after that we only switch between them
+        self.view = PhoneView(self.app, self)
 
     def start_trip(self):
-        def gui_start():
-            self.clear_gui()
-            self.app.addLabel("label_intro", "Welcome! Send your location to find scooters.")
-            self.app.addButton("Send Location", self.send_location)
-
-        self.app.queueFunction(gui_start)
+        self.view.show("start")
 
     def send_location(self):
         # Simulate user location and notify server
@@ -49,28 +45,15 @@ class PhoneLogic:
         self.stm.send("phone_location_exchanged")
 
     def escooters_gui_select_escooter(self, escooters, distance):
-        def gui_escooters():
-            self.clear_gui()
-            self.app.addLabel("label_escooters", "Select an available scooter:")
-            for i in range(len(escooters)):
-                self.app.addButton(f"Select {escooters[i]['id']} (Distance {distance[i]}m)",
-                                   lambda btn, s=escooters[i]['id']: self.select_escooter(s))
-
-        self.app.queueFunction(gui_escooters)
-        self.app.queueFunction(gui_escooters)
+        self.view.set_escooters(escooters, distance)
+        self.view.show("escooters")
 
     def select_escooter(self, scooter_id):
         self.component.publish_message(
             {"command": "selected_escooter", "escooter": scooter_id, "phone_name": self.name})
         self.selected_escooter = scooter_id
         self.stm.send("send_escooter")
-
-        def gui_destination():
-            self.clear_gui()
-            self.app.addLabel("label_dest", "Click to send your destination:")
-            self.app.addButton("Send Destination", self.send_destination)
-
-        self.app.queueFunction(gui_destination)
+        self.view.show("destination", label_dest="Click to send your destination:")
 
     def send_destination(self):
         self.destination = (63.45, 10.38)
@@ -81,14 +64,9 @@ class PhoneLogic:
 
 
     def receive_route_suggestion(self, distance, price):
-        def gui_suggestion():
-            self.clear_gui()
-            self.app.addLabel("distance_label", f"Distance to destination: {distance} meters")
-            self.app.addLabel("price_label", f"Estimated price: {price} NOK")
-            self.app.addButton("Confirm Route", self.confirm_route)
-            self.app.addButton("Decline Route", self.decline_route)
-            self.price = price
-        self.app.queueFunction(gui_suggestion)
+        self.price = price
+        self.view.show("suggestion", suggested_distance_label=f"Distance to destination: {distance} meters",
+                       suggested_price_label=f"Estimated price: {price} NOK")
 
     def confirm_route(self):
         self.component.publish_message({"command": "route_confirmed", "confirm": True, "phone_name": self.name,
@@ -100,24 +78,10 @@ class PhoneLogic:
     def decline_route(self):
         self.component.publish_message({"command": "route_confirmed", "confirm": False, "phone_name": self.name})
         self.stm.send("route_not_confirmed")
-
-        def gui_destination_again():
-            self.clear_gui()
-            self.app.addLabel("label_dest", "Destination rejected, choose again:")
-            self.app.addButton("Send Destination", self.send_destination)
-
-        self.app.queueFunction(gui_destination_again)
+        self.view.show("destination", label_dest="Destination rejected, choose again:")
 
     def traveling_gui(self):
-        def gui_traveling():
-            self.clear_gui()
-            self.app.addLabel("travel_label", "Traveling... You can:")
-            self.app.addButton("Ask for Price", self.ask_price)
-            self.app.addButton("Ask for Distance Update", self.ask_distance)
-            self.app.addLabel("distance_label", "")
-            self.app.addLabel("price_label", "")
-
-        self.app.queueFunction(gui_traveling)
+        self.view.show("traveling", travel_label="Traveling... You can:", distance_label="", price_label="")
         self.check_arrival()
 
     def ask_price(self):
@@ -151,17 +115,17 @@ class PhoneLogic:
 
     def show_destination_reached_animation(self):
         # Define an animation for destination reached
-        self.clear_gui()
+        self.view.show("arrived", destination_label="")
 
         def animation_step(step=0):
             if step == 0:
-                self.app.addLabel("destination_label", "Destination Reached!")
+                self.view.set_label("destination_label", "Destination Reached!")
                 self.app.setBackground("lightgreen")  # Change background to light green
             elif step == 1:
-                self.app.setLabel("destination_label", "Destination Reached! 🎉")
+                self.view.set_label("destination_label", "Destination Reached! 🎉")
                 self.app.setBackground("lightblue")  # Change background to light blue
             elif step == 2:
-                self.app.setLabel("destination_label", "Destination Reached! 🎉 🚗")
+                self.view.set_label("destination_label", "Destination Reached! 🎉 🚗")
                 self.app.setBackground("lightyellow")  # Change background to yellow
 
             # After the last animation step, close the window
@@ -176,25 +140,32 @@ class PhoneLogic:
 
 
 class PhoneSenderComponent:
-    def __init__(self):
+    def __init__(self, transport=None):
         self._logger = logging.getLogger(__name__)
         logging.basicConfig(level=logging.DEBUG)
         self._logger.info('Starting Component')
 
-        self.mqtt_client = mqtt.Client()
-        self.mqtt_client.on_connect = self.on_connect
-        self.mqtt_client.on_message = self.on_message
-        self.mqtt_client.connect(MQTT_BROKER, MQTT_PORT)
-        self.mqtt_client.loop_start()
-
         self.app = gui("Phone GUI")
         self.setup_gui()
 
+        # counters and histograms of the phone and its machine, see metrics.py
+        self.metrics = Metrics()
+
         self.phone_logic = PhoneLogic("phone", None, self)
         self.phone_stm = self.phone_logic.create_machine(self.phone_logic.name, None, self)
+        # the server drops what it already got by these ids, see qos.py
+        self.message_ids = MessageIds(self.phone_logic.name)
         self.driver = stmpy.Driver()
         self.driver.add_machine(self.phone_stm)
         self.driver.start()
+        self.metrics.gauge('driver_queue_depth', self.driver._event_queue.qsize)
+
+        # connect once the phone has a name, and only to the answers meant for it
+        self.transport = MqttTransport(MQTT_BROKER, MQTT_PORT, MQTT_CODEC) if transport is None else transport
+        self.transport.on_message = self.on_message
+        self.transport.subscribe(phone_topic(self.phone_logic.name))
+        self.transport.start()
+        self._logger.info('Transport started')
 
     def setup_gui(self):
         self.app.startLabelFrame("Escooter APP")
@@ -204,18 +175,17 @@ class PhoneSenderComponent:
         self.app.go()
 
     def publish_message(self, msg):
-        payload = json.dumps(msg)
-        self.mqtt_client.publish(MQTT_TOPIC_INPUT, payload=payload, qos=2)
-
-    def on_connect(self, client, userdata, flags, rc):
-        self._logger.info('Connected to MQTT Broker')
-        client.subscribe(MQTT_TOPIC_OUTPUT)
+        qos = self.message_ids.stamp(msg)
+        start = time.perf_counter()
+        self.transport.publish(phone_input_topic(self.phone_logic.name), msg, qos=qos)
+        self.metrics.observe('publish_s', time.perf_counter() - start, msg.get('command'))
+        self.metrics.inc('messages_out', msg.get('command'))
 
-    def on_message(self, client, userdata, msg):
-        data = json.loads(msg.payload.decode('utf-8'))
+    def on_message(self, topic, data, codec):
         self._logger.info(f"Received: {data}")
 
         msg_command = data.get("command")
+        self.metrics.inc('messages_in', msg_command)
 
         if msg_command == "escooters_list":
             scooters = data.get("escooters", [])
@@ -223,6 +193,14 @@ class PhoneSenderComponent:
             self.phone_logic.escooters_gui_select_escooter(scooters, distance)
             self.phone_logic.stm.send("receive_escooters")
 
+        elif msg_command == "reservation_failed":
+            # the server follows up with a fresh list of free escooters
+            self._logger.info(f"Escooter {data.get('escooter')} was taken by someone else")
+            self.phone_logic.stm.send("reservation_failed")
+
+        elif msg_command == "reservation_confirmed":
+            self._logger.info(f"Escooter {data.get('escooter')} reserved")
+
         elif msg_command == "suggest_route":
             distance = data.get("distance")
             price = data.get("price")
@@ -231,11 +209,22 @@ class PhoneSenderComponent:
         elif msg_command == "distance_remaining":
             distance = data.get("distance")
 
-            self.app.setLabel("distance_label", f"Distance to destination: {distance} meters")
+            self.phone_logic.view.set_label("distance_label", f"Distance to destination: {distance} meters")
+
+        elif msg_command == "trip_update":
+            # pushed by the server while we travel, no need to ask
+            self.phone_logic.view.set_label("distance_label", f"Distance to destination: {data.get('distance')} meters")
+            self.phone_logic.view.set_label("price_label", f"Estimated price: {data.get('price')} NOK")
+
+        elif msg_command == "out_of_route":
+            self.phone_logic.view.set_label("travel_label", "You left the route! Please head back.")
+
+        elif msg_command == "back_on_route":
+            self.phone_logic.view.set_label("travel_label", "Traveling... You can:")
 
         elif msg_command == "price_remaining":
             price = data.get("price")
-            self.app.setLabel("price_label", f"Estimated price: {price} NOK")
+            self.phone_logic.view.set_label("price_label", f"Estimated price: {price} NOK")
 
         else:
             print(f"Command ignored: {msg_command}")
@@ -253,8 +242,13 @@ def create_machine(self, phone_name, func, component):
     t9 = {"trigger": "received_distance", "source": "DistanceAsked", "target": "TravelingAndCheckRouteInfo"}
     t10 = {"trigger": "received_price", "source": "PriceAsked", "target": "TravelingAndCheckRouteInfo"}
     t11 = {"trigger": "destination_reached", "source": "TravelingAndCheckRouteInfo", "target": "final"}
+    t12 = {"trigger": "reservation_failed", "source": "SelectDestination", "target": "AwaitServerInfo"}
+    # the reservation ran out before we confirmed the route, and the escooter was taken
+    t13 = {"trigger": "reservation_failed", "source": "ConfirmRoute", "target": "AwaitServerInfo"}
 
-    phone_stm = stmpy.Machine(name=phone_name, transitions=[t0, t1, t2, t3, t4, t5, t6, t7, t8, t9, t10, t11], obj=self)
+    phone_stm = InstrumentedMachine(name=phone_name,
+                                    transitions=[t0, t1, t2, t3, t4, t5, t6, t7, t8, t9, t10, t11, t12, t13],
+                                    obj=self, metrics=component.metrics, kind='phone', table_key='phone')
     self.stm = phone_stm
     return phone_stm
 
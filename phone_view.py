@@ -0,0 +1,123 @@
+import logging
+import threading
+
+# screens of the phone, in the order they are stacked
+SCREENS = ["start", "escooters", "destination", "suggestion", "traveling", "arrived"]
+
+
+class PhoneView:
+    """
+    The widgets of the phone GUI, built once.
+
+    Every screen is a frame of one appJar frame stack; changing screen only
+    selects another frame, and texts are changed in place. `show`, `set_label`
+    and `set_escooters` may be called from any thread: they only record what
+    should be on screen, and one redraw queued on the GUI thread applies
+    everything recorded since the last one, however many server updates
+    arrived in between.
+    """
+
+    def __init__(self, app, logic):
+        self._logger = logging.getLogger(__name__)
+        self.app = app
+        self._lock = threading.Lock()
+        self._screen = None
+        self._labels = {}
+        self._escooters = None
+        self._redraw_queued = False
+        # listbox entry -> escooter id of the list on screen
+        self._escooter_ids = {}
+        self._build(logic)
+
+    def _build(self, logic):
+        app = self.app
+        app.startFrameStack("Screens", start=0)
+
+        app.startFrame()
+        app.addLabel("label_intro", "Welcome! Send your location to find scooters.")
+        app.addButton("Send Location", logic.send_location)
+        app.stopFrame()
+
+        app.startFrame()
+        app.addLabel("label_escooters", "Select an available scooter:")
+        # one listbox however many escooters there are, instead of a button each
+        app.addListBox("escooters", [])
+        app.addButton("Select Escooter", self._on_select_escooter)
+        app.stopFrame()
+        self._on_escooter_selected = logic.select_escooter
+
+        app.startFrame()
+        app.addLabel("label_dest", "Click to send your destination:")
+        app.addButton("Send Destination", logic.send_destination)
+        app.stopFrame()
+
+        app.startFrame()
+        app.addLabel("suggested_distance_label", "")
+        app.addLabel("suggested_price_label", "")
+        app.addButton("Confirm Route", logic.confirm_route)
+        app.addButton("Decline Route", logic.decline_route)
+        app.stopFrame()
+
+        app.startFrame()
+        app.addLabel("travel_label", "Traveling... You can:")
+        app.addButton("Ask for Price", logic.ask_price)
+        app.addButton("Ask for Distance Update", logic.ask_distance)
+        app.addLabel("distance_label", "")
+        app.addLabel("price_label", "")
+        app.stopFrame()
+
+        app.startFrame()
+        app.addLabel("destination_label", "Destination Reached!")
+        app.stopFrame()
+
+        app.stopFrameStack()
+
+    def show(self, screen, **labels):
+        """Switch to `screen`, setting any of its labels given by name."""
+        if screen not in SCREENS:
+            raise ValueError("Unknown screen {}".format(screen))
+        with self._lock:
+            self._screen = screen
+            self._labels.update(labels)
+        self._queue_redraw()
+
+    def set_label(self, name, text):
+        with self._lock:
+            self._labels[name] = text
+        self._queue_redraw()
+
+    def set_escooters(self, escooters, distances):
+        entries = [f"{escooter['id']} (Distance {distance}m)" for escooter, distance in zip(escooters, distances)]
+        with self._lock:
+            self._escooters = (entries, {entry: escooter['id'] for entry, escooter in zip(entries, escooters)})
+        self._queue_redraw()
+
+    def _queue_redraw(self):
+        with self._lock:
+            if self._redraw_queued:
+                return
+            self._redraw_queued = True
+        self.app.queueFunction(self._redraw)
+
+    def _redraw(self):
+        # GUI thread only
+        with self._lock:
+            screen, self._screen = self._screen, None
+            labels, self._labels = self._labels, {}
+            escooters, self._escooters = self._escooters, None
+            self._redraw_queued = False
+        if escooters is not None:
+            entries, self._escooter_ids = escooters
+            self.app.updateListBox("escooters", entries, select=False, callFunction=False)
+        for name, text in labels.items():
+            self.app.setLabel(name, text)
+        if screen is not None:
+            self.app.selectFrame("Screens", SCREENS.index(screen))
+
+    def _on_select_escooter(self, button=None):
+        selected = self.app.getListBox("escooters")
+        if not selected:
+            return
+        escooter_id = self._escooter_ids.get(selected[0])
+        if escooter_id is not None:
+            self._on_escooter_selected(escooter_id)
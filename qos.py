@@ -0,0 +1,137 @@
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# MQTT delivery guarantee of every command, by what a lost or repeated message costs.
+#
+# 2, exactly once: commands that move a session forward or hand out an escooter.
+# Losing one strands a phone, so they keep the four-packet handshake; there are
+# only a handful of them per trip.
+# 1, at least once: discovery and route monitoring, worth a retry but harmless
+# when repeated, and the gateway's telemetry batches, which a lost one would
+# leave stale for a whole report interval, and its resets.
+# 0, at most once: quote replies and position updates, which the next one
+# replaces anyway.
+EXACTLY_ONCE = 2
+AT_LEAST_ONCE = 1
+AT_MOST_ONCE = 0
+COMMAND_QOS = {
+    "phone_location": EXACTLY_ONCE,
+    "escooters_list": EXACTLY_ONCE,
+    "selected_escooter": EXACTLY_ONCE,
+    "reservation_confirmed": EXACTLY_ONCE,
+    "reservation_failed": EXACTLY_ONCE,
+    "exchange_destination": EXACTLY_ONCE,
+    "suggest_route": EXACTLY_ONCE,
+    "route_confirmed": EXACTLY_ONCE,
+    "receive_route_details": EXACTLY_ONCE,
+    "destination_reached": EXACTLY_ONCE,
+    "get_location": AT_LEAST_ONCE,
+    "receive_escooter_location": AT_LEAST_ONCE,
+    "out_of_route": AT_LEAST_ONCE,
+    "back_on_route": AT_LEAST_ONCE,
+    "escooter_report_batch": AT_LEAST_ONCE,
+    "gateway_reset": AT_LEAST_ONCE,
+    "ask_price": AT_MOST_ONCE,
+    "price_remaining": AT_MOST_ONCE,
+    "ask_distance": AT_MOST_ONCE,
+    "distance_remaining": AT_MOST_ONCE,
+    "trip_update": AT_MOST_ONCE,
+    "escooter_report": AT_MOST_ONCE,
+    # between the servers of a cluster
+    "session_handoff": EXACTLY_ONCE,
+    "reservation_request": EXACTLY_ONCE,
+    "reservation_result": EXACTLY_ONCE,
+    "reservation_extend": EXACTLY_ONCE,
+    "reservation_release": EXACTLY_ONCE,
+    "reservation_handoff": EXACTLY_ONCE,
+    "node_leave": AT_LEAST_ONCE,
+    "node_heartbeat": AT_MOST_ONCE,
+}
+# commands missing from the table
+DEFAULT_QOS = AT_LEAST_ONCE
+
+# field of a message holding its id
+MESSAGE_ID = "msg_id"
+# ids remembered per receiver, and for how long (seconds); a broker redelivers
+# within a reconnect, long before either runs out
+DEDUP_SIZE = 100000
+DEDUP_TTL = 600
+
+
+def qos_for(command):
+    return COMMAND_QOS.get(command, DEFAULT_QOS)
+
+
+class MessageIds:
+    """
+    Ids for the messages one sender publishes.
+
+    An id is the sender's name, a token drawn when the sender starts and a
+    counter, so a restarted sender never repeats the ids of its previous run.
+    """
+
+    def __init__(self, sender):
+        self.prefix = "{}.{}".format(sender, os.urandom(4).hex())
+        self._counter = itertools.count(1)
+
+    def next(self):
+        return "{}.{}".format(self.prefix, next(self._counter))
+
+    def stamp(self, msg):
+        """Give `msg` an id if it can be delivered more than once; returns the QoS to publish it with."""
+        qos = qos_for(msg.get("command"))
+        if qos != AT_MOST_ONCE and MESSAGE_ID not in msg:
+            msg[MESSAGE_ID] = self.next()
+        return qos
+
+
+class Deduplicator:
+    """
+    Remembers the ids of recently received messages to drop repeated ones.
+
+    At-least-once delivery, a client resending after a reconnect or a broker
+    retrying a QoS 2 handshake that was cut off can all hand us the same message
+    twice; a handler that reserves an escooter or advances a machine must see
+    it only once. Messages without an id are always let through.
+    """
+
+    def __init__(self, size=DEDUP_SIZE, ttl=DEDUP_TTL):
+        if size < 1:
+            raise ValueError("Deduplicator needs room for at least one id, got {}".format(size))
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # msg_id -> time it was first seen, oldest first
+        self._seen = OrderedDict()
+        self.duplicates = 0
+
+    def __len__(self):
+        return len(self._seen)
+
+    def is_duplicate(self, msg, now=None):
+        """True if a message with the id of `msg` was seen before, otherwise remembers it."""
+        msg_id = msg.get(MESSAGE_ID)
+        if msg_id is None:
+            return False
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            while self._seen:
+                oldest, seen_at = next(iter(self._seen.items()))
+                if seen_at > now - self.ttl and len(self._seen) < self.size:
+                    break
+                del self._seen[oldest]
+            if msg_id in self._seen:
+                self.duplicates += 1
+                return True
+            self._seen[msg_id] = now
+            return False
+
+    def forget(self, msg):
+        """Let a message seen before through again, for one that could not be handled after all."""
+        msg_id = msg.get(MESSAGE_ID)
+        if msg_id is not None:
+            with self._lock:
+                self._seen.pop(msg_id, None)
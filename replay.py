@@ -0,0 +1,262 @@
+"""
+Replays recorded traffic against the server, to compare builds under the same load.
+
+A server started with --record writes every message it receives and sends to a
+recording (see traffic.py). This feeds the messages it received, in the same
+order, to a fresh server of the build checked out here: with --speed 1 at the
+pace they were recorded at, with --speed N N times as fast, with --speed 0 as
+fast as the server takes them. The recording is read one record at a time, so
+captures of any size replay in constant memory.
+
+Reported are the messages replayed per second and, for every command a phone
+sent, how long the server took to send the phone something back. With
+--baseline, the results of a replay against another build are compared to.
+
+    python server.py --record capture.bin
+    git checkout old && python replay.py capture.bin --speed 0 --output old.json
+    git checkout new && python replay.py capture.bin --speed 0 --baseline old.json
+"""
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+
+import server
+from dispatch import WORKER_QUEUE_SIZE
+from cluster import CLUSTER_COMMANDS
+from codec import get_codec
+from topics import phone_topic
+from traffic import INBOUND, read_traffic
+
+# what the server answers a phone's command with, the first of these sent for the
+# phone's session after the command gives its latency
+REPLIES = {
+    "phone_location": ("escooters_list",),
+    "selected_escooter": ("reservation_confirmed", "reservation_failed"),
+    "exchange_destination": ("suggest_route",),
+    "route_confirmed": ("receive_route_details",),
+    "ask_price": ("price_remaining",),
+    "ask_distance": ("distance_remaining",),
+    "destination_reached": ("destination_reached",),
+}
+# the phone an answer is for is in its topic, or in the server_name of what goes to its escooter
+PHONE_TOPIC_PREFIX = phone_topic('')
+# latencies kept per command to work out the percentiles from
+SAMPLE_SIZE = 10000
+# the replay is over once the server sent nothing for this long after the last message ...
+QUIET_PERIOD = 0.5
+# ... or this long has passed
+DRAIN_TIMEOUT = 30
+# a command the server did not answer within this many seconds counts as unanswered
+REPLY_TIMEOUT = 10
+# at full speed, the replay holds back while a worker has this many jobs waiting,
+# so the server takes every message instead of dropping them from full queues
+MAX_BACKLOG = WORKER_QUEUE_SIZE // 2
+
+
+class LatencySample:
+    """Count and mean of all latencies, percentiles from a fixed-size uniform sample of them."""
+
+    def __init__(self, size=SAMPLE_SIZE, seed=0):
+        self.size = size
+        self.values = []
+        self.count = 0
+        self.sum = 0.0
+        self._random = random.Random(seed)
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if len(self.values) < self.size:
+            self.values.append(value)
+        else:
+            # reservoir sampling: every latency so far is kept with the same chance
+            i = self._random.randrange(self.count)
+            if i < self.size:
+                self.values[i] = value
+
+    def summary(self):
+        values = sorted(self.values)
+
+        def ms(p):
+            return round(values[min(len(values) - 1, int(p / 100 * len(values)))] * 1000, 3) if values else None
+        return {"count": self.count, "mean_ms": round(self.sum / self.count * 1000, 3) if self.count else None,
+                "p50_ms": ms(50), "p95_ms": ms(95), "p99_ms": ms(99)}
+
+
+class ReplayTransport:
+    """
+    Stands in for the broker of the server under replay.
+
+    The recorded messages are handed in by `deliver`; whatever the server
+    publishes is counted, and the answers to the phones' commands (see
+    REPLIES) are timed. A command the phone sends again before it was
+    answered, or that waits for longer than REPLY_TIMEOUT, counts as
+    unanswered, so no later answer is credited to it.
+    """
+
+    def __init__(self):
+        self.on_message = None
+        # the server publishes from its workers, drivers and timers alike
+        self._lock = threading.Lock()
+        self.published = 0
+        self.last_published = time.perf_counter()
+        self.latencies = {}
+        self.unanswered = {}
+        # phone name -> (when, command) of the phone's commands not answered yet, oldest first
+        self._waiting = {}
+
+    def subscribe(self, topic):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def deliver(self, topic, msg, codec):
+        command = msg.get('command')
+        if command in REPLIES and msg.get('phone_name') is not None:
+            now = time.perf_counter()
+            with self._lock:
+                waiting = self._waiting.setdefault(msg.get('phone_name'), [])
+                self._drop(waiting, lambda since, waiting_for: waiting_for == command or since < now - REPLY_TIMEOUT)
+                waiting.append((now, command))
+        self.on_message(topic, msg, codec)
+
+    def publish(self, topic, msg, qos=2, codec=None):
+        now = time.perf_counter()
+        with self._lock:
+            self.published += 1
+            self.last_published = now
+            phone_name = topic[len(PHONE_TOPIC_PREFIX):] if topic.startswith(PHONE_TOPIC_PREFIX) else \
+                msg.get('server_name')
+            waiting = self._waiting.get(phone_name)
+            if waiting is None:
+                return
+            self._drop(waiting, lambda since, command: since < now - REPLY_TIMEOUT)
+            for i, (since, command) in enumerate(waiting):
+                if msg.get('command') in REPLIES[command]:
+                    del waiting[i]
+                    if not waiting:
+                        del self._waiting[phone_name]
+                    sample = self.latencies.get(command)
+                    if sample is None:
+                        sample = self.latencies[command] = LatencySample()
+                    sample.add(now - since)
+                    return
+            if not waiting:
+                del self._waiting[phone_name]
+
+    def give_up(self):
+        # the replay is over, whatever still waits is not going to be answered
+        with self._lock:
+            for waiting in self._waiting.values():
+                self._drop(waiting, lambda since, command: True)
+            self._waiting.clear()
+
+    def _drop(self, waiting, unanswered):
+        # with the lock held
+        kept = []
+        for since, command in waiting:
+            if unanswered(since, command):
+                self.unanswered[command] = self.unanswered.get(command, 0) + 1
+            else:
+                kept.append((since, command))
+        waiting[:] = kept
+
+
+def run_replay(path, speed=0, driver_pool_size=server.DRIVER_POOL_SIZE, worker_pool_size=server.WORKER_POOL_SIZE,
+               drain_timeout=DRAIN_TIMEOUT, engine=server.THREADS):
+    transport = ReplayTransport()
+    component = server.ServerManagerComponent(driver_pool_size=driver_pool_size, worker_pool_size=worker_pool_size,
+                                              transport=transport, engine=engine)
+    replayed = 0
+    skipped = 0
+    first = None
+    start = time.perf_counter()
+    for elapsed, direction, topic, msg, codec in read_traffic(path):
+        # what the server sent is what we measure, and the standalone server is no cluster
+        if direction != INBOUND or msg.get('command') in CLUSTER_COMMANDS:
+            skipped += 1
+            continue
+        if speed:
+            first = elapsed if first is None else first
+            delay = (elapsed - first) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        else:
+            while max(component.workers.queue_depths()) >= MAX_BACKLOG:
+                time.sleep(0.001)
+        transport.deliver(topic, msg, get_codec(codec) if codec else None)
+        replayed += 1
+    fed = time.perf_counter() - start
+
+    # until the server has answered everything it is going to
+    deadline = time.perf_counter() + drain_timeout
+    while time.perf_counter() < deadline:
+        busy = any(component.workers.queue_depths()) or any(component.driver_pool.queue_depths())
+        if not busy and time.perf_counter() - transport.last_published >= QUIET_PERIOD:
+            break
+        time.sleep(0.05)
+    transport.give_up()
+    # up to the last answer, the quiet period after it is no work
+    elapsed = max(fed, transport.last_published - start)
+    results = {
+        "recording": path,
+        "speed": speed,
+        "engine": engine,
+        "replayed": replayed,
+        "skipped": skipped,
+        "published": transport.published,
+        "feed_s": fed,
+        "elapsed_s": elapsed,
+        "messages_per_s": replayed / elapsed if elapsed else None,
+        "latency": {command: sample.summary() for command, sample in sorted(transport.latencies.items())},
+        "unanswered": dict(sorted(transport.unanswered.items())),
+        "server_metrics": component.metrics.snapshot(),
+    }
+    component.stop()
+    return results
+
+
+def compare(results, baseline):
+    """Ratio of every figure of `results` to the same figure of `baseline`."""
+    def ratio(new, old):
+        return round(new / old, 3) if new is not None and old else None
+
+    return {
+        "messages_per_s": ratio(results.get("messages_per_s"), baseline.get("messages_per_s")),
+        "latency": {command: {key: ratio(figures.get(key), baseline["latency"][command].get(key))
+                              for key in ("mean_ms", "p50_ms", "p95_ms", "p99_ms")}
+                    for command, figures in results["latency"].items() if command in baseline.get("latency", {})},
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('recording', help='recording made by server.py --record')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='1 replays at the recorded pace, N N times as fast, 0 as fast as possible')
+    parser.add_argument('--drivers', type=int, default=server.DRIVER_POOL_SIZE, help='stmpy driver pool size')
+    parser.add_argument('--workers', type=int, default=server.WORKER_POOL_SIZE, help='command worker pool size')
+    parser.add_argument('--engine', choices=server.ENGINES, default=server.THREADS,
+                        help='how the server runs its sessions, see async_engine.py')
+    parser.add_argument('--baseline', default=None, help='results of a replay against another build to compare to')
+    parser.add_argument('--output', default=None, help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = run_replay(args.recording, speed=args.speed, driver_pool_size=args.drivers,
+                         worker_pool_size=args.workers, engine=args.engine)
+    if args.baseline:
+        with open(args.baseline) as f:
+            results["compared_to"] = dict(compare(results, json.load(f)), baseline=args.baseline)
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
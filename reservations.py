@@ -0,0 +1,116 @@
+import threading
+import time
+
+# time a phone has between selecting an escooter and confirming the route
+RESERVATION_TTL = 300
+# once the trip has started the reservation lasts for the whole ride
+TRIP_RESERVATION_TTL = 3600
+
+
+class ReservationLedger:
+    """
+    The single source of truth for who holds which escooter.
+
+    Reservations are keyed by escooter id, and checking and taking one happen
+    under the same lock, so two sessions can never both get the same escooter.
+    Every reservation carries an expiry; expired ones count as free and are
+    dropped lazily or by `expire`.
+    """
+
+    def __init__(self, ttl=RESERVATION_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # escooter_id -> (holder, expires_at)
+        self._reservations = {}
+
+    def __len__(self):
+        return len(self._reservations)
+
+    def reserve(self, escooter_id, holder, ttl=None, now=None):
+        """Reserve the escooter for `holder`, False if somebody else holds it."""
+        now = time.monotonic() if now is None else now
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            current = self._reservations.get(escooter_id)
+            if current is not None and current[0] != holder and current[1] > now:
+                return False
+            self._reservations[escooter_id] = (holder, expires_at)
+            return True
+
+    def extend(self, escooter_id, holder, ttl, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            current = self._reservations.get(escooter_id)
+            if current is None or current[0] != holder or current[1] <= now:
+                return False
+            self._reservations[escooter_id] = (holder, now + ttl)
+            return True
+
+    def release(self, escooter_id, holder):
+        with self._lock:
+            current = self._reservations.get(escooter_id)
+            if current is None or current[0] != holder:
+                return False
+            del self._reservations[escooter_id]
+            return True
+
+    def holder(self, escooter_id, now=None):
+        now = time.monotonic() if now is None else now
+        current = self._reservations.get(escooter_id)
+        if current is None or current[1] <= now:
+            return None
+        return current[0]
+
+    def is_reserved(self, escooter_id, now=None):
+        return self.holder(escooter_id, now) is not None
+
+    def take(self, select, now=None):
+        """Remove the live reservations of the escooters `select(escooter_id)` is true for.
+
+        Returns (escooter_id, holder, seconds left) for each, so they can be
+        handed to another ledger.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            taken = [(escooter_id, holder, expires_at - now)
+                     for escooter_id, (holder, expires_at) in self._reservations.items()
+                     if expires_at > now and select(escooter_id)]
+            for escooter_id, _, _ in taken:
+                del self._reservations[escooter_id]
+        return taken
+
+    def expire(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            expired = [escooter_id for escooter_id, (_, expires_at) in self._reservations.items()
+                       if expires_at <= now]
+            for escooter_id in expired:
+                del self._reservations[escooter_id]
+        return expired
+
+
+if __name__ == '__main__':
+    # throughput of reserve/release pairs from several threads over a shared fleet
+    num_threads = 8
+    num_escooters = 10000
+    per_thread = 50000
+    ledger = ReservationLedger()
+    granted = [0] * num_threads
+
+    def run(index):
+        holder = f"phone_{index}"
+        for i in range(per_thread):
+            escooter_id = f"escooter_{(i * 7 + index) % num_escooters}"
+            if ledger.reserve(escooter_id, holder):
+                granted[index] += 1
+                ledger.release(escooter_id, holder)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(num_threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    attempts = num_threads * per_thread
+    print(f"{attempts} reservation attempts in {elapsed:.2f}s, {attempts / elapsed:.0f}/s, {sum(granted)} granted")
@@ -0,0 +1,84 @@
+import math
+import threading
+from collections import OrderedDict
+
+# most origin/destination pairs kept
+QUOTE_CACHE_SIZE = 10000
+# side, in metres like every location the server sees, of the cells origins and
+# destinations are rounded to; a quote is off by at most about one cell
+QUOTE_CELL_SIZE = 10
+
+
+class RouteQuoteCache:
+    """
+    LRU cache of route quotes between two locations.
+
+    Locations are quantized to cells of `cell_size`, so every origin in one cell
+    going to any destination in another cell gets the quote computed for the
+    first such pair. The least recently used pair is dropped once `size` pairs
+    are cached.
+    """
+
+    def __init__(self, size=QUOTE_CACHE_SIZE, cell_size=QUOTE_CELL_SIZE):
+        if size < 1:
+            raise ValueError("Quote cache needs room for at least one quote, got {}".format(size))
+        self.size = size
+        self.cell_size = cell_size
+        self._lock = threading.Lock()
+        self._quotes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._quotes)
+
+    def _cell(self, location):
+        return (math.floor(location[0] / self.cell_size), math.floor(location[1] / self.cell_size))
+
+    def get(self, origin, destination, compute):
+        """Quote for going from `origin` to `destination`, calling `compute(origin, destination)` on a miss."""
+        key = (self._cell(origin), self._cell(destination))
+        with self._lock:
+            quote = self._quotes.get(key)
+            if quote is not None:
+                self._quotes.move_to_end(key)
+                self.hits += 1
+                return quote
+            self.misses += 1
+        # computed outside the lock, a slow routing backend must not block the other sessions;
+        # two sessions missing the same pair at once both compute it
+        quote = compute(origin, destination)
+        with self._lock:
+            self._quotes[key] = quote
+            self._quotes.move_to_end(key)
+            while len(self._quotes) > self.size:
+                self._quotes.popitem(last=False)
+                self.evictions += 1
+        return quote
+
+    def clear(self):
+        with self._lock:
+            self._quotes.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"quotes": len(self._quotes), "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "hit_rate": self.hits / lookups if lookups else None}
+
+
+if __name__ == '__main__':
+    # nearby trips share a quote, trips a cell apart do not
+    cache = RouteQuoteCache()
+    calls = []
+
+    def compute(origin, destination):
+        calls.append((origin, destination))
+        return abs(origin[0] - destination[0]) + abs(origin[1] - destination[1])
+
+    first = cache.get((12, 34), (71, 88), compute)
+    second = cache.get((14.5, 31), (78, 82.5), compute)
+    assert first == second and len(calls) == 1, calls
+    cache.get((22, 34), (71, 88), compute)
+    assert len(calls) == 2, calls
+    print(cache.stats())
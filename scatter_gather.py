@@ -0,0 +1,46 @@
+import threading
+
+# how long the server waits for escooters to answer get_location
+GATHER_DEADLINE_MS = 1500
+# answer as soon as this many escooters replied, None waits for all of them
+GATHER_QUORUM = None
+
+
+class ScatterGather:
+    """
+    Collects the replies to one fan-out.
+
+    `add` returns True exactly once, for the reply that completes the quorum (or
+    the full set when there is no quorum), which is the moment to answer early.
+    The deadline itself is left to the caller's state machine timer; once the
+    gather is closed, late replies are only counted and otherwise ignored.
+    """
+
+    def __init__(self, expected, quorum=GATHER_QUORUM):
+        self.expected = expected
+        self.quorum = expected if quorum is None else min(quorum, expected)
+        self.replies = {}
+        self.late_replies = 0
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.replies)
+
+    def add(self, key, value):
+        with self._lock:
+            if self.closed:
+                self.late_replies += 1
+                return False
+            if key in self.replies:
+                return False
+            self.replies[key] = value
+            if len(self.replies) == self.quorum:
+                self.closed = True
+                return True
+            return False
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            return dict(self.replies)
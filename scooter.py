@@ -1,30 +1,53 @@
-import paho.mqtt.client as mqtt
 import stmpy
 import logging
-import json
-import random
+import threading
+import time
+
+import numpy as np
+
+from codec import BINARY
+from fleet_sim import FleetSimulator, TICK_INTERVAL
+from geofence import RouteCorridor
+from metrics import InstrumentedMachine, Metrics
+from qos import Deduplicator, MessageIds
+from telemetry import TelemetryScheduler, MAX_BATCH_SIZE, TELEMETRY_TICK
+from topics import escooter_input_topic, escooter_bucket_topic, gateway_input_topic
+from transport import MqttTransport
 
 MQTT_BROKER = 'mqtt20.iik.ntnu.no'
 MQTT_PORT = 1883
+# wire format used for everything we send, see codec.py
+MQTT_CODEC = BINARY
 
-MQTT_TOPIC_INPUT = 'team02Input'
-MQTT_TOPIC_OUTPUT = 'team02Output'
+# name of the gateway in the topic of its batched reports
+GATEWAY_NAME = 'gateway'
+# ms an escooter that was asked for its location waits for route details, as long as a reservation lasts
+ROUTE_DETAILS_TIMEOUT = 300000
+# ms between two position samples checked against the route while traveling
+POSITION_SAMPLE_INTERVAL = 1000
 
 
 class ScooterLogic:
+    # created only for escooters that are talking to the server, the rest of
+    # the fleet lives in the simulator's arrays
+    __slots__ = ('_logger', 'name', 'func', 'component', 'stm', 'server_name', 'corridor')
+
     def __init__(self, name, func, component):
         self._logger = logging.getLogger(__name__)
         self.name = name
         self.func = func
         self.component = component
+        self.stm = None
+        # session that sent the route, and the corridor around that route
+        self.server_name = None
+        self.corridor = None
 
     def get_location(self):
-        return (random.randint(0, 100), random.randint(0, 100))
+        return self.component.fleet.location(self.name)
 
     def create_machine(self, scooter_name, func, component):
 
         # initial transition
-        scooter_logic = ScooterLogic(name=scooter_name, func=func, component=component)
         t0 = {
             "source": "initial",
             "target": "AwaitServerRequest"
@@ -42,6 +65,7 @@ class ScooterLogic:
             "trigger": "received_route_details",
             "source": "AwaitRouteDetails",
             "target": "Traveling",
+            "effect": "stop_timer('t')"
         }
 
         # t2 (if/else) -> await_server_request(not arrived yet)
@@ -49,24 +73,81 @@ class ScooterLogic:
             "trigger": "arrived",
             "source": "Traveling",
             "target": "final",
-
+            "effect": "release_machine"
         }
 
+        # nobody picked this escooter, forget about the request
         t4 = {
             "trigger": "t",
-            "source": "AwaiteRouteDetails",
-            "target": "AwaitServerRequest",
-            "effect": "started"
+            "source": "AwaitRouteDetails",
+            "target": "final",
+            "effect": "release_machine"
+        }
+
+        # picked from the server's fleet registry without being asked for its location
+        t5 = {
+            "trigger": "received_route_details",
+            "source": "AwaitServerRequest",
+            "target": "Traveling"
+        }
+        # Traveling <-> OutOfRoute, decided by check_route on every position sample
+        t6 = {
+            "trigger": "sample",
+            "source": "Traveling",
+            "target": "Traveling",
+            "effect": "check_route"
+        }
+        t7 = {
+            "trigger": "left_route",
+            "source": "Traveling",
+            "target": "OutOfRoute",
+            "effect": "notify_out_of_route"
+        }
+        t8 = {
+            "trigger": "sample",
+            "source": "OutOfRoute",
+            "target": "OutOfRoute",
+            "effect": "check_route"
         }
-        scooter_stm = stmpy.Machine(name=scooter_name, transitions=[t0, t1, t2, t3, t4],
-                                    obj=scooter_logic)
-        scooter_logic.stm = scooter_stm
+        t9 = {
+            "trigger": "returned_to_route",
+            "source": "OutOfRoute",
+            "target": "Traveling",
+            "effect": "notify_back_on_route"
+        }
+        t10 = {
+            "trigger": "arrived",
+            "source": "OutOfRoute",
+            "target": "final",
+            "effect": "release_machine"
+        }
+        await_route_details = {"name": "AwaitRouteDetails", "entry": f"start_timer('t', {ROUTE_DETAILS_TIMEOUT})"}
+        traveling = {"name": "Traveling", "entry": f"start_timer('sample', {POSITION_SAMPLE_INTERVAL})",
+                     "exit": "stop_timer('sample')"}
+        out_of_route = {"name": "OutOfRoute", "entry": f"start_timer('sample', {POSITION_SAMPLE_INTERVAL})",
+                        "exit": "stop_timer('sample')"}
+        scooter_stm = InstrumentedMachine(name=scooter_name,
+                                          transitions=[t0, t1, t2, t3, t4, t5, t6, t7, t8, t9, t10],
+                                          states=[await_route_details, traveling, out_of_route], obj=self,
+                                          metrics=component.metrics, kind='scooter', table_key='scooter')
+        self.stm = scooter_stm
         return scooter_stm
 
-    def started(self):
-        self.stm.start_timer('t', 2000)
-    def receive_server_request(self, destination, price):
+    def release_machine(self):
+        # effect of every transition into final
+        self.component.release_escooter(self.name)
+
+    def receive_server_request(self, destination, price, server_name=None):
         print(destination, price)
+        self.server_name = server_name
+        # no routing here, the route is the straight line from where we are now
+        try:
+            self.corridor = RouteCorridor([self.get_location(), destination])
+        except (TypeError, ValueError) as err:
+            self._logger.error('Invalid route to {}, not checking it. {}'.format(destination, err))
+            self.corridor = None
+        # the next telemetry round reports us busy
+        self.component.fleet.start_trip(self.name, destination)
         """
         from sense_hat import SenseHat
 
@@ -110,47 +191,79 @@ class ScooterLogic:
         """
         # Maybe display in the RaspberryPi a image with the info
 
+    def check_route(self):
+        # effect of every position sample while traveling; only a change between
+        # on and off route becomes an event
+        if self.corridor is None:
+            return
+        on_route = self.corridor.contains(self.get_location())
+        if self.stm.state == 'Traveling' and not on_route:
+            self.stm.send('left_route')
+        elif self.stm.state == 'OutOfRoute' and on_route:
+            self.stm.send('returned_to_route')
+
+    def notify_out_of_route(self):
+        self._logger.warning('Escooter {} left its route'.format(self.name))
+        self.component.publish_message({"command": "out_of_route", "escooter_id": self.name,
+                                        "server_name": self.server_name, "location": self.get_location()},
+                                       escooter_input_topic(self.name))
+
+    def notify_back_on_route(self):
+        self._logger.info('Escooter {} is back on its route'.format(self.name))
+        self.component.publish_message({"command": "back_on_route", "escooter_id": self.name,
+                                        "server_name": self.server_name, "location": self.get_location()},
+                                       escooter_input_topic(self.name))
+
     def provide_location(self, server_name, phone_location):
         location = self.get_location()
         msg = {"command": "receive_escooter_location", "location": location, "escooter_id": self.name,
-               "busy": random.randint(0, 1),
+               "busy": self.component.fleet.is_busy(self.name),
                "server_name": server_name, "phone_location": phone_location
                }
-        self.component.publish_message(msg)
+        self.component.publish_message(msg, escooter_input_topic(self.name))
 
+    def trip_finished(self):
+        self.corridor = None
+        self.component.fleet.end_trip(self.name)
 
 
-class ScooterManagerComponent:
-    def publish_message(self, msg):
-        payload = json.dumps(msg)
-        self.mqtt_client.publish(MQTT_TOPIC_INPUT, payload=payload, qos=2)
-
-    def on_connect(self, client, userdata, flags, rc):
-        self._logger.debug('MQTT connected to {}'.format(client))
-        client.subscribe(MQTT_TOPIC_OUTPUT)
 
-    def on_message(self, client, userdata, msg):
-        self._logger.debug('Incoming message to topic {}'.format(msg.topic))
-        try:
-            payload = json.loads(msg.payload.decode("utf-8"))
-            self._logger.info(f"Received: {payload}")
-        except Exception as err:
-            self._logger.error('Message sent to topic {} had no valid JSON. Message ignored. {}'.format(msg.topic, err))
-            return
+class ScooterManagerComponent:
+    def publish_message(self, msg, topic):
+        qos = self.message_ids.stamp(msg)
+        start = time.perf_counter()
+        self.transport.publish(topic, msg, qos=qos)
+        self.metrics.observe('publish_s', time.perf_counter() - start, msg.get('command'))
+        self.metrics.inc('messages_out', msg.get('command'))
+
+    def on_message(self, topic, payload, codec):
+        self._logger.debug('Incoming message to topic {}'.format(topic))
+        self._logger.info(f"Received: {payload}")
         command = payload.get('command')
         self._logger.debug('Command in message is {}'.format(command))
+        self.metrics.inc('messages_in', command)
 
         if not command:
             self._logger.error("Message has no command")
 
+        elif payload.get("escooter_name") not in self.fleet:
+            # we subscribe to all escooter topics, this one is served by another gateway
+            self._logger.debug('Escooter {} is not ours. Message ignored.'.format(payload.get("escooter_name")))
+
+        elif self.dedup.is_duplicate(payload):
+            # a route or an arrival handled twice would start or end the trip twice
+            self._logger.debug('Duplicate message {}. Message ignored.'.format(payload.get('msg_id')))
+            self.metrics.inc('duplicates_in', command)
+
         elif command == 'get_location':
             try:
                 print(f"Received: {command}")
                 escooter_name = payload.get("escooter_name")
                 server_name = payload.get("server_name")
                 phone_location = payload.get("phone_location")
-                self.escooter_logic[escooter_name].provide_location(server_name, phone_location)
-                self.escooter_stm[payload.get("escooter_name")].send("server_location_request")
+                logic = self.escooter(escooter_name)
+                logic.provide_location(server_name, phone_location)
+                logic.stm.send("server_location_request")
 
             except Exception as err:
                 self._logger.error('Invalid arguments to command. {}'.format(err))
@@ -158,11 +271,12 @@ class ScooterManagerComponent:
         elif command == 'receive_route_details':
             try:
                 print(f"Received: {command}")
-                server_name = payload.get("server_name")
+                escooter_name = payload.get("escooter_name")
                 destination = payload.get("destination")
                 price = payload.get("price")
-                self.escooter_logic[server_name].receive_server_request(destination, price)
-                self.escooter_stm[payload.get("escooter_name")].send("received_route_details")
+                logic = self.escooter(escooter_name)
+                logic.receive_server_request(destination, price, payload.get("server_name"))
+                logic.stm.send("received_route_details")
 
             except Exception as err:
                 self._logger.error('Invalid arguments to command. {}'.format(err))
@@ -170,54 +284,150 @@ class ScooterManagerComponent:
         elif command == 'destination_reached':
             try:
                 print(f"Received: {command}")
-                self.escooter_stm[payload.get("escooter_name")].send("arrived")
+                escooter_name = payload.get("escooter_name")
+                logic = self.escooter_logic.get(escooter_name)
+                if logic is None:
+                    # no trip we know of, just make sure the escooter is free again
+                    self.fleet.end_trip(escooter_name)
+                else:
+                    logic.trip_finished()
+                    logic.stm.send("arrived")
 
             except Exception as err:
                 self._logger.error('Invalid arguments to command. {}'.format(err))
         else:
             print(f"Command ignored: {command}")
 
-    def __init__(self, num_scooters):
+    def __init__(self, num_scooters, transport=None, seed=None, tick_interval=TICK_INTERVAL, name=GATEWAY_NAME,
+                 telemetry_tick=TELEMETRY_TICK, names=None, buckets=None):
         self._logger = logging.getLogger(__name__)
         print('logging under name {}.'.format(__name__))
         self._logger.info('Starting Component')
-        self._logger.debug('Connecting to MQTT broker {} at port {}'.format(MQTT_BROKER, MQTT_PORT))
-        self.mqtt_client = mqtt.Client()
-        self.mqtt_client.on_connect = self.on_connect
-        self.mqtt_client.on_message = self.on_message
-        self.mqtt_client.connect(MQTT_BROKER, MQTT_PORT)
-        self.mqtt_client.subscribe(MQTT_TOPIC_INPUT)
-        self.mqtt_client.loop_start()
+        self.name = name
+
+        # counters and histograms of the gateway and its machines, see metrics.py
+        self.metrics = Metrics()
+        # ids of what we send, and of what we already handled, see qos.py
+        self.message_ids = MessageIds(name)
+        self.dedup = Deduplicator()
 
+        # logic and machine of the escooters that are busy with a request or a
+        # trip, created on demand and dropped when their machine reaches final
         self.escooter_logic = {}
         self.escooter_stm = {}
-        self.driver = stmpy.Driver()
+        self._escooters_lock = threading.Lock()
         self.stm_driver = stmpy.Driver()
-        self.escooters = {}
 
-        for i in range(num_scooters):
-            name = f"escooter_{i + 1}"
-            self.escooter_logic[name] = ScooterLogic(name, None, self)
-            self.escooter_stm[name] = self.escooter_logic[name].create_machine(self.escooter_logic[name], None, self)
+        # where the escooters are and where they are going, for the whole fleet at
+        # once; a worker of gateway_supervisor.py is given the `names` of its shard
+        self.fleet = FleetSimulator(num_scooters, seed=seed, names=names)
+        self.fleet.start(tick_interval)
+        # who has to report when, see telemetry.py
+        self.telemetry = TelemetryScheduler(num_scooters, seed=seed)
 
-            self.stm_driver.add_machine(self.escooter_stm[name])
-
-        self.stm_driver.start()
+        self.stm_driver.start(keep_active=True)
+        self.metrics.gauge('active_escooters', lambda: len(self.escooter_stm))
+        self.metrics.gauge('driver_queue_depth', self.stm_driver._event_queue.qsize)
         print(f"{num_scooters} e-scooters initialized.")
+
+        # connect once the escooters exist; one subscription for the whole fleet,
+        # or one per topic bucket our escooters are in, see topics.py
+        self.transport = MqttTransport(MQTT_BROKER, MQTT_PORT, MQTT_CODEC) if transport is None else transport
+        self.transport.on_message = self.on_message
+        for bucket in ('+',) if buckets is None else buckets:
+            self.transport.subscribe(escooter_bucket_topic(bucket))
+        self.transport.start()
+
+        # telemetry, so the server can answer phones without asking us
+        self._telemetry_tick = telemetry_tick
+        self._stop_reporting = threading.Event()
+        self._reporter = threading.Thread(target=self._report_periodically, daemon=True)
+        self._reporter.start()
         self._logger.debug('Component initialization finished')
 
+    def escooter(self, name):
+        with self._escooters_lock:
+            logic = self.escooter_logic.get(name)
+            if logic is None:
+                self.fleet.index_of(name)
+                logic = ScooterLogic(name, None, self)
+                self.escooter_stm[name] = logic.create_machine(name, None, self)
+                self.escooter_logic[name] = logic
+                self.stm_driver.add_machine(logic.stm)
+        return logic
+
+    def release_escooter(self, name):
+        with self._escooters_lock:
+            self.escooter_logic.pop(name, None)
+            self.escooter_stm.pop(name, None)
+
+    def _report_periodically(self):
+        while not self._stop_reporting.is_set():
+            self.publish_telemetry()
+            self._stop_reporting.wait(self._telemetry_tick)
+
+    def publish_telemetry(self, now=None):
+        """Send the reports that are due, batched; returns how many were sent."""
+        now = time.monotonic() if now is None else now
+        positions, velocities, busy = self.fleet.state()
+        due = self.telemetry.due(positions, velocities, busy, now)
+        if not len(due):
+            return 0
+        self.telemetry.reported(due, positions, velocities, busy, now)
+        # [escooter_id, location, busy, velocity], rounded like single reports
+        reports = [[self.fleet.name_of(i), location, is_busy, velocity]
+                   for i, location, is_busy, velocity in zip(due.tolist(), np.round(positions[due], 2).tolist(),
+                                                            busy[due].tolist(), np.round(velocities[due], 2).tolist())]
+        for start in range(0, len(reports), MAX_BATCH_SIZE):
+            self.publish_message({"command": "escooter_report_batch", "gateway": self.name,
+                                  "reports": reports[start:start + MAX_BATCH_SIZE]}, gateway_input_topic(self.name))
+        self.metrics.inc('telemetry_reports', n=len(reports))
+        return len(reports)
+
+    def announce_reset(self):
+        # we started over, the trips the server still knows of on our escooters are gone
+        names = [self.fleet.name_of(i) for i in range(len(self.fleet))]
+        for start in range(0, len(names), MAX_BATCH_SIZE):
+            self.publish_message({"command": "gateway_reset", "gateway": self.name,
+                                  "escooters": names[start:start + MAX_BATCH_SIZE]}, gateway_input_topic(self.name))
+
+    def healthy(self):
+        # stmpy's driver thread dies with the first transition that raises
+        return self.stm_driver.thread.is_alive() and self._reporter.is_alive()
+
     def stop(self):
-        self.mqtt_client.loop_stop()
+        self._stop_reporting.set()
+        self.fleet.stop()
+        self.transport.stop()
         self.stm_driver.stop()
 
 
-debug_level = logging.DEBUG
-logger = logging.getLogger(__name__)
-logger.setLevel(debug_level)
-ch = logging.StreamHandler()
-ch.setLevel(debug_level)
-formatter = logging.Formatter('%(asctime)s - %(name)-12s - %(levelname)-8s - %(message)s')
-ch.setFormatter(formatter)
-logger.addHandler(ch)
-
-s = ScooterManagerComponent(num_scooters=3)
\ No newline at end of file
+if __name__ == '__main__':
+    debug_level = logging.DEBUG
+    logger = logging.getLogger(__name__)
+    logger.setLevel(debug_level)
+    ch = logging.StreamHandler()
+    ch.setLevel(debug_level)
+    formatter = logging.Formatter('%(asctime)s - %(name)-12s - %(levelname)-8s - %(message)s')
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scooters', type=int, default=3, help='number of simulated escooters')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the fleet simulation')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='split the escooters over this many worker processes, see gateway_supervisor.py')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='with --workers, worker i serves its JSON metrics on this port + i')
+    args = parser.parse_args()
+
+    if args.workers:
+        from gateway_supervisor import GatewaySupervisor
+        s = GatewaySupervisor(args.scooters, workers=args.workers, seed=args.seed, metrics_port=args.metrics_port)
+        try:
+            input("Gateway is running. Press Enter to exit.\n")
+        finally:
+            s.stop()
+    else:
+        s = ScooterManagerComponent(num_scooters=args.scooters, seed=args.seed)
\ No newline at end of file
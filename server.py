@@ -1,15 +1,41 @@
-import paho.mqtt.client as mqtt
 import logging
-import json
-from stmpy import Driver, Machine
-from collections import defaultdict
+import threading
+import time
+from async_engine import (AsyncioMqttTransport, EventLoopThread, LoopDriverPool, LoopWorkerPool, ASYNCIO, ENGINES,
+                          THREADS)
+from cluster import ClusterMembership, CLUSTER_COMMANDS, HEARTBEAT_INTERVAL, SHARED_GROUP
+from dispatch import CommandDispatcher, WorkerPool, WORKER_POOL_SIZE
+from driver_pool import DriverPool, DRIVER_POOL_SIZE
+from fleet_registry import FleetRegistry
+from metrics import InstrumentedMachine, Metrics, serve_metrics
+from qos import Deduplicator, MessageIds, qos_for
+from reservations import ReservationLedger, RESERVATION_TTL, TRIP_RESERVATION_TTL
+from route_cache import RouteQuoteCache, QUOTE_CACHE_SIZE, QUOTE_CELL_SIZE
+from scatter_gather import ScatterGather, GATHER_DEADLINE_MS, GATHER_QUORUM
+from session_lifecycle import SessionLifecycle, approx_size, SESSION_TTL, SESSION_SWEEP_INTERVAL
+from session_store import SessionStore, SNAPSHOT_INTERVAL
+from topics import (MQTT_TOPIC_INPUT, MQTT_TOPIC_INPUT_ALL, MQTT_TOPIC_PHONES_ALL, MQTT_TOPIC_ESCOOTERS_ALL,
+                    MQTT_TOPIC_GATEWAYS_ALL, phone_topic, escooter_topic, shared_topic, member_topic, node_topic)
+from traffic import RecordingTransport, TrafficRecorder
+from transport import LocalFirstTransport, LoopbackBus, LoopbackTransport, MqttTransport
 
 NUM_SCOOTERS = 3
+# how many scooters, and how far away, are offered to a phone
+NEARBY_LIMIT = 10
+NEARBY_RADIUS = 50
+# while traveling, the phone gets remaining distance and price pushed at most
+# this often (seconds, None to only answer ask_price / ask_distance) ...
+TRIP_UPDATE_INTERVAL = 5
+# ... and only when the remaining distance changed at least this much
+TRIP_UPDATE_MIN_CHANGE = 1.0
+# seconds after a cluster change during which messages for a session we do not
+# have yet are kept, waiting for the node that had it to hand it over
+HANDOFF_GRACE = 10
+# seconds a node that stops waits for its sessions to be handed over
+HANDOFF_TIMEOUT = 5
 
 MQTT_BROKER = 'mqtt20.iik.ntnu.no'
 MQTT_PORT = 1883
-MQTT_TOPIC_INPUT = 'team02Input'
-MQTT_TOPIC_OUTPUT = 'team02Output'
 
 
 def calculate_price(distance):
@@ -20,54 +46,175 @@ def calculate_distance(source, destination):
     return round((abs(destination[0] - source[0]) + abs(destination[1] - source[1])) / 2, 2)
 
 
+def resumed_state(state):
+    # target of the resume transition of a session handed over by another node;
+    # the states replies are computed in are left right away, resume after them
+    if state in ('initial', None):
+        return 'WaitPhoneRequest'
+    if state in ('CalculateDistance', 'CalculatePrice'):
+        return 'Traveling'
+    return state
+
+
 class ServerLogic:
+    # one of these per session, so no per-instance __dict__
+    __slots__ = ('_logger', 'name', 'component', 'stm', 'destination', 'escooter_id', 'phone_location', 'gather',
+                 'pushed_report', 'pushed_distance', 'trip_started')
+
     def __init__(self, name, component):
         self._logger = logging.getLogger(__name__)
         self.name = name
         self.component = component
         self.stm = None
         self.destination = None
-
-        self.escooters = []
+        self.escooter_id = None
+        self.phone_location = None
+        # replies to the get_location fan-out, None when answering from the registry
+        self.gather = None
+        # escooter location and remaining distance of the last trip update
+        self.pushed_report = None
+        self.pushed_distance = None
+        # when the trip started, a trip outlasting its reservation is taken for abandoned
+        self.trip_started = None
 
     def send_nearby_escooters(self, phone_location):
-        # send list of dict of escooters with locations and distances
+        # send list of dict of the closest free escooters, sorted by distance
 
         distance = []
         available_escooters = []
 
-        for escooter in self.escooters:
-            if not escooter["busy"]:
-                distance.append(calculate_distance(phone_location, escooter["location"]))
-                available_escooters.append(escooter)
+        nearest = self.component.fleet.nearest(phone_location, k=NEARBY_LIMIT, radius=NEARBY_RADIUS,
+                                               exclude=self.component.reservations.is_reserved)
+        for escooter_distance, escooter_id, escooter_location in nearest:
+            distance.append(escooter_distance)
+            available_escooters.append({"id": escooter_id, "location": escooter_location, "busy": False})
         msg = {
             "command": "escooters_list",
             "escooters": available_escooters,
             "distance": distance
         }
 
-        self.component.publish_message(msg)
-
-    def reserve_escooter(self, escooter_id):
-        for i in range(len(self.escooters)):
-            if escooter_id == self.escooters[i]["id"]:
-                self.escooters[i]["busy"] = self.name
+        self.component.publish_message(msg, phone_topic(self.name))
+
+    def start_gather(self, expected, quorum=GATHER_QUORUM):
+        self.gather = ScatterGather(expected, quorum)
+        return self.gather
+
+    def reply_nearby_escooters(self):
+        # effect of leaving WaitingEscootersLocation, either because enough
+        # escooters answered or because the deadline expired
+        if self.gather is not None:
+            replies = self.gather.close()
+            self._logger.debug('Server {} answers with {} of {} escooter replies'.format(
+                self.name, len(replies), self.gather.expected))
+        self.send_nearby_escooters(self.phone_location)
+
+    def reservation_decided(self, escooter_id, granted):
+        # answer of the ledger that holds the escooter, see ServerManagerComponent.request_reservation
+        if not granted:
+            self.component.publish_message({"command": "reservation_failed", "escooter": escooter_id},
+                                           phone_topic(self.name))
+            return False
+        if self.escooter_id is not None and self.escooter_id != escooter_id:
+            self.component.release_reservation(self.escooter_id, self.name)
+        self.escooter_id = escooter_id
+        self.component.publish_message({"command": "reservation_confirmed", "escooter": escooter_id},
+                                       phone_topic(self.name))
+        return True
+
+    def start_trip(self):
+        # keep the escooter for the whole ride; False if the reservation ran out
+        # while the phone made up its mind, and somebody else took the escooter
+        if not self.component.extend_reservation(self.escooter_id, self.name, TRIP_RESERVATION_TTL):
+            return False
+        self.trip_started = time.monotonic()
+        return True
+
+    def reservation_lost(self):
+        # effect of reservation_lost, the phone gets to choose again from what is free
+        self.component.publish_message({"command": "reservation_failed", "escooter": self.escooter_id},
+                                       phone_topic(self.name))
+        self.escooter_id = None
+        self.send_nearby_escooters(self.phone_location)
+
+    def release_escooter(self):
+        if self.escooter_id is not None:
+            self.component.release_reservation(self.escooter_id, self.name)
+
+    def route_distance(self, origin, destination):
+        # popular origin/destination pairs are answered from the server-wide cache
+        return self.component.quotes.get(origin, destination, calculate_distance)
 
     def receive_destination(self, phone_location, destination):
-        distance = calculate_distance(phone_location, destination)
+        distance = self.route_distance(phone_location, destination)
         price = calculate_price(distance)
-        self.component.publish_message({"command": "suggest_route", "distance": distance, "price": price})
+        self.component.publish_message({"command": "suggest_route", "distance": distance, "price": price},
+                                       phone_topic(self.name))
 
     def price_remaining(self, phone_location):
-        price = round(2 * calculate_distance(phone_location, self.destination), 2)
-        self.component.publish_message({"command": "price_remaining", "price": price})
+        price = round(2 * self.route_distance(phone_location, self.destination), 2)
+        self.component.publish_message({"command": "price_remaining", "price": price}, phone_topic(self.name))
 
     def distance_remaining(self, phone_location):
-        distance = round(calculate_distance(phone_location, self.destination), 2)
-        self.component.publish_message({"command": "distance_remaining", "distance": distance})
+        distance = round(self.route_distance(phone_location, self.destination), 2)
+        self.component.publish_message({"command": "distance_remaining", "distance": distance},
+                                       phone_topic(self.name))
+
+    def start_trip_updates(self):
+        # entry of Traveling
+        interval = self.component.trip_update_interval
+        if interval:
+            self.stm.start_timer('trip_update', int(interval * 1000))
+
+    def push_trip_update(self):
+        # reports are coalesced by the fleet registry; a tick without a new one
+        # since the last push sends nothing, even though position() would keep
+        # extrapolating the escooter along its last reported velocity
+        fleet = self.component.fleet
+        reported = fleet.last_seen(self.escooter_id)
+        if reported is None or self.destination is None or reported == self.pushed_report:
+            return
+        location = fleet.position(self.escooter_id)
+        if location is None:
+            return
+        # live positions bypass the quote cache, they would only push the popular pairs out
+        distance = round(calculate_distance(location, self.destination), 2)
+        self.pushed_report = reported
+        if self.pushed_distance is not None and \
+                abs(distance - self.pushed_distance) < self.component.trip_update_min_change:
+            return
+        self.pushed_distance = distance
+        self.component.publish_message({"command": "trip_update", "distance": distance,
+                                        "price": round(2 * distance, 2)}, phone_topic(self.name))
 
     def send_info_to_escooter(self, destination, price):
-        self.component.publish_message({"command": "receive_route_details", "destination": destination,"price": price})
+        self.component.publish_message({"command": "receive_route_details", "escooter_name": self.escooter_id,
+                                        "server_name": self.name, "destination": destination, "price": price},
+                                       escooter_topic(self.escooter_id))
+
+    def notify_escooter_arrived(self):
+        self.component.publish_message({"command": "destination_reached", "escooter_name": self.escooter_id,
+                                        "server_name": self.name}, escooter_topic(self.escooter_id))
+
+    def release_session(self):
+        # effect of every transition into final
+        self.component.release_session(self.name)
+
+    def end_trip(self):
+        # effect of session_expired during a trip: the escooter is free again, or it stays busy for good
+        self.notify_escooter_arrived()
+        self.release_session()
+
+    def record(self, state):
+        # what it takes to resume this session, on another node or after a restart
+        return {"phone_name": self.name, "state": state, "destination": self.destination,
+                "escooter": self.escooter_id, "location": self.phone_location}
+
+    def hand_off(self, node):
+        # effect of handed_off, the session belongs to `node` now; what the
+        # session holds goes with it, its reservation stays in the ledger
+        self.component.send_to_node(node, dict(self.record(self.stm.state), command="session_handoff"))
+        self.component.forget_session(self.name)
 
 
 
@@ -80,9 +227,9 @@ class ServerManagerComponent:
 
     * Connect to the same broker as the component. You find the broker address
     in the value of the variable `MQTT_BROKER`.
-    * Subscribe to the topic in variable `MQTT_TOPIC_OUTPUT`. On this topic, the
-    component sends its answers.
-    * Send the messages listed below to the topic in variable `MQTT_TOPIC_INPUT`.
+    * Subscribe to your own topic below `MQTT_TOPIC_OUTPUT` (see `topics.py`).
+    On this topic, the component sends the answers meant for you.
+    * Send the messages listed below to your own topic below `MQTT_TOPIC_INPUT`.
 
         {"command": "phone_request", "name": "spaghetti", "duration":50}
 
@@ -90,51 +237,235 @@ class ServerManagerComponent:
 
         {"command": "status_single_timer", "name": "spaghetti"}
 
+    Several components can share the load when each is given its own `node`
+    name. They then form a cluster (see `cluster.py`): the broker splits the
+    phones' messages over the nodes by a shared subscription, and a node passes
+    on whatever belongs to a session another node owns. Escooters' messages
+    reach every node. When nodes join or leave, sessions and reservations that
+    changed owner are handed over to it.
+
+    With `engine='asyncio'` the sessions run on a single event loop instead of
+    pools of threads, see `async_engine.py`; the machines and the commands
+    they get are the same.
+
     """
 
-    def __init__(self):
+    def __init__(self, driver_pool_size=DRIVER_POOL_SIZE, session_ttl=SESSION_TTL,
+                 sweep_interval=SESSION_SWEEP_INTERVAL, worker_pool_size=WORKER_POOL_SIZE,
+                 broker=MQTT_BROKER, port=MQTT_PORT, transport=None, quote_cache_size=QUOTE_CACHE_SIZE,
+                 quote_cell_size=QUOTE_CELL_SIZE, trip_update_interval=TRIP_UPDATE_INTERVAL,
+                 trip_update_min_change=TRIP_UPDATE_MIN_CHANGE, node=None, heartbeat_interval=HEARTBEAT_INTERVAL,
+                 state_dir=None, snapshot_interval=SNAPSHOT_INTERVAL, record=None, engine=THREADS):
         # get the logger object for the component
         self._logger = logging.getLogger(__name__)
         print('logging under name {}.'.format(__name__))
         self._logger.info('Starting Component')
 
-        # create a new MQTT client
-        self._logger.debug('Connecting to MQTT broker {} at port {}'.format(MQTT_BROKER, MQTT_PORT))
-        self.mqtt_client = mqtt.Client()
-        # callback methods
-        self.mqtt_client.on_connect = self.on_connect
-        self.mqtt_client.on_message = self.on_message
-        # Connect to the broker
-        self.mqtt_client.connect(MQTT_BROKER, MQTT_PORT)
-        # subscribe to proper topic(s) of your choice
-        self.mqtt_client.subscribe(MQTT_TOPIC_INPUT)
-        # start the internal loop to process MQTT messages
-        self.mqtt_client.loop_start()
-
-        # we start the stmpy driver, without any state machines for now
+        # counters and histograms of everything below, see metrics.py
+        self.metrics = Metrics()
+
+        # threads or a single asyncio event loop, see async_engine.py
+        if engine not in ENGINES:
+            raise ValueError("Unknown engine {}, expected one of {}".format(engine, ENGINES))
+        self.engine = engine
+        self.event_loop = EventLoopThread() if engine == ASYNCIO else None
+
+        # commands are handled on a pool of workers partitioned by session,
+        # never on the MQTT network thread; or on the event loop
+        self.workers = WorkerPool(worker_pool_size) if engine == THREADS else LoopWorkerPool(self.event_loop)
+        self.dispatcher = CommandDispatcher(self.workers)
+        self._register_handlers()
+
+        # we start a fixed pool of stmpy drivers, without any state machines for now;
+        # every session is pinned to one of them by its phone name. On the event
+        # loop, a single driver without a thread runs them all
+        self.driver_pool = DriverPool(driver_pool_size) if engine == THREADS else LoopDriverPool(self.event_loop)
         self.server_logic = {}
         self.server_stm = {}
         self.stm_driver = {}
 
         # List of escooters
         self.escooters = []
-        # Number of escooters that have responded the message
-        self.counter = defaultdict(int)
+        # Who holds which escooter, shared by all sessions
+        self.reservations = ReservationLedger()
+        # Last known location and busy state of every escooter, kept fresh by
+        # the escooters' own reports so discovery can be answered from memory
+        self.fleet = FleetRegistry()
+        # distances already worked out, by origin and destination cell
+        self.quotes = RouteQuoteCache(quote_cache_size, quote_cell_size)
+        # pushed trip updates, see ServerLogic.push_trip_update
+        self.trip_update_interval = trip_update_interval
+        self.trip_update_min_change = trip_update_min_change
 
         for i in range(NUM_SCOOTERS):
             self.escooters.append(f"escooter_{i + 1}")
 
-    def on_connect(self, client, userdata, flags, rc):
-        # we just log that we are connected
-        self._logger.debug('MQTT connected to {}'.format(client))
-
-    def on_message(self, client, userdata, msg):
+        # ids of what we send, and of what we already handled, see qos.py
+        self.message_ids = MessageIds('server')
+        self.dedup = Deduplicator()
+
+        # wire format spoken by each client, by the topic we answer it on;
+        # clients we have not heard from get the transport's default (JSON)
+        self.client_codecs = {}
+
+        # last activity of every session, idle ones are evicted by the sweeper
+        self.sessions = SessionLifecycle(session_ttl)
+        self._sweep_interval = sweep_interval
+        self._stop_sweeping = threading.Event()
+        self._sweeper = threading.Thread(target=self._sweep_idle_sessions, daemon=True)
+        self._sweeper.start()
+
+        # evaluated only when a snapshot is taken
+        self.metrics.gauge('driver_queue_depths', self.driver_pool.queue_depths)
+        self.metrics.gauge('worker_queue_depths', self.workers.queue_depths)
+        self.metrics.gauge('sessions', self.session_stats)
+        self.metrics.gauge('fleet_size', lambda: len(self.fleet))
+        self.metrics.gauge('quote_cache', self.quotes.stats)
+
+        # snapshots and a journal of the sessions in state_dir, to pick them up again after a restart
+        self.store = None
+        self._journal_transition = None
+        if state_dir is not None:
+            self.store = SessionStore(state_dir, snapshot_interval)
+            self._journal_transition = self.journal_transition
+            self.restore()
+            self._snapshots = threading.Thread(target=self._snapshot_periodically, daemon=True)
+            self._snapshots.start()
+
+        # MQTT to the broker unless we were given another transport, e.g. a
+        # loopback to an escooter gateway in the same process
+        if transport is None:
+            transport = MqttTransport(broker, port) if engine == THREADS else \
+                AsyncioMqttTransport(self.event_loop, broker, port)
+        self.transport = transport
+        if record is not None:
+            # everything in and out goes to a recording, to be replayed later, see replay.py
+            self.transport = RecordingTransport(self.transport, TrafficRecorder(record))
+        self.transport.on_message = self.on_message
+
+        # with a node name we are one server of a cluster
+        self.node = node
+        self.cluster = None
+        # messages for sessions that are still being handed over to us, by session
+        self._parked = {}
+        if node is None:
+            # subscribe to everything phones and escooters send to the server
+            self.transport.subscribe(MQTT_TOPIC_INPUT_ALL)
+        else:
+            self.cluster = ClusterMembership(node, self.transport, self.rebalance, heartbeat_interval)
+            self.metrics.gauge('cluster_members', lambda: self.cluster.members)
+            self.transport.subscribe(MQTT_TOPIC_ESCOOTERS_ALL)
+            self.transport.subscribe(MQTT_TOPIC_GATEWAYS_ALL)
+            self.transport.subscribe(member_topic('+'))
+            self.transport.subscribe(node_topic(node))
+        # start the transport to process incoming messages
+        self.transport.start()
+        if self.cluster is not None:
+            self.cluster.start()
+            # take our share of the phones only once we heard who else is there,
+            # before that we would think we own every session
+            self._join = threading.Timer(2 * heartbeat_interval, self._join_phones)
+            self._join.daemon = True
+            self._join.start()
+
+    def _join_phones(self):
+        self.transport.subscribe(shared_topic(SHARED_GROUP, MQTT_TOPIC_PHONES_ALL))
+        self.transport.subscribe(shared_topic(SHARED_GROUP, MQTT_TOPIC_INPUT))
+        self._logger.info('Node {} takes phones, members {}'.format(self.node, self.cluster.members))
+
+    def restore(self):
+        """Take up the sessions and the fleet as the store has them, before any message comes in."""
+        start = time.perf_counter()
+        sessions, reports = self.store.load()
+        self.fleet.restore(reports)
+        for record in sessions.values():
+            logic = self.resume_session(record)
+            if logic.escooter_id is not None:
+                ttl = TRIP_RESERVATION_TTL if record.get('state') == 'Traveling' else RESERVATION_TTL
+                self.reservations.reserve(logic.escooter_id, logic.name, ttl)
+        self.store.open()
+        self._logger.info('Restored {} sessions and {} escooters in {:.3f}s'.format(
+            len(sessions), len(reports), time.perf_counter() - start))
+
+    def journal_transition(self, machine, source, target):
+        # driver thread; passing through the states replies are computed in changes nothing to resume
+        if resumed_state(source) != resumed_state(target):
+            self.store.append(machine._obj.record(target))
+
+    def snapshot(self):
+        def sessions():
+            return [logic.record(resumed_state(logic.stm.state))
+                    for logic in list(self.server_logic.values()) if logic.stm is not None]
+        start = time.perf_counter()
+        size = self.store.snapshot(sessions, self.fleet.snapshot)
+        self.metrics.observe('snapshot_s', time.perf_counter() - start)
+        self._logger.debug('Snapshot of {} bytes'.format(size))
+
+    def _snapshot_periodically(self):
+        while not self._stop_sweeping.wait(self.store.interval):
+            try:
+                self.snapshot()
+            except OSError as err:
+                self._logger.error('Snapshot failed, the journal keeps growing. {}'.format(err))
+
+    def _sweep_idle_sessions(self):
+        while not self._stop_sweeping.wait(self._sweep_interval):
+            for server_name in self.sessions.expired():
+                if self._on_trip(server_name):
+                    # the phone has nothing to say while traveling, the escooter still moving
+                    # keeps the session alive, for as long as its reservation lasts at most
+                    self.sessions.touch(server_name)
+                    continue
+                self._logger.info(f"Server {server_name} has been idle too long, evicting it")
+                if server_name in self.server_stm:
+                    # let the machine itself go to final, it releases the session on the way
+                    self.stm_driver[server_name].send('session_expired', server_name)
+                else:
+                    self.release_session(server_name)
+            self.reservations.expire()
+            # whatever waited for a handover that never came
+            for server_name, parked in list(self._parked.items()):
+                if parked[0][0] <= time.monotonic() - HANDOFF_GRACE:
+                    self._logger.warning('No handover of {} arrived, dropping {} messages'.format(
+                        server_name, len(parked)))
+                    self._parked.pop(server_name, None)
+            self._logger.info('Sessions: {}'.format(self.session_stats()))
+            self._logger.debug('Metrics: {}'.format(self.metrics.snapshot()))
+
+    def _on_trip(self, server_name):
+        logic = self.server_logic.get(server_name)
+        stm = self.server_stm.get(server_name)
+        return logic is not None and stm is not None and stm.state == 'Traveling' and \
+            logic.trip_started is not None and time.monotonic() - logic.trip_started < TRIP_RESERVATION_TTL and \
+            self.fleet.is_fresh(logic.escooter_id) and self.fleet.is_moving(logic.escooter_id)
+
+    def release_session(self, server_name):
+        # drop everything the server kept for this session
+        if server_name in self.server_logic:
+            self.server_logic[server_name].release_escooter()
+        self.forget_session(server_name)
+
+    def forget_session(self, server_name):
+        reclaimed = approx_size(self.server_logic.get(server_name), self.server_stm.get(server_name))
+        self.server_logic.pop(server_name, None)
+        self.server_stm.pop(server_name, None)
+        self.stm_driver.pop(server_name, None)
+        # released or handed over, the phone's next message tells its format again
+        self.client_codecs.pop(phone_topic(server_name), None)
+        self.sessions.forget(server_name, reclaimed)
+        self._logger.info(f"Server {server_name} released")
+
+    def session_stats(self):
+        return self.sessions.stats()
+
+    def on_message(self, topic, payload, codec):
         """
-        Processes incoming MQTT messages.
+        Processes incoming messages.
 
-        We assume the payload of all received MQTT messages is an UTF-8 encoded
-        string, which is formatted as a JSON object. The JSON object contains
-        a field called `command` which identifies what the message should achieve.
+        The transport has already decoded the message (JSON or the binary format
+        of `codec.py`) into a dict, `codec` tells which one it was, or is None for
+        messages handed over in-process. The dict contains a field called
+        `command` which identifies what the message should achieve.
 
         As a reaction to a received message, we can for example do the following:
 
@@ -144,149 +475,381 @@ class ServerManagerComponent:
         * throw the message away.
 
         """
-        self._logger.debug('Incoming message to topic {}'.format(msg.topic))
+        self._logger.debug('Incoming message to topic {}'.format(topic))
 
-        # unwrap JSON-encoded payload
-        try:
-            payload = json.loads(msg.payload.decode("utf-8"))
-        except Exception as err:
-            self._logger.error('Message sent to topic {} had no valid JSON. Message ignored. {}'.format(msg.topic, err))
-            return
         command = payload.get('command')
         self._logger.debug('Command in message is {}'.format(command))
+        self.metrics.inc('messages_in', command)
 
-        if not command:
-            self._logger.error("Message has no command")
-
-        elif command == "receive_escooter_location":
-            try:
-                escooter_location = payload.get('location')
-                escooter_id = payload.get('escooter_id')
-                escooter_busy = payload.get('escooter_busy')
-                server_name = payload.get('server_name')
-                self.server_logic[server_name].escooters.append(
-                    {"id": escooter_id, "location": escooter_location, "busy": escooter_busy})
-                self.counter[server_name] += 1
-
-                if self.counter[server_name] == len(self.escooters):
-                    phone_location = payload.get('location')
-                    self.server_logic[server_name].send_nearby_escooters(phone_location)
-                    # send trigger to internal transition to move states
-                    self.stm_driver[server_name].send('received_escooters_location', server_name)
-
-            except Exception as err:
-                self._logger.error('Invalid arguments to command. {}'.format(err))
-
-
-        elif command == 'phone_location':  # starting server state machine and first transition
-            try:
-                server_name = payload.get('phone_name')
-                exist = False
-                phone_location = payload.get('location')
-                for server, logic in self.server_logic.items():
-                    if server == server_name:
-                        print("This phone already requested info")
-                        exist = True
-                if not exist:
-                    # create a new instance of the timer logic state machine
-                    self.server_logic[server_name] = ServerLogic(name=server_name, component=self)
-                    self.server_stm[server_name] = self.server_logic[server_name].create_machine(server_name, self)
-                    # add the machine to the driver to start it
-                    self.stm_driver[server_name] = Driver()
-                    self.stm_driver[server_name].start(keep_active=True)
-                    self.stm_driver[server_name].add_machine(self.server_stm[server_name])
-
-                    self._logger.info(f"Server {server_name}, has been started")
-
-                    for escooter in self.escooters:
-                        print("Sent command get location")
-                        self.publish_message(
-                            {"command": "get_location", "escooter_name": escooter, "server_name": server_name,
-                             "phone_location": phone_location})
-
-                    self.stm_driver[server_name].send("exchange_phone_location", server_name)
-            except Exception as err:
-                self._logger.error('Invalid arguments to command. {}'.format(err))
-
-        elif command == 'selected_escooter':
-            try:
-                server_name = payload.get('phone_name')
-                escooter_id = payload.get("escooter")  # save id for calculation later
-                print(payload)
-                self.server_logic[server_name].reserve_escooter(escooter_id)
+        if self.cluster is not None and not self._owned_here(topic, command, payload, codec):
+            return
 
-                self.stm_driver[server_name].send('selected_escooter', server_name)
-            except Exception as err:
-                self._logger.error('Invalid arguments to command. {}'.format(err))
+        if self.dedup.is_duplicate(payload):
+            # delivered again at least once, or resent by the client; it was handled the first time
+            self._logger.debug('Duplicate message {}. Message ignored.'.format(payload.get('msg_id')))
+            self.metrics.inc('duplicates_in', command)
+            return
 
+        # answer every client in the format it last spoke
+        if codec is not None and command not in CLUSTER_COMMANDS:
+            if payload.get('phone_name') is not None:
+                self.client_codecs[phone_topic(payload.get('phone_name'))] = codec
+            elif payload.get('escooter_id') is not None:
+                self.client_codecs[escooter_topic(payload.get('escooter_id'))] = codec
 
+        # any message from a phone keeps its session alive
+        if payload.get('phone_name') in self.server_logic:
+            self.sessions.touch(payload.get('phone_name'))
 
-        elif command == 'exchange_destination':
-            try:
-                server_name = payload.get('phone_name')
-                self.server_logic[server_name].destination = payload.get('destination')
-                self.server_logic[server_name].receive_destination(payload.get('location'),
-                                                                   self.server_logic[server_name].destination)
-                self.stm_driver[server_name].send('received_destination', server_name)
-            except Exception as err:
-                self._logger.error('Invalid arguments to command. {}'.format(err))
-
-        elif command == 'route_confirmed':
-            try:
-                server_name = payload.get('phone_name')
-                confirmed = payload.get('confirm')
-                if confirmed:
-                    price = payload.get("price")
-                    self.server_logic[server_name].send_info_to_escooter(self.server_logic[server_name].destination,
-                                                                         price)
-                    self.stm_driver[server_name].send('route_accepted', server_name)
-                else:
-                    self.stm_driver[server_name].send('route_declined', server_name)
-            except Exception as err:
-                self._logger.error('Invalid arguments to command. {}'.format(err))
+        if not command:
+            self._logger.error("Message has no command")
 
-        elif command == "ask_price":
-            try:
-                server_name = payload.get('phone_name')
-                self.stm_driver[server_name].send('price_requested', server_name)
-                phone_location = payload.get('location')
-                self.server_logic[server_name].price_remaining(phone_location)
-            except Exception as err:
-                self._logger.error('Invalid arguments to command. {}'.format(err))
-
-        elif command == "ask_distance":
-            try:
-                server_name = payload.get('phone_name')
-                self.stm_driver[server_name].send('distance_requested', server_name)
-                self.server_logic[server_name].distance_remaining(payload.get("location"))
-            except Exception as err:
-                self._logger.error('Invalid arguments to command. {}'.format(err))
+        elif command in self.dispatcher and self.cluster is not None and \
+                self.dispatcher.key_field(command) == 'phone_name':
+            # as above, but the session may still be on its way from another node
+            if not self.workers.submit(payload.get('phone_name'), self._run_session_command, command, payload):
+                self.dedup.forget(payload)
 
-        elif command == "destination_reached":
-            try:
-                server_name = payload.get('phone_name')
-                self.stm_driver[server_name].send("destination_reached", server_name)
-                self.server_logic.pop(server_name)
-            except Exception as err:
-                self._logger.error('Invalid arguments to command. {}'.format(err))
+        elif command in self.dispatcher:
+            # hand over to the worker that owns this session, so the network
+            # thread can go back to reading packets right away; a job dropped
+            # from a full queue is taken when the client sends it again
+            if not self.dispatcher.dispatch(command, payload):
+                self.dedup.forget(payload)
 
         else:
             self._logger.error('Unknown command {}. Message ignored.'.format(command))
 
-    def publish_message(self, msg):
-
-        payload = json.dumps(msg)
-        self.mqtt_client.publish(MQTT_TOPIC_OUTPUT, payload=payload, qos=2)
+    def _owned_here(self, topic, command, payload, codec):
+        # whether this node handles the message, passing it on to the node that should
+        if command == 'node_heartbeat':
+            self.cluster.on_heartbeat(payload.get('node'))
+            return False
+        if command == 'node_leave':
+            self.cluster.on_leave(payload.get('node'))
+            return False
+        if topic == node_topic(self.node) or command not in self.dispatcher:
+            # sent to us in particular
+            return True
+        key_field = self.dispatcher.key_field(command)
+        if key_field not in ('phone_name', 'server_name'):
+            # escooter telemetry, every node keeps the whole fleet
+            return True
+        owner = self.cluster.owner(payload.get(key_field))
+        if owner == self.node:
+            return True
+        if key_field == 'phone_name':
+            # the broker gave us a phone's message for a session of another node;
+            # in the format the phone sent, so the owner answers it in that format
+            self.transport.publish(node_topic(owner), payload, qos=qos_for(command), codec=codec)
+            self.metrics.inc('forwarded', command)
+        # escooters' messages reach every node, the owner has its own copy
+        return False
+
+    def _run_session_command(self, command, payload):
+        # worker of the session; a session that changed node may not have been handed over yet
+        server_name = payload.get('phone_name')
+        if command != 'phone_location' and command not in CLUSTER_COMMANDS and server_name not in self.server_logic and \
+                time.monotonic() - self.cluster.changed_at < HANDOFF_GRACE:
+            self._parked.setdefault(server_name, []).append((time.monotonic(), command, payload))
+            return
+        self.dispatcher.handler(command)(payload)
+
+    def send_to_node(self, node, msg):
+        self.publish_message(msg, node_topic(node))
+
+    def _remote_owner(self, key):
+        # the node responsible for key if that is another one, None if it is us or there is no cluster
+        if self.cluster is None:
+            return None
+        owner = self.cluster.owner(key)
+        return None if owner == self.node else owner
+
+    def rebalance(self, members):
+        """Hand sessions and reservations that belong to another node now over to it."""
+        for server_name in list(self.server_logic):
+            owner = self._remote_owner(server_name)
+            driver = self.stm_driver.get(server_name)
+            if owner is not None and driver is not None:
+                # the machine hands itself over, between two of its transitions
+                driver.send('handed_off', server_name, args=[owner])
+        for escooter_id, holder, ttl in self.reservations.take(lambda escooter_id: self._remote_owner(escooter_id)):
+            self.send_to_node(self.cluster.owner(escooter_id), {"command": "reservation_handoff",
+                                                               "escooter": escooter_id, "phone_name": holder,
+                                                               "ttl": ttl})
+
+    def request_reservation(self, server_name, escooter_id):
+        # an escooter's reservations are kept by the node it hashes to, a cluster of one keeps them all
+        owner = self._remote_owner(escooter_id)
+        if owner is None:
+            self.reservation_decided(server_name, escooter_id, self.reservations.reserve(escooter_id, server_name))
+        else:
+            self.send_to_node(owner, {"command": "reservation_request", "escooter": escooter_id,
+                                      "phone_name": server_name, "node": self.node})
+
+    def reservation_decided(self, server_name, escooter_id, granted):
+        logic = self.server_logic.get(server_name)
+        if logic is None:
+            # the session went away while the ledger was asked
+            if granted:
+                self.release_reservation(escooter_id, server_name)
+            return
+        if logic.reservation_decided(escooter_id, granted):
+            self.stm_driver[server_name].send('selected_escooter', server_name)
+        else:
+            # somebody else was faster, offer what is still free
+            logic.send_nearby_escooters(logic.phone_location)
+
+    def extend_reservation(self, escooter_id, holder, ttl):
+        # a reservation that ran out is taken again if the escooter is still free; another
+        # node keeping the ledger does the same, we do not wait for it
+        owner = self._remote_owner(escooter_id)
+        if owner is None:
+            return self.reservations.extend(escooter_id, holder, ttl) or \
+                self.reservations.reserve(escooter_id, holder, ttl)
+        self.send_to_node(owner, {"command": "reservation_extend", "escooter": escooter_id,
+                                  "phone_name": holder, "ttl": ttl})
+        return True
+
+    def release_reservation(self, escooter_id, holder):
+        owner = self._remote_owner(escooter_id)
+        if owner is None:
+            self.reservations.release(escooter_id, holder)
+        else:
+            self.send_to_node(owner, {"command": "reservation_release", "escooter": escooter_id,
+                                      "phone_name": holder})
+
+    def _register_handlers(self):
+        # command -> (handler, field holding the session key)
+        self.dispatcher.register("receive_escooter_location", self.on_receive_escooter_location, 'server_name')
+        self.dispatcher.register("escooter_report", self.on_escooter_report, 'escooter_id')
+        self.dispatcher.register("escooter_report_batch", self.on_escooter_report_batch, 'gateway')
+        self.dispatcher.register("gateway_reset", self.on_gateway_reset, 'gateway')
+        self.dispatcher.register("phone_location", self.on_phone_location, 'phone_name')
+        self.dispatcher.register("selected_escooter", self.on_selected_escooter, 'phone_name')
+        self.dispatcher.register("exchange_destination", self.on_exchange_destination, 'phone_name')
+        self.dispatcher.register("route_confirmed", self.on_route_confirmed, 'phone_name')
+        self.dispatcher.register("ask_price", self.on_ask_price, 'phone_name')
+        self.dispatcher.register("ask_distance", self.on_ask_distance, 'phone_name')
+        self.dispatcher.register("destination_reached", self.on_destination_reached, 'phone_name')
+        self.dispatcher.register("out_of_route", self.on_route_deviation, 'server_name')
+        self.dispatcher.register("back_on_route", self.on_route_deviation, 'server_name')
+        # from the other nodes of a cluster
+        self.dispatcher.register("session_handoff", self.on_session_handoff, 'phone_name')
+        self.dispatcher.register("reservation_request", self.on_reservation_request, 'escooter')
+        self.dispatcher.register("reservation_result", self.on_reservation_result, 'phone_name')
+        self.dispatcher.register("reservation_extend", self.on_reservation_extend, 'escooter')
+        self.dispatcher.register("reservation_release", self.on_reservation_release, 'escooter')
+        self.dispatcher.register("reservation_handoff", self.on_reservation_handoff, 'escooter')
+
+    def on_receive_escooter_location(self, payload):
+        escooter_location = payload.get('location')
+        escooter_id = payload.get('escooter_id')
+        escooter_busy = bool(payload.get('busy'))
+        server_name = payload.get('server_name')
+        self.fleet.report(escooter_id, escooter_location, escooter_busy)
+
+        logic = self.server_logic.get(server_name)
+        if logic is None or logic.gather is None:
+            # late reply to a session that already answered or is gone
+            return
+        reply = {"id": escooter_id, "location": escooter_location, "busy": escooter_busy}
+        if logic.gather.add(escooter_id, reply):
+            # quorum reached before the deadline, move on right away
+            self.stm_driver[server_name].send('received_escooters_location', server_name)
+
+    def on_escooter_report(self, payload):
+        self.fleet.report(payload.get('escooter_id'), payload.get('location'), payload.get('busy'))
+
+    def on_escooter_report_batch(self, payload):
+        # [escooter_id, location, busy, velocity] for every escooter of the gateway that had to report
+        now = time.monotonic()
+        for escooter_id, location, busy, velocity in payload.get('reports', []):
+            self.fleet.report(escooter_id, location, busy, now, velocity)
+
+    def on_gateway_reset(self, payload):
+        # a gateway started over, the trips on its escooters are gone: end the sessions we have on
+        # them, and release the reservations we keep whoever holds them
+        escooters = set(payload.get('escooters', []))
+        for server_name, logic in list(self.server_logic.items()):
+            if logic.escooter_id in escooters:
+                self.stm_driver[server_name].send('session_expired', server_name)
+        for escooter_id in escooters:
+            holder = self.reservations.holder(escooter_id) if self._remote_owner(escooter_id) is None else None
+            if holder is not None:
+                self.reservations.release(escooter_id, holder)
+        self._logger.warning('Gateway {} started over with {} escooters'.format(payload.get('gateway'),
+                                                                                len(escooters)))
+
+    def start_session(self, server_name):
+        # create a new instance of the timer logic state machine
+        self.server_logic[server_name] = ServerLogic(name=server_name, component=self)
+        self.server_stm[server_name] = self.server_logic[server_name].create_machine(server_name, self)
+        # add the machine to its driver in the pool to start it
+        self.stm_driver[server_name] = self.driver_pool.add_machine(server_name, self.server_stm[server_name])
+        self.sessions.touch(server_name)
+
+        self._logger.info(f"Server {server_name}, has been started")
+        return self.server_logic[server_name]
+
+    def resume_session(self, record):
+        # a session of ServerLogic.record, started again in the state it had
+        logic = self.start_session(record.get('phone_name'))
+        logic.destination = record.get('destination')
+        logic.escooter_id = record.get('escooter')
+        logic.phone_location = record.get('location')
+        if resumed_state(record.get('state')) == 'Traveling':
+            # we cannot tell when the trip started, it gets the time of a whole trip from here
+            logic.trip_started = time.monotonic()
+        self.stm_driver[logic.name].send('resume', logic.name, args=[record.get('state')])
+        return logic
+
+    def on_phone_location(self, payload):
+        # starting server state machine and first transition
+        server_name = payload.get('phone_name')
+        phone_location = payload.get('location')
+        if server_name in self.server_logic:
+            print("This phone already requested info")
+            return
 
-    def stop(self, server_name):
+        self.start_session(server_name)
+        self.server_logic[server_name].phone_location = phone_location
+        if self.fleet.has_fresh():
+            # the registry is warm, answer straight from memory
+            self.stm_driver[server_name].send("exchange_phone_location", server_name)
+            self.stm_driver[server_name].send('received_escooters_location', server_name)
+        else:
+            # cold start, nobody has reported yet: ask every escooter and
+            # answer with whatever arrived by the deadline
+            self.server_logic[server_name].start_gather(len(self.escooters))
+            for escooter in self.escooters:
+                print("Sent command get location")
+                self.publish_message(
+                    {"command": "get_location", "escooter_name": escooter, "server_name": server_name,
+                     "phone_location": phone_location}, escooter_topic(escooter))
+
+            self.stm_driver[server_name].send("exchange_phone_location", server_name)
+
+    def on_selected_escooter(self, payload):
+        server_name = payload.get('phone_name')
+        escooter_id = payload.get("escooter")  # save id for calculation later
+        print(payload)
+        self.request_reservation(server_name, escooter_id)
+
+    def on_exchange_destination(self, payload):
+        server_name = payload.get('phone_name')
+        self.server_logic[server_name].destination = payload.get('destination')
+        self.server_logic[server_name].receive_destination(payload.get('location'),
+                                                           self.server_logic[server_name].destination)
+        self.stm_driver[server_name].send('received_destination', server_name)
+
+    def on_route_confirmed(self, payload):
+        server_name = payload.get('phone_name')
+        confirmed = payload.get('confirm')
+        if confirmed:
+            price = payload.get("price")
+            if not self.server_logic[server_name].start_trip():
+                self.stm_driver[server_name].send('reservation_lost', server_name)
+                return
+            self.server_logic[server_name].send_info_to_escooter(self.server_logic[server_name].destination, price)
+            self.stm_driver[server_name].send('route_accepted', server_name)
+        else:
+            self.stm_driver[server_name].send('route_declined', server_name)
+
+    def on_ask_price(self, payload):
+        server_name = payload.get('phone_name')
+        self.stm_driver[server_name].send('price_requested', server_name)
+        phone_location = payload.get('location')
+        self.server_logic[server_name].price_remaining(phone_location)
+        self.stm_driver[server_name].send('send_price', server_name)
+
+    def on_ask_distance(self, payload):
+        server_name = payload.get('phone_name')
+        self.stm_driver[server_name].send('distance_requested', server_name)
+        self.server_logic[server_name].distance_remaining(payload.get("location"))
+        self.stm_driver[server_name].send('send_distance', server_name)
+
+    def on_destination_reached(self, payload):
+        server_name = payload.get('phone_name')
+        self.server_logic[server_name].notify_escooter_arrived()
+        # the session is released when the machine reaches final
+        self.stm_driver[server_name].send("destination_reached", server_name)
+
+    def on_route_deviation(self, payload):
+        # the escooter only reports changes, leaving its route or getting back on it
+        server_name = payload.get('server_name')
+        if server_name not in self.server_logic:
+            self._logger.debug('{} for unknown server {}. Message ignored.'.format(payload.get('command'), server_name))
+            return
+        self._logger.info(f"Server {server_name}: escooter {payload.get('escooter_id')} {payload.get('command')}")
+        self.publish_message({"command": payload.get('command'), "escooter": payload.get('escooter_id')},
+                             phone_topic(server_name))
+
+    def on_session_handoff(self, payload):
+        # a session that another node had until the cluster changed
+        server_name = payload.get('phone_name')
+        if server_name in self.server_logic:
+            self._logger.warning(f"Server {server_name} handed over, but we already have it")
+            return
+        self.resume_session(payload)
+        self._logger.info(f"Server {server_name} taken over in state {payload.get('state')}")
+        # what the phone sent while the session was on its way
+        for _, command, parked in self._parked.pop(server_name, []):
+            self.dispatcher.handler(command)(parked)
+
+    def on_reservation_request(self, payload):
+        granted = self.reservations.reserve(payload.get('escooter'), payload.get('phone_name'))
+        self.send_to_node(payload.get('node'), {"command": "reservation_result", "escooter": payload.get('escooter'),
+                                                "phone_name": payload.get('phone_name'), "granted": granted})
+
+    def on_reservation_result(self, payload):
+        self.reservation_decided(payload.get('phone_name'), payload.get('escooter'), payload.get('granted'))
+
+    def on_reservation_extend(self, payload):
+        if not self.extend_reservation(payload.get('escooter'), payload.get('phone_name'), payload.get('ttl')):
+            self._logger.warning('Reservation of {} by {} ran out and the escooter was taken'.format(
+                payload.get('escooter'), payload.get('phone_name')))
+
+    def on_reservation_release(self, payload):
+        self.reservations.release(payload.get('escooter'), payload.get('phone_name'))
+
+    def on_reservation_handoff(self, payload):
+        self.reservations.reserve(payload.get('escooter'), payload.get('phone_name'), ttl=payload.get('ttl'))
+
+    def publish_message(self, msg, topic):
+        qos = self.message_ids.stamp(msg)
+        start = time.perf_counter()
+        self.transport.publish(topic, msg, qos=qos, codec=self.client_codecs.get(topic))
+        self.metrics.observe('publish_s', time.perf_counter() - start, msg.get('command'))
+        self.metrics.inc('messages_out', msg.get('command'))
+
+    def stop(self):
         """
         Stop the component.
         """
-        # stop the MQTT client
-        self.mqtt_client.loop_stop()
-
-        # stop the state machine Driver
-        self.stm_driver[server_name].stop()
+        if self.cluster is not None:
+            # leave the cluster and wait until the sessions went to the others
+            self._join.cancel()
+            self.cluster.leave()
+            self.rebalance(self.cluster.members)
+            deadline = time.monotonic() + HANDOFF_TIMEOUT
+            while self.server_logic and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.cluster.stop()
+
+        # stop the transport
+        self.transport.stop()
+
+        # stop the idle-session sweeper, the workers and the state machine drivers
+        self._stop_sweeping.set()
+        self.workers.stop()
+        if self.store is not None:
+            # what is left is taken up again by the next start
+            self.snapshot()
+            self.store.close()
+        self.driver_pool.stop()
+        if self.event_loop is not None:
+            self.event_loop.stop()
 
 
 def create_machine(self, server_name, component):
@@ -343,7 +906,7 @@ def create_machine(self, server_name, component):
         "target": "Traveling"
     }
     t9 = {
-        "trigger": "price_requested",
+        "trigger": "send_price",
         "source": "CalculatePrice",
         "target": "Traveling"
     }
@@ -352,12 +915,44 @@ def create_machine(self, server_name, component):
     t10 = {
         "trigger": "destination_reached",
         "source": "Traveling",
-        "target": "final"
+        "target": "final",
+        "effect": "release_session"
     }
     t11 = {
         "trigger": "received_escooters_location",
         "source": "WaitingEscootersLocation",
-        "target": "SearchForNearbyEscooters"
+        "target": "SearchForNearbyEscooters",
+        "effect": "stop_timer('gather_deadline'); reply_nearby_escooters"
+    }
+    # WaitingEscootersLocation -> SearchForNearbyEscooters with whatever arrived
+    t12 = {
+        "trigger": "gather_deadline",
+        "source": "WaitingEscootersLocation",
+        "target": "SearchForNearbyEscooters",
+        "effect": "reply_nearby_escooters"
+    }
+    WaitingEscootersLocation = {"name": "WaitingEscootersLocation",
+                                "entry": "start_timer('gather_deadline', {})".format(GATHER_DEADLINE_MS)}
+    # Traveling -> Traveling, push the remaining distance and price to the phone
+    t13 = {
+        "trigger": "trip_update",
+        "source": "Traveling",
+        "target": "Traveling",
+        "effect": "push_trip_update"
+    }
+    Traveling = {"name": "Traveling", "entry": "start_trip_updates", "exit": "stop_timer('trip_update')"}
+    # AwaitRouteConfirmation -> SearchForNearbyEscooters, the reservation ran out and the escooter was taken
+    t15 = {
+        "trigger": "reservation_lost",
+        "source": "AwaitRouteConfirmation",
+        "target": "SearchForNearbyEscooters",
+        "effect": "reservation_lost"
+    }
+    # WaitPhoneRequest -> wherever the session was on the node that handed it over
+    t14 = {
+        "trigger": "resume",
+        "source": "WaitPhoneRequest",
+        "function": resumed_state
     }
     """
     # States
@@ -372,7 +967,21 @@ def create_machine(self, server_name, component):
     Traveling = {"name": "Traveling", 
                     "entry": "send_price; send_route" }
     """
-    server_stm = Machine(name=server_name, transitions=[t0, t1, t2, t3, t4, t5, t6, t7, t8, t9, t10, t11], obj=self)
+    # any state -> final when the session has been idle for too long
+    states = ["WaitPhoneRequest", "WaitingEscootersLocation", "SearchForNearbyEscooters", "AwaitDestination",
+              "AwaitRouteConfirmation", "Traveling", "CalculateDistance", "CalculatePrice"]
+    expired = [{"trigger": "session_expired", "source": state, "target": "final",
+                "effect": "end_trip" if state in ("Traveling", "CalculateDistance", "CalculatePrice")
+                else "release_session"}
+               for state in states]
+    # any state -> final when the session moved to another node of the cluster
+    handed_off = [{"trigger": "handed_off", "source": state, "target": "final", "effect": "hand_off(*)"}
+                  for state in states]
+    server_stm = InstrumentedMachine(name=server_name,
+                                     transitions=[t0, t1, t2, t3, t4, t5, t6, t7, t8, t9, t10, t11, t12, t13, t14, t15]
+                                     + expired + handed_off,
+                                     states=[WaitingEscootersLocation, Traveling], obj=self, metrics=component.metrics,
+                                     kind='server', table_key='server', on_transition=component._journal_transition)
     self.stm = server_stm
     return server_stm
 
@@ -380,6 +989,22 @@ def create_machine(self, server_name, component):
 ServerLogic.create_machine = create_machine
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scooters', type=int, default=0,
+                        help='also run an escooter gateway with this many escooters in this process')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve JSON metrics snapshots over HTTP on this port')
+    parser.add_argument('--state-dir', default=None,
+                        help='keep snapshots of the sessions here and take them up again on start')
+    parser.add_argument('--record', default=None,
+                        help='record every message in and out to this file, see replay.py')
+    parser.add_argument('--engine', choices=ENGINES, default=THREADS,
+                        help='run the sessions on threads or on one asyncio event loop, see async_engine.py')
+    parser.add_argument('--node', default=None,
+                        help='name of this server in a cluster of servers sharing the load, see cluster.py')
+    args = parser.parse_args()
+
     # logging.DEBUG: Most fine-grained logging, printing everything
     # logging.INFO:  Only the most important informational log items
     # logging.WARN:  Show only warnings and errors.
@@ -393,10 +1018,25 @@ if __name__ == '__main__':
     ch.setFormatter(formatter)
     logger.addHandler(ch)
 
-    s = ServerManagerComponent()
+    if args.scooters:
+        # co-located gateway: server <-> escooters stay in-process, phones go through the broker
+        bus = LoopbackBus()
+        s = ServerManagerComponent(transport=LocalFirstTransport(LoopbackTransport(bus),
+                                                                 MqttTransport(MQTT_BROKER, MQTT_PORT)),
+                                   node=args.node, state_dir=args.state_dir, record=args.record,
+                                   engine=args.engine)
+        from scooter import ScooterManagerComponent
+        gateway = ScooterManagerComponent(args.scooters, transport=LoopbackTransport(bus))
+    else:
+        s = ServerManagerComponent(node=args.node, state_dir=args.state_dir, record=args.record,
+                                   engine=args.engine)
+    if args.metrics_port is not None:
+        serve_metrics(s.metrics, args.metrics_port)
 
     try:
         input("Server is running. Press Enter to exit.\n")
+        # in a cluster, the other nodes take over our sessions
+        s.stop()
     except Exception as e:
         raise ValueError("Error", e)
 
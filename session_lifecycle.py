@@ -0,0 +1,94 @@
+import heapq
+import sys
+import threading
+import time
+
+# a session with no phone activity for this long is evicted, unless it is traveling
+# on an escooter that is still moving (see ServerManagerComponent._on_trip)
+SESSION_TTL = 600
+# how often the server looks for idle sessions
+SESSION_SWEEP_INTERVAL = 30
+
+
+def approx_size(*objects):
+    # shallow estimate: the objects, their attributes and the items of any
+    # container attribute, good enough to report what a session held on to
+    total = 0
+    for obj in objects:
+        total += sys.getsizeof(obj)
+        if hasattr(obj, "__dict__"):
+            values = obj.__dict__.values()
+        else:
+            values = [getattr(obj, name, None) for name in getattr(type(obj), "__slots__", ())]
+        for value in values:
+            total += sys.getsizeof(value)
+            if isinstance(value, (list, tuple, set, dict)):
+                for item in value:
+                    total += sys.getsizeof(item)
+    return total
+
+
+class SessionLifecycle:
+    """
+    Keeps track of when each session was last active.
+
+    There is one heap entry per session holding the deadline it had when the
+    entry was pushed. Activity only updates a timestamp; when an entry comes out
+    of the heap for a session that was active since, it is pushed back with the
+    new deadline instead of being treated as expired. An expired session is
+    pushed back too, a ttl later, so it is asked to go again if it is still
+    there then; only `forget` drops it for good.
+    """
+
+    def __init__(self, ttl=SESSION_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._last_active = {}
+        self._deadlines = []
+        self.released_sessions = 0
+        self.reclaimed_bytes = 0
+
+    def __len__(self):
+        return len(self._last_active)
+
+    def __contains__(self, name):
+        return name in self._last_active
+
+    def touch(self, name, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if name not in self._last_active:
+                heapq.heappush(self._deadlines, (now + self.ttl, name))
+            self._last_active[name] = now
+
+    def forget(self, name, reclaimed_bytes=0):
+        with self._lock:
+            if self._last_active.pop(name, None) is not None:
+                self.released_sessions += 1
+                self.reclaimed_bytes += reclaimed_bytes
+
+    def expired(self, now=None):
+        now = time.monotonic() if now is None else now
+        names = []
+        with self._lock:
+            retry = []
+            while self._deadlines and self._deadlines[0][0] <= now:
+                _, name = heapq.heappop(self._deadlines)
+                last_active = self._last_active.get(name)
+                if last_active is None:
+                    # released in the meantime
+                    continue
+                if last_active + self.ttl > now:
+                    heapq.heappush(self._deadlines, (last_active + self.ttl, name))
+                else:
+                    names.append(name)
+                    # in case the eviction gets lost on its way
+                    retry.append((now + self.ttl, name))
+            for deadline in retry:
+                heapq.heappush(self._deadlines, deadline)
+        return names
+
+    def stats(self):
+        return {"live_sessions": len(self._last_active),
+                "released_sessions": self.released_sessions,
+                "reclaimed_bytes": self.reclaimed_bytes}
@@ -0,0 +1,182 @@
+import logging
+import os
+import struct
+import threading
+import time
+from array import array
+
+from codec import CodecError, CODECS, BINARY
+
+# seconds between two snapshots
+SNAPSHOT_INTERVAL = 60
+SNAPSHOT_FILE = 'snapshot.bin'
+JOURNAL_FILE = 'journal.bin'
+# the journal of the previous snapshot, until the next one is safely on disk
+PREVIOUS_JOURNAL_FILE = 'journal.prev.bin'
+
+# every journal record is its length followed by a message in the binary format of codec.py
+_length = struct.Struct('<I')
+
+
+class SessionStore:
+    """
+    What the server needs to pick up its sessions again after a restart.
+
+    A snapshot holds every session (state, destination, escooter, phone
+    location) and the fleet registry. Between two snapshots, every time a
+    session changes state its whole record is appended to a journal, so
+    replaying the journal over the last snapshot gives each session's latest
+    record. Records and the sessions of a snapshot use the binary format of
+    `codec.py`; the fleet, which can be many times larger, is stored column by
+    column as plain arrays, so it loads without decoding every report.
+
+    Taking a snapshot starts a new journal first and only then collects the
+    sessions, so a change made while collecting lands in the new journal and
+    is replayed after the snapshot; replaying a record twice is harmless.
+    """
+
+    def __init__(self, directory, interval=SNAPSHOT_INTERVAL):
+        self._logger = logging.getLogger(__name__)
+        self.directory = directory
+        self.interval = interval
+        self._codec = CODECS[BINARY]
+        self._lock = threading.Lock()
+        self._journal = None
+        self.records = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def load(self):
+        """Returns (sessions by name, fleet reports) as of the last record written, before anything is appended."""
+        sessions = {}
+        reports = []
+        snapshot = self._read_file(SNAPSHOT_FILE)
+        if snapshot:
+            header, ids, numbers, busy = self._split(snapshot)
+            state = self._codec.decode(header)
+            for record in state.get("sessions", []):
+                sessions[record["phone_name"]] = record
+            reports = self._fleet_reports(state, ids, numbers, busy)
+        for name in (PREVIOUS_JOURNAL_FILE, JOURNAL_FILE):
+            for record in self._read_records(name):
+                if record.get("state") == 'final':
+                    sessions.pop(record.get("phone_name"), None)
+                else:
+                    sessions[record.get("phone_name")] = record
+        return sessions, reports
+
+    @staticmethod
+    def _split(data):
+        parts = []
+        i = 0
+        while i < len(data):
+            n = _length.unpack_from(data, i)[0]
+            parts.append(data[i + _length.size:i + _length.size + n])
+            i += _length.size + n
+        return parts
+
+    @staticmethod
+    def _fleet_columns(reports):
+        # ids, then x, y, vx, vy and age of every report as doubles, then the busy flags
+        ids = "\n".join(report[0] for report in reports).encode("utf-8")
+        numbers = array('d')
+        for _, location, _, velocity, age in reports:
+            numbers.extend((location[0], location[1]) + (tuple(velocity) if velocity else (0.0, 0.0)) + (age,))
+        busy = bytes(bool(report[2]) for report in reports)
+        return ids, numbers.tobytes(), busy
+
+    @staticmethod
+    def _fleet_reports(state, ids, numbers, busy):
+        if not state.get("escooters"):
+            return []
+        columns = array('d')
+        columns.frombytes(numbers)
+        # the fleet has aged while we were down
+        downtime = max(0.0, time.time() - state["time"])
+        return [[escooter_id, (x, y), bool(is_busy), (vx, vy) if vx or vy else None, age + downtime]
+                for escooter_id, x, y, vx, vy, age, is_busy in
+                zip(ids.decode("utf-8").split("\n"), columns[0::5], columns[1::5], columns[2::5], columns[3::5],
+                    columns[4::5], busy)]
+
+    def _read_file(self, name):
+        try:
+            with open(self._path(name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return b''
+
+    def _read_records(self, name):
+        return self._scan(name, self._read_file(name))[0]
+
+    def _scan(self, name, data):
+        # the records in data, and where the last complete one ends
+        records = []
+        i = 0
+        while i + _length.size <= len(data):
+            n = _length.unpack_from(data, i)[0]
+            if i + _length.size + n > len(data):
+                # cut off by a crash in the middle of a write
+                self._logger.warning('Journal {} ends in a partial record'.format(name))
+                break
+            try:
+                records.append(self._codec.decode(data[i + _length.size:i + _length.size + n]))
+            except (CodecError, IndexError) as err:
+                self._logger.error('Journal {} has an invalid record, stopping there. {}'.format(name, err))
+                break
+            i += _length.size + n
+        return records, i
+
+    def open(self):
+        # drop whatever follows the last complete record, appending after it would garble the rest
+        _, end = self._scan(JOURNAL_FILE, self._read_file(JOURNAL_FILE))
+        with self._lock:
+            self._journal = open(self._path(JOURNAL_FILE), 'ab')
+            self._journal.truncate(end)
+
+    def append(self, record):
+        data = self._codec.encode(record)
+        with self._lock:
+            if self._journal is None:
+                return
+            self._journal.write(_length.pack(len(data)) + data)
+            # into the OS right away, so a crash of the process loses nothing
+            self._journal.flush()
+            self.records += 1
+
+    def snapshot(self, sessions, reports):
+        """
+        Write a snapshot. `sessions` and `reports` are called after the journal
+        was rotated and return the session records and the fleet reports.
+        """
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+            # after a snapshot that did not make it to disk the previous journal
+            # is still needed, the current one goes after it
+            with open(self._path(PREVIOUS_JOURNAL_FILE), 'ab') as previous:
+                previous.write(self._read_file(JOURNAL_FILE))
+            self._journal = open(self._path(JOURNAL_FILE), 'wb')
+            self.records = 0
+        reports = reports()
+        header = self._codec.encode({"time": time.time(), "sessions": sessions(), "escooters": len(reports)})
+        data = b''.join(_length.pack(len(part)) + part for part in (header,) + self._fleet_columns(reports))
+        tmp = self._path(SNAPSHOT_FILE + '.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path(SNAPSHOT_FILE))
+        # the snapshot covers everything the previous journal had
+        try:
+            os.remove(self._path(PREVIOUS_JOURNAL_FILE))
+        except FileNotFoundError:
+            pass
+        return len(data)
+
+    def close(self):
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
@@ -0,0 +1,39 @@
+import logging
+import threading
+
+from stmpy import Machine
+
+# table_key -> (initial transition, transition table, states) parsed once
+_TABLES = {}
+_tables_lock = threading.Lock()
+
+
+class SharedTableMachine(Machine):
+    """
+    stmpy Machine that shares its parsed transitions with every other machine
+    of the same `table_key`.
+
+    stmpy parses the transitions and states of each machine into its own table
+    of transition objects, which is most of what a machine weighs. The parsed
+    table is never changed afterwards, so machines that are created from the
+    same definition over and over (one per session or per escooter) can all use
+    the table of the first one. Without a `table_key` it is a plain Machine.
+    """
+
+    def __init__(self, name, transitions, obj, states=[], table_key=None):
+        if table_key is None:
+            super().__init__(name=name, transitions=transitions, obj=obj, states=states)
+            return
+        with _tables_lock:
+            shared = _TABLES.get(table_key)
+            if shared is None:
+                super().__init__(name=name, transitions=transitions, obj=obj, states=states)
+                _TABLES[table_key] = (self._intial_transition, self._table, self._states)
+                return
+        # what Machine.__init__ sets up, minus the parsing
+        self._logger = logging.getLogger('stmpy')
+        self._state = 'initial'
+        self._obj = obj
+        self._id = name
+        self._intial_transition, self._table, self._states = shared
+        self._defer_queue = None
@@ -0,0 +1,164 @@
+import heapq
+import math
+import threading
+
+# side of a grid cell, in the same units as the scooter coordinates
+GRID_CELL_SIZE = 5.0
+
+
+def grid_distance(source, destination):
+    # same metric as server.calculate_distance, kept here so the index has no
+    # dependency on the server module
+    return round((abs(destination[0] - source[0]) + abs(destination[1] - source[1])) / 2, 2)
+
+
+class GridIndex:
+    """
+    Uniform grid over the scooter fleet.
+
+    Every scooter is stored in the cell that contains its last known location.
+    Nearest-neighbour queries walk the cells in rings around the query point and
+    stop as soon as no unvisited ring can hold anything closer than the k-th
+    candidate found so far, so a query only touches the cells around the phone
+    instead of the whole fleet.
+    """
+
+    def __init__(self, cell_size=GRID_CELL_SIZE):
+        self.cell_size = float(cell_size)
+        self._lock = threading.Lock()
+        # cell -> {escooter_id: (location, busy)}
+        self._cells = {}
+        # escooter_id -> cell
+        self._cell_of = {}
+        # bounding box of occupied cells, used to know when to stop walking rings
+        self._bounds = None
+
+    def __len__(self):
+        return len(self._cell_of)
+
+    def __contains__(self, escooter_id):
+        return escooter_id in self._cell_of
+
+    def _cell(self, location):
+        return (math.floor(location[0] / self.cell_size), math.floor(location[1] / self.cell_size))
+
+    def update(self, escooter_id, location, busy=False):
+        cell = self._cell(location)
+        with self._lock:
+            old_cell = self._cell_of.get(escooter_id)
+            if old_cell is not None and old_cell != cell:
+                self._discard(escooter_id, old_cell)
+            self._cells.setdefault(cell, {})[escooter_id] = (tuple(location), busy)
+            self._cell_of[escooter_id] = cell
+            self._grow_bounds(cell)
+
+    def update_many(self, entries):
+        # (escooter_id, location, busy) for many scooters at once, e.g. when restoring the fleet
+        size = self.cell_size
+        added = set()
+        with self._lock:
+            for escooter_id, location, busy in entries:
+                cell = (math.floor(location[0] / size), math.floor(location[1] / size))
+                old_cell = self._cell_of.get(escooter_id)
+                if old_cell is not None and old_cell != cell:
+                    self._discard(escooter_id, old_cell)
+                bucket = self._cells.get(cell)
+                if bucket is None:
+                    bucket = self._cells[cell] = {}
+                    added.add(cell)
+                bucket[escooter_id] = (tuple(location), busy)
+                self._cell_of[escooter_id] = cell
+            # only new cells can widen the bounds
+            for cell in added:
+                self._grow_bounds(cell)
+
+    def remove(self, escooter_id):
+        with self._lock:
+            cell = self._cell_of.pop(escooter_id, None)
+            if cell is not None:
+                self._discard(escooter_id, cell)
+
+    def get(self, escooter_id):
+        with self._lock:
+            cell = self._cell_of.get(escooter_id)
+            if cell is None:
+                return None
+            return self._cells[cell][escooter_id]
+
+    def entries(self):
+        # escooter_id -> (location, busy) of every scooter, taken under one lock
+        with self._lock:
+            return {escooter_id: entry for bucket in self._cells.values() for escooter_id, entry in bucket.items()}
+
+    def _discard(self, escooter_id, cell):
+        bucket = self._cells.get(cell)
+        if bucket is None:
+            return
+        bucket.pop(escooter_id, None)
+        if not bucket:
+            del self._cells[cell]
+
+    def _grow_bounds(self, cell):
+        if self._bounds is None:
+            self._bounds = [cell[0], cell[1], cell[0], cell[1]]
+        else:
+            b = self._bounds
+            b[0], b[1] = min(b[0], cell[0]), min(b[1], cell[1])
+            b[2], b[3] = max(b[2], cell[0]), max(b[3], cell[1])
+
+    def _ring(self, center, r):
+        cx, cy = center
+        if r == 0:
+            yield center
+            return
+        for x in range(cx - r, cx + r + 1):
+            yield (x, cy - r)
+            yield (x, cy + r)
+        for y in range(cy - r + 1, cy + r):
+            yield (cx - r, y)
+            yield (cx + r, y)
+
+    def nearest(self, location, k=10, radius=None, include_busy=False, exclude=None):
+        """
+        Return up to `k` scooters around `location`, closest first.
+
+        Each item is a tuple `(distance, escooter_id, location)`. Busy scooters
+        are skipped unless `include_busy` is set, and `exclude` can be a callable
+        that returns True for ids that must not be offered (e.g. reserved ones).
+        """
+        if k <= 0:
+            return []
+        center = self._cell(location)
+        best = []  # max-heap on distance, stored as (-distance, id, location)
+        with self._lock:
+            if not self._cells:
+                return []
+            b = self._bounds
+            max_ring = max(center[0] - b[0], b[2] - center[0], center[1] - b[1], b[3] - center[1], 0)
+            r = 0
+            while r <= max_ring:
+                # anything in ring r is at least (r - 1) cells away on one axis
+                lower_bound = max(r - 1, 0) * self.cell_size / 2
+                if radius is not None and lower_bound > radius:
+                    break
+                if len(best) == k and lower_bound > -best[0][0]:
+                    break
+                for cell in self._ring(center, r):
+                    bucket = self._cells.get(cell)
+                    if not bucket:
+                        continue
+                    for escooter_id, (escooter_location, busy) in bucket.items():
+                        if busy and not include_busy:
+                            continue
+                        if exclude is not None and exclude(escooter_id):
+                            continue
+                        distance = grid_distance(location, escooter_location)
+                        if radius is not None and distance > radius:
+                            continue
+                        item = (-distance, escooter_id, escooter_location)
+                        if len(best) < k:
+                            heapq.heappush(best, item)
+                        elif distance < -best[0][0]:
+                            heapq.heapreplace(best, item)
+                r += 1
+        return sorted(((-d, escooter_id, loc) for d, escooter_id, loc in best), key=lambda item: item[0])
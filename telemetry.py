@@ -0,0 +1,82 @@
+import math
+
+import numpy as np
+
+# seconds between two reports of an escooter standing still and free
+PARKED_REPORT_INTERVAL = 60.0
+# a moving escooter reports at least this often, even when on its predicted track
+MOVING_REPORT_INTERVAL = 30.0
+# report when the escooter is this far from where its last report predicts it to be
+DEAD_RECKONING_THRESHOLD = 5.0
+# or when its heading changed by more than this
+HEADING_CHANGE_THRESHOLD = math.radians(30)
+# seconds between two telemetry rounds
+TELEMETRY_TICK = 1.0
+# most reports sent in one message
+MAX_BATCH_SIZE = 5000
+# below this speed an escooter counts as standing still
+MIN_SPEED = 0.01
+
+
+class TelemetryScheduler:
+    """
+    Decides which escooters of a fleet have to report, all at once.
+
+    For every escooter it remembers what its last report said: position,
+    velocity, busy flag and time. Anyone using the reports can predict where a
+    moving escooter is from those (dead reckoning), so an escooter only has to
+    report again when:
+
+    * it became busy or free,
+    * it is parked and PARKED_REPORT_INTERVAL has passed,
+    * it moves and the prediction is off by DEAD_RECKONING_THRESHOLD, its
+      heading changed by HEADING_CHANGE_THRESHOLD, or MOVING_REPORT_INTERVAL
+      has passed.
+
+    The first reports of parked escooters are spread over a whole interval, so
+    a parked fleet reports at a steady rate instead of all at once.
+    """
+
+    def __init__(self, size, seed=None, parked_interval=PARKED_REPORT_INTERVAL,
+                 moving_interval=MOVING_REPORT_INTERVAL, threshold=DEAD_RECKONING_THRESHOLD,
+                 heading_threshold=HEADING_CHANGE_THRESHOLD):
+        self._rng = np.random.default_rng(seed)
+        self.parked_interval = parked_interval
+        self.moving_interval = moving_interval
+        self.threshold = threshold
+        self._cos_heading = math.cos(heading_threshold)
+        self.positions = np.full((size, 2), np.nan)
+        self.velocities = np.zeros((size, 2))
+        self.busy = np.zeros(size, dtype=bool)
+        self.reported_at = np.zeros(size)
+
+    def due(self, positions, velocities, busy, now):
+        """Indices of the escooters that have to report now."""
+        never = np.isnan(self.positions[:, 0])
+        age = now - self.reported_at
+        predicted = self.positions + self.velocities * age[:, None]
+        error = np.hypot(*(positions - predicted).T)
+
+        speed = np.hypot(*velocities.T)
+        reported_speed = np.hypot(*self.velocities.T)
+        moving = (speed > MIN_SPEED) | (reported_speed > MIN_SPEED)
+        dot = np.einsum('ij,ij->i', velocities, self.velocities)
+        both_moving = (speed > MIN_SPEED) & (reported_speed > MIN_SPEED)
+        # started, stopped or turned
+        turned = (speed > MIN_SPEED) != (reported_speed > MIN_SPEED)
+        turned[both_moving] = dot[both_moving] < self._cos_heading * speed[both_moving] * reported_speed[both_moving]
+
+        due = never | (busy != self.busy)
+        due |= ~moving & (age >= self.parked_interval)
+        due |= moving & ((error > self.threshold) | turned | (age >= self.moving_interval))
+        return np.flatnonzero(due)
+
+    def reported(self, indices, positions, velocities, busy, now):
+        first = np.isnan(self.positions[indices, 0])
+        self.positions[indices] = positions[indices]
+        self.velocities[indices] = velocities[indices]
+        self.busy[indices] = busy[indices]
+        self.reported_at[indices] = now
+        # spread the next report of the parked ones over one interval
+        parked_first = indices[first & ~busy[indices]]
+        self.reported_at[parked_first] -= self._rng.uniform(0, self.parked_interval, len(parked_first))
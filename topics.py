@@ -0,0 +1,71 @@
+import zlib
+
+# Topic layout shared by the phone, the server and the escooters.
+#
+# Everything sent to the server goes below MQTT_TOPIC_INPUT, one subtopic per
+# sender, and the server subscribes to all of it with a wildcard. Everything the
+# server sends goes below MQTT_TOPIC_OUTPUT, one subtopic per recipient, so each
+# client only receives the messages meant for it. Escooters are addressed below
+# one of ESCOOTER_TOPIC_BUCKETS buckets, so a gateway serving part of the fleet
+# subscribes to the buckets of its escooters instead of to every escooter.
+
+MQTT_TOPIC_INPUT = 'team02Input'
+MQTT_TOPIC_OUTPUT = 'team02Output'
+
+# matches MQTT_TOPIC_INPUT itself as well, so clients that still publish there work
+MQTT_TOPIC_INPUT_ALL = MQTT_TOPIC_INPUT + '/#'
+# what phones send, split between the servers of a cluster, see cluster.py
+MQTT_TOPIC_PHONES_ALL = MQTT_TOPIC_INPUT + '/phone/#'
+# what escooters and their gateways send, every server of a cluster gets all of it
+MQTT_TOPIC_ESCOOTERS_ALL = MQTT_TOPIC_INPUT + '/escooter/#'
+MQTT_TOPIC_GATEWAYS_ALL = MQTT_TOPIC_INPUT + '/gateway/#'
+
+# servers of a cluster talk to each other below this
+MQTT_TOPIC_CLUSTER = 'team02Cluster'
+
+ESCOOTER_TOPIC_BUCKETS = 64
+
+
+def phone_input_topic(phone_name):
+    return '{}/phone/{}'.format(MQTT_TOPIC_INPUT, phone_name)
+
+
+def escooter_input_topic(escooter_name):
+    return '{}/escooter/{}'.format(MQTT_TOPIC_INPUT, escooter_name)
+
+
+def gateway_input_topic(gateway_name):
+    # batched messages of an escooter gateway, on behalf of many escooters
+    return '{}/gateway/{}'.format(MQTT_TOPIC_INPUT, gateway_name)
+
+
+def phone_topic(phone_name):
+    return '{}/phone/{}'.format(MQTT_TOPIC_OUTPUT, phone_name)
+
+
+def escooter_bucket(escooter_name):
+    return zlib.crc32(escooter_name.encode('utf-8')) % ESCOOTER_TOPIC_BUCKETS
+
+
+def escooter_topic(escooter_name):
+    return '{}/escooter/{}/{}'.format(MQTT_TOPIC_OUTPUT, escooter_bucket(escooter_name), escooter_name)
+
+
+def escooter_bucket_topic(bucket):
+    # every escooter of one bucket, or of the whole fleet with '+'
+    return '{}/escooter/{}/+'.format(MQTT_TOPIC_OUTPUT, bucket)
+
+
+def shared_topic(group, topic):
+    # MQTT shared subscription: the broker hands each message to one subscriber of the group
+    return '$share/{}/{}'.format(group, topic)
+
+
+def member_topic(node):
+    # heartbeats of a server node
+    return '{}/member/{}'.format(MQTT_TOPIC_CLUSTER, node)
+
+
+def node_topic(node):
+    # messages forwarded or handed over to one server node
+    return '{}/node/{}'.format(MQTT_TOPIC_CLUSTER, node)
@@ -0,0 +1,165 @@
+import logging
+import queue
+import struct
+import threading
+import time
+
+from codec import BINARY, CODECS, JSON, CodecError
+
+# A recording is a header followed by one record per message, in the order the
+# messages went through the transport. Every record is a fixed-size head, the
+# topic and the message in the binary format of codec.py, so a recording can be
+# read one record at a time however large it grows.
+TRAFFIC_MAGIC = b'T02TRAF1'
+INBOUND = 0
+OUTBOUND = 1
+# messages waiting for the writer; when it falls behind further, new ones are
+# dropped rather than slowing the server down
+RECORDER_QUEUE_SIZE = 100000
+# bytes gathered before they are written out
+WRITE_BUFFER_SIZE = 1 << 20
+# seconds between two checks of close() that the writer is still there to take what is queued
+CLOSE_POLL_INTERVAL = 1.0
+
+# wall-clock time the recording started at
+_header = struct.Struct('<d')
+# seconds since the start, direction, codec the message travelled in, length of the topic and of the message
+_record = struct.Struct('<dBBHI')
+# codec names by their code in a record, 0 is a message handed over in-process
+_CODEC_NAMES = [None, JSON, BINARY]
+_CODEC_CODES = {name: code for code, name in enumerate(_CODEC_NAMES)}
+
+
+class TrafficRecorder:
+    """
+    Writes every message handed to `record` to a recording file.
+
+    The caller only puts the message on a queue; encoding and writing happen on
+    the recorder's own thread, so the messages must not be changed after they
+    were recorded, which transports already ask of publishers and subscribers.
+    """
+
+    def __init__(self, path, queue_size=RECORDER_QUEUE_SIZE):
+        self._logger = logging.getLogger(__name__)
+        self.path = path
+        self._codec = CODECS[BINARY]
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._file = open(path, 'wb', buffering=WRITE_BUFFER_SIZE)
+        self._file.write(TRAFFIC_MAGIC + _header.pack(time.time()))
+        self._start = time.monotonic()
+        self.recorded = 0
+        self.dropped = 0
+        self._failed = False
+        self._writer = threading.Thread(target=self._write, daemon=True)
+        self._writer.start()
+
+    def record(self, direction, topic, msg, codec=None):
+        if self._failed:
+            self.dropped += 1
+            return
+        try:
+            self._queue.put_nowait((time.monotonic() - self._start, direction, topic, msg, codec))
+        except queue.Full:
+            self.dropped += 1
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._failed:
+                continue
+            elapsed, direction, topic, msg, codec = item
+            try:
+                data = self._codec.encode(msg)
+                topic = topic.encode('utf-8')
+                record = _record.pack(elapsed, direction, _CODEC_CODES.get(codec and codec.name, 0),
+                                      len(topic), len(data)) + topic + data
+            except Exception as err:
+                # whatever is wrong with one message, the writer has to keep going
+                self._logger.error('Message to topic {} could not be recorded. {}'.format(topic, err))
+                continue
+            try:
+                self._file.write(record)
+            except OSError as err:
+                self._logger.error('Recording {} could not be written, dropping the rest. {}'.format(self.path, err))
+                self._failed = True
+                continue
+            self.recorded += 1
+        try:
+            self._file.close()
+        except OSError as err:
+            self._logger.error('Recording {} could not be written to the end. {}'.format(self.path, err))
+
+    def close(self):
+        # whatever is queued still goes to the file, as long as there is a writer to take it
+        while self._writer.is_alive():
+            try:
+                self._queue.put(None, timeout=CLOSE_POLL_INTERVAL)
+                break
+            except queue.Full:
+                pass
+        else:
+            self._logger.error('Writer of recording {} is gone, {} messages are lost'.format(
+                self.path, self._queue.qsize()))
+        self._writer.join()
+        if self.dropped:
+            self._logger.warning('Recording {} dropped {} messages'.format(self.path, self.dropped))
+
+
+def read_traffic(path):
+    """
+    Yields (seconds since the start, direction, topic, message, codec name) for
+    every record of a recording, reading it one record at a time.
+    """
+    logger = logging.getLogger(__name__)
+    codec = CODECS[BINARY]
+    with open(path, 'rb') as f:
+        if f.read(len(TRAFFIC_MAGIC)) != TRAFFIC_MAGIC or len(f.read(_header.size)) < _header.size:
+            raise CodecError('{} is not a traffic recording'.format(path))
+        while True:
+            head = f.read(_record.size)
+            if len(head) < _record.size:
+                if head:
+                    logger.warning('Recording {} ends in a partial record'.format(path))
+                return
+            elapsed, direction, codec_code, topic_size, size = _record.unpack(head)
+            body = f.read(topic_size + size)
+            if len(body) < topic_size + size:
+                logger.warning('Recording {} ends in a partial record'.format(path))
+                return
+            yield (elapsed, direction, body[:topic_size].decode('utf-8'), codec.decode(body[topic_size:]),
+                   _CODEC_NAMES[codec_code] if codec_code < len(_CODEC_NAMES) else None)
+
+
+class RecordingTransport:
+    """
+    Any transport, with everything it receives and publishes recorded.
+
+    Meant to capture the traffic of a server in production, to be replayed
+    against another build of it later (see `replay.py`).
+    """
+
+    def __init__(self, transport, recorder):
+        self.transport = transport
+        self.recorder = recorder
+        self.on_message = None
+        transport.on_message = self._on_message
+
+    def subscribe(self, topic):
+        self.transport.subscribe(topic)
+
+    def start(self):
+        self.transport.start()
+
+    def stop(self):
+        self.transport.stop()
+        self.recorder.close()
+
+    def publish(self, topic, msg, qos=2, codec=None):
+        self.recorder.record(OUTBOUND, topic, msg, codec)
+        self.transport.publish(topic, msg, qos, codec)
+
+    def _on_message(self, topic, msg, codec):
+        self.recorder.record(INBOUND, topic, msg, codec)
+        self.on_message(topic, msg, codec)
@@ -0,0 +1,213 @@
+import logging
+import threading
+
+import paho.mqtt.client as mqtt
+
+from codec import JSON, decode, get_codec
+
+MQTT_BROKER = 'mqtt20.iik.ntnu.no'
+MQTT_PORT = 1883
+
+# Transports move message dicts between the components. They all offer the same
+# small interface:
+#
+#   transport.on_message = callback(topic, msg, codec)
+#   transport.subscribe(topic)
+#   transport.start()
+#   transport.publish(topic, msg, qos, codec=None)
+#   transport.stop()
+#
+# `codec` in the callback is the codec the message arrived in, or None when it
+# was handed over in-process without being serialized.
+
+
+def topic_matches(pattern, topic):
+    pattern_parts = pattern.split('/')
+    topic_parts = topic.split('/')
+    for i, part in enumerate(pattern_parts):
+        if part == '#':
+            return True
+        if i >= len(topic_parts) or (part != '+' and part != topic_parts[i]):
+            return False
+    return len(pattern_parts) == len(topic_parts)
+
+
+class MqttTransport:
+    """The paho MQTT client behind the transport interface."""
+
+    def __init__(self, broker=MQTT_BROKER, port=MQTT_PORT, codec=JSON):
+        self._logger = logging.getLogger(__name__)
+        self.broker = broker
+        self.port = port
+        self.codec = get_codec(codec)
+        self.on_message = None
+        self._subscriptions = []
+        self.mqtt_client = mqtt.Client()
+        self.mqtt_client.on_connect = self._on_connect
+        self.mqtt_client.on_message = self._on_message
+
+    def subscribe(self, topic):
+        self._subscriptions.append(topic)
+        if self.mqtt_client.is_connected():
+            self.mqtt_client.subscribe(topic)
+
+    def start(self):
+        self._logger.debug('Connecting to MQTT broker {} at port {}'.format(self.broker, self.port))
+        self.mqtt_client.connect(self.broker, self.port)
+        self.mqtt_client.loop_start()
+
+    def stop(self):
+        self.mqtt_client.loop_stop()
+
+    def publish(self, topic, msg, qos=2, codec=None):
+        payload = (codec or self.codec).encode(msg)
+        self.mqtt_client.publish(topic, payload=payload, qos=qos)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        self._logger.debug('MQTT connected to {}'.format(client))
+        # (re)subscribe, so a reconnect does not lose our topics
+        for topic in self._subscriptions:
+            client.subscribe(topic)
+
+    def _on_message(self, client, userdata, msg):
+        try:
+            codec, payload = decode(msg.payload)
+        except Exception as err:
+            self._logger.error('Message sent to topic {} had no valid payload. Message ignored. {}'.format(msg.topic, err))
+            return
+        self.on_message(msg.topic, payload, codec)
+
+
+class LoopbackBus:
+    """
+    In-process stand-in for the broker.
+
+    Messages are handed to every matching subscriber as the very same dict, in
+    the publisher's thread, without being serialized. Publishers must therefore
+    not change a message after publishing it, and subscribers must not change
+    the messages they receive.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # exact topics are looked up directly, only wildcards are matched one by one
+        self._exact = {}
+        self._wildcards = []
+        # (group, pattern) -> members of a shared subscription, and who got the last message
+        self._shared = {}
+        self._shared_turn = {}
+
+    def subscribe(self, pattern, transport):
+        with self._lock:
+            if pattern.startswith('$share/'):
+                _, group, shared_pattern = pattern.split('/', 2)
+                self._shared.setdefault((group, shared_pattern), []).append(transport)
+            elif '+' in pattern or '#' in pattern:
+                self._wildcards.append((pattern, transport))
+            else:
+                self._exact.setdefault(pattern, []).append(transport)
+
+    def unsubscribe_all(self, transport):
+        with self._lock:
+            self._wildcards = [(p, t) for p, t in self._wildcards if t is not transport]
+            for pattern in list(self._exact):
+                self._exact[pattern] = [t for t in self._exact[pattern] if t is not transport]
+                if not self._exact[pattern]:
+                    del self._exact[pattern]
+            for key in list(self._shared):
+                self._shared[key] = [t for t in self._shared[key] if t is not transport]
+                if not self._shared[key]:
+                    del self._shared[key]
+
+    def subscribers(self, topic, pick=False):
+        """Everybody subscribed to `topic`; with `pick`, only one member of each shared subscription."""
+        with self._lock:
+            receivers = list(self._exact.get(topic, ()))
+            for pattern, transport in self._wildcards:
+                if transport not in receivers and topic_matches(pattern, topic):
+                    receivers.append(transport)
+            for key, members in self._shared.items():
+                if not topic_matches(key[1], topic):
+                    continue
+                if pick:
+                    # round robin, like a broker without a smarter strategy
+                    turn = self._shared_turn.get(key, -1) + 1
+                    self._shared_turn[key] = turn
+                    members = [members[turn % len(members)]]
+                receivers.extend(transport for transport in members if transport not in receivers)
+        return receivers
+
+    def publish(self, topic, msg):
+        receivers = self.subscribers(topic, pick=True)
+        for transport in receivers:
+            transport.deliver(topic, msg)
+        return len(receivers)
+
+
+class LoopbackTransport:
+    """Transport for components that live in the same process, connected by a LoopbackBus."""
+
+    def __init__(self, bus):
+        self._logger = logging.getLogger(__name__)
+        self.bus = bus
+        self.on_message = None
+        self._subscriptions = []
+        self._started = False
+
+    def subscribe(self, topic):
+        self._subscriptions.append(topic)
+        if self._started:
+            self.bus.subscribe(topic, self)
+
+    def start(self):
+        self._started = True
+        for topic in self._subscriptions:
+            self.bus.subscribe(topic, self)
+
+    def stop(self):
+        self._started = False
+        self.bus.unsubscribe_all(self)
+
+    def publish(self, topic, msg, qos=2, codec=None):
+        self.bus.publish(topic, msg)
+
+    def deliver(self, topic, msg):
+        self.on_message(topic, msg, None)
+
+
+class LocalFirstTransport:
+    """
+    Loopback for peers in this process, MQTT for everybody else.
+
+    Meant for a server and an escooter gateway running on the same machine:
+    messages between the two stay in-process while phones still go through the
+    broker. Subscriptions are made on both sides.
+    """
+
+    def __init__(self, local, remote):
+        self.local = local
+        self.remote = remote
+        self.on_message = None
+        local.on_message = self._on_message
+        remote.on_message = self._on_message
+
+    def subscribe(self, topic):
+        self.local.subscribe(topic)
+        self.remote.subscribe(topic)
+
+    def start(self):
+        self.local.start()
+        self.remote.start()
+
+    def stop(self):
+        self.local.stop()
+        self.remote.stop()
+
+    def publish(self, topic, msg, qos=2, codec=None):
+        if self.local.bus.subscribers(topic):
+            self.local.publish(topic, msg, qos)
+        else:
+            self.remote.publish(topic, msg, qos, codec)
+
+    def _on_message(self, topic, msg, codec):
+        self.on_message(topic, msg, codec)